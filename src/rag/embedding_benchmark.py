@@ -0,0 +1,158 @@
+"""
+Embedding backend benchmark and parity check.
+
+Embeds the same chunked PDFs with each backend in a fresh subprocess (so the
+peak RSS of one backend doesn't leak into another's number), then compares
+every backend against torch.
+
+Usage:
+    python embedding_benchmark.py                       # sample PDFs in this folder
+    python embedding_benchmark.py --files a.pdf b.pdf --backends torch onnx-int8
+
+Reports per backend: load time, chunks/sec, peak RSS. For each non-torch
+backend it also reports the mean and minimum cosine similarity to the torch
+vectors, plus how much of torch's top-k each query retrieves (recall@k).
+A backend whose vectors are meant to search torch-built stores should sit
+near 1.0 on both.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import List
+
+HERE = Path(__file__).parent
+DEFAULT_FILES = sorted(str(p) for p in HERE.glob("*.pdf"))
+QUERIES = [
+    "denial reason policy coverage exclusions",
+    "medical necessity criteria",
+    "appeal rights and deadlines",
+    "insurance company name plan name policy number",
+]
+
+
+def _load_chunks(files: List[str]) -> List[str]:
+    from langchain_community.document_loaders import PyPDFLoader
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    docs = []
+    for f in files:
+        docs.extend(PyPDFLoader(f).load())
+    splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=600, add_start_index=True)
+    return [c.page_content for c in splitter.split_documents(docs)]
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_backend(backend: str, chunks_path: str, output_path: str):
+    """Child process: embed the chunks with one backend and dump timings + vectors."""
+    from embedding_engine import build_embedding_engine
+
+    with open(chunks_path) as f:
+        chunks = json.load(f)
+
+    start = time.perf_counter()
+    engine = build_embedding_engine("all-MiniLM-L6-v2", backend=backend)
+    load_seconds = time.perf_counter() - start
+
+    engine.embed_documents(chunks[:8])  # warm-up, not timed
+    start = time.perf_counter()
+    vectors = engine.embed_documents(chunks)
+    embed_seconds = time.perf_counter() - start
+    queries = [engine.embed_query(q) for q in QUERIES]
+
+    with open(output_path, "w") as f:
+        json.dump({
+            "backend": backend,
+            "loadSeconds": round(load_seconds, 2),
+            "chunksPerSec": round(len(chunks) / embed_seconds, 1) if embed_seconds else 0.0,
+            "peakRssMb": round(_peak_rss_mb(), 1),
+            "vectors": vectors,
+            "queries": queries,
+        }, f)
+
+
+def _cosine(a, b) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    na = sum(x * x for x in a) ** 0.5
+    nb = sum(y * y for y in b) ** 0.5
+    return dot / (na * nb) if na and nb else 0.0
+
+
+def _top_k(query, vectors, k: int) -> List[int]:
+    scores = sorted(((_cosine(query, v), i) for i, v in enumerate(vectors)), reverse=True)
+    return [i for _, i in scores[:k]]
+
+
+def compare(reference: dict, candidate: dict, k: int) -> dict:
+    sims = [_cosine(a, b) for a, b in zip(reference["vectors"], candidate["vectors"])]
+    recalls = []
+    for ref_q, cand_q in zip(reference["queries"], candidate["queries"]):
+        ref_top = set(_top_k(ref_q, reference["vectors"], k))
+        cand_top = set(_top_k(cand_q, candidate["vectors"], k))
+        recalls.append(len(ref_top & cand_top) / max(1, len(ref_top)))
+    return {
+        "meanCosine": round(sum(sims) / len(sims), 5) if sims else 0.0,
+        "minCosine": round(min(sims), 5) if sims else 0.0,
+        f"recall@{k}": round(sum(recalls) / len(recalls), 3) if recalls else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark embedding backends against torch")
+    parser.add_argument("--files", nargs="*", default=DEFAULT_FILES, help="PDFs to chunk and embed")
+    parser.add_argument("--backends", nargs="*", default=["torch", "onnx", "onnx-int8"], help="Backends to compare")
+    parser.add_argument("--k", type=int, default=10, help="Top-k used for the retrieval overlap check")
+    parser.add_argument("--child", nargs=3, metavar=("BACKEND", "CHUNKS", "OUTPUT"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_backend(*args.child)
+        return
+
+    if not args.files:
+        print("No PDFs given and none found next to this script", file=sys.stderr)
+        sys.exit(1)
+
+    backends = list(dict.fromkeys(["torch"] + args.backends))
+    chunks = _load_chunks(args.files)
+    print(f"Benchmarking {len(chunks)} chunks from {len(args.files)} file(s)", file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        chunks_path = os.path.join(tmp, "chunks.json")
+        with open(chunks_path, "w") as f:
+            json.dump(chunks, f)
+
+        results = {}
+        for backend in backends:
+            output_path = os.path.join(tmp, f"{backend}.json")
+            subprocess.run(
+                [sys.executable, __file__, "--child", backend, chunks_path, output_path],
+                check=True,
+                cwd=str(HERE),
+            )
+            with open(output_path) as f:
+                results[backend] = json.load(f)
+
+    report = []
+    for backend in backends:
+        r = results[backend]
+        row = {k: r[k] for k in ("backend", "loadSeconds", "chunksPerSec", "peakRssMb")}
+        if backend != "torch":
+            row.update(compare(results["torch"], r, args.k))
+        report.append(row)
+    print(json.dumps({"chunks": len(chunks), "results": report}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
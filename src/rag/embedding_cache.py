@@ -0,0 +1,187 @@
+"""
+Content-addressed embedding cache for the PolicyPilot RAG pipeline.
+
+Chunks are keyed by (model name, sha256 of whitespace-normalised text) so the
+same policy text, boilerplate denial language or re-uploaded file is only ever
+embedded once per model. Vectors are stored as packed float32 blobs in SQLite
+and evicted least-recently-used once the entry cap is reached.
+"""
+
+import os
+import sys
+import sqlite3
+import hashlib
+import threading
+from array import array
+from typing import List, Dict, Optional
+
+try:
+    from langchain_core.embeddings import Embeddings
+except ImportError:
+    # EmbeddingCache is plain SQLite; only CachedEmbeddings plugs into LangChain
+    Embeddings = object
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """SQLite store of float32 vectors with LRU eviction and hit/miss counters."""
+
+    def __init__(self, path: str, max_entries: int = 200_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._tick = 0
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                dim INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                last_access INTEGER NOT NULL,
+                PRIMARY KEY (model, hash)
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access)")
+        row = self._conn.execute("SELECT COALESCE(MAX(last_access), 0) FROM embeddings").fetchone()
+        self._tick = row[0]
+        self._conn.commit()
+
+    def _next_tick(self) -> int:
+        self._tick += 1
+        return self._tick
+
+    def get_many(self, model: str, hashes: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        if not hashes:
+            return found
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            # SQLite caps bound parameters, so look up in slices
+            for i in range(0, len(unique), 500):
+                batch = unique[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({placeholders})",
+                    [model, *batch],
+                ).fetchall()
+                for h, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[h] = vector.tolist()
+            if found:
+                tick = self._next_tick()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE model = ? AND hash = ?",
+                    [(tick, model, h) for h in found],
+                )
+                self._conn.commit()
+            self.hits += sum(1 for h in hashes if h in found)
+            self.misses += sum(1 for h in hashes if h not in found)
+        return found
+
+    def put_many(self, model: str, items: Dict[str, List[float]]):
+        if not items:
+            return
+        with self._lock:
+            tick = self._next_tick()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, dim, vector, last_access) VALUES (?, ?, ?, ?, ?)",
+                [(model, h, len(v), array("f", v).tobytes(), tick) for h, v in items.items()],
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+                (overflow,),
+            )
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRatio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that consults an EmbeddingCache before delegating to
+    the underlying model. Only cache misses are sent to the model.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model_name: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = model_name
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [text_hash(t) for t in texts]
+        found = self.cache.get_many(self.model_name, hashes)
+        cached = sum(1 for h in hashes if h in found)
+
+        missing = {}
+        for h, t in zip(hashes, texts):
+            if h not in found and h not in missing:
+                missing[h] = t
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(self.model_name, computed)
+            found.update(computed)
+
+        stats = self.cache.stats()
+        print(
+            f"Embedding cache: {cached}/{len(texts)} cached "
+            f"(lifetime hits={stats['hits']} misses={stats['misses']})",
+            file=sys.stderr,
+        )
+        return [found[h] for h in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        h = text_hash(text)
+        found = self.cache.get_many(self.model_name, [h])
+        if h in found:
+            return found[h]
+        vector = self.embeddings.embed_query(text)
+        self.cache.put_many(self.model_name, {h: vector})
+        return vector
+
+
+def open_embedding_cache(path: Optional[str] = None, max_entries: Optional[int] = None) -> Optional[EmbeddingCache]:
+    """
+    Open the cache configured by EMBEDDING_CACHE_PATH / EMBEDDING_CACHE_MAX_ENTRIES.
+    Setting EMBEDDING_CACHE_PATH to an empty string disables caching.
+    """
+    if path is None:
+        path = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+    if not path:
+        return None
+    if max_entries is None:
+        max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+    try:
+        return EmbeddingCache(path, max_entries=max_entries)
+    except Exception as e:
+        print(f"Warning: Could not open embedding cache at {path}: {e}", file=sys.stderr)
+        return None
@@ -0,0 +1,194 @@
+"""
+Batched embedding engine for the PolicyPilot RAG pipeline.
+
+Wraps an embedding backend with explicit batch sizing, length-sorted batching
+(similar-length chunks share a batch, so less padding is computed) and
+throughput reporting, and configures the torch intra-op thread pool for
+CPU-only hosts.
+
+Configuration (environment):
+    EMBEDDING_BATCH_SIZE        chunks per encode call (default 32)
+    EMBEDDING_THREADS           intra-op threads (torch or onnxruntime), 0 = library default (default 0)
+    EMBEDDING_SORT_BY_LENGTH    1/0, sort chunks by length before batching (default 1)
+    EMBEDDING_NORMALIZE         1/0, L2-normalise vectors (default 0; all-MiniLM-L6-v2
+                                already ends in a Normalize layer)
+    EMBEDDING_BACKEND           torch | onnx | onnx-int8 (default torch)
+    EMBEDDING_ONNX_FILE         ONNX file in the model's hub repo; defaults to
+                                onnx/model.onnx, or onnx/model_quint8_avx2.onnx for onnx-int8
+
+The onnx backends run the model's published ONNX export with onnxruntime and
+tokenizers only, so they never import torch. Their vectors are mean-pooled and
+L2-normalised like the sentence-transformers pipeline, so they can search
+stores built with the torch backend (see embedding_benchmark.py for parity).
+"""
+
+import os
+import sys
+import time
+import threading
+from typing import List, Dict
+from langchain_core.embeddings import Embeddings
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    return os.getenv(name, "1" if default else "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+class EmbeddingEngine(Embeddings):
+    """
+    Embeddings wrapper that feeds the backend fixed-size, length-sorted
+    batches and tracks chunks/sec. Output order always matches input order.
+    """
+
+    def __init__(self, backend: Embeddings, batch_size: int = 32, sort_by_length: bool = True, name: str = "embeddings"):
+        self.backend = backend
+        self.batch_size = max(1, batch_size)
+        self.sort_by_length = sort_by_length
+        self.name = name
+        self.total_chunks = 0
+        self.total_seconds = 0.0
+        self._stats_lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        order = list(range(len(texts)))
+        if self.sort_by_length:
+            order.sort(key=lambda i: len(texts[i]), reverse=True)
+
+        start = time.perf_counter()
+        vectors: List[List[float]] = [None] * len(texts)
+        for i in range(0, len(order), self.batch_size):
+            batch_idx = order[i:i + self.batch_size]
+            batch_vectors = self.backend.embed_documents([texts[j] for j in batch_idx])
+            for j, vector in zip(batch_idx, batch_vectors):
+                vectors[j] = vector
+        elapsed = time.perf_counter() - start
+
+        with self._stats_lock:
+            self.total_chunks += len(texts)
+            self.total_seconds += elapsed
+        rate = len(texts) / elapsed if elapsed > 0 else float("inf")
+        print(
+            f"Embedded {len(texts)} chunks in {elapsed:.2f}s ({rate:.1f} chunks/sec, "
+            f"batch_size={self.batch_size}, backend={self.name})",
+            file=sys.stderr,
+        )
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.backend.embed_query(text)
+
+    def stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            return {
+                "chunks": self.total_chunks,
+                "seconds": round(self.total_seconds, 3),
+                "chunksPerSec": round(self.total_chunks / self.total_seconds, 1) if self.total_seconds else 0.0,
+            }
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    sentence-transformers style embeddings (mean pooling + L2 normalise)
+    computed with onnxruntime. Requires onnxruntime, tokenizers and
+    huggingface_hub; torch is not needed.
+    """
+
+    def __init__(self, model_name: str, onnx_file: str = "onnx/model.onnx", threads: int = 0, max_length: int = 256):
+        import numpy as np
+        import onnxruntime as ort
+        from huggingface_hub import hf_hub_download
+        from tokenizers import Tokenizer
+
+        repo_id = model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+        self._np = np
+        self.tokenizer = Tokenizer.from_file(hf_hub_download(repo_id, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+        options = ort.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(
+            hf_hub_download(repo_id, onnx_file),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        np = self._np
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+
+        token_embeddings = self.session.run(None, feeds)[0]
+        mask = attention_mask[:, :, None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._encode(texts) if texts else []
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0]
+
+
+def configure_threads(threads: int):
+    """Pin torch's intra-op thread pool; 0 leaves torch's default."""
+    if threads <= 0:
+        return
+    try:
+        import torch
+        torch.set_num_threads(threads)
+        print(f"torch intra-op threads set to {threads}", file=sys.stderr)
+    except Exception as e:
+        print(f"Warning: Could not set torch threads: {e}", file=sys.stderr)
+
+
+def build_embedding_engine(model_name: str, backend: str = None) -> EmbeddingEngine:
+    """
+    Create the configured backend for `model_name` wrapped in an EmbeddingEngine.
+
+    The engine's `name` is also the embedding cache key: torch keeps the bare
+    model name, other backends are prefixed (e.g. "onnx-int8:all-MiniLM-L6-v2")
+    because their vectors are close to, but not bit-identical with, torch's.
+    """
+    batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+    threads = int(os.getenv("EMBEDDING_THREADS", "0"))
+    backend = (backend or os.getenv("EMBEDDING_BACKEND", "torch")).strip().lower()
+    sort_by_length = _env_flag("EMBEDDING_SORT_BY_LENGTH", True)
+
+    if backend in ("onnx", "onnx-int8"):
+        default_file = "onnx/model_quint8_avx2.onnx" if backend == "onnx-int8" else "onnx/model.onnx"
+        onnx_file = os.getenv("EMBEDDING_ONNX_FILE", default_file)
+        print(f"Loading ONNX embedding backend {model_name} ({onnx_file})", file=sys.stderr)
+        return EmbeddingEngine(
+            OnnxEmbeddings(model_name, onnx_file=onnx_file, threads=threads),
+            batch_size=batch_size,
+            sort_by_length=sort_by_length,
+            name=f"{backend}:{model_name}",
+        )
+    if backend != "torch":
+        raise ValueError(f"Unknown EMBEDDING_BACKEND: {backend}")
+
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    configure_threads(threads)
+    return EmbeddingEngine(
+        HuggingFaceEmbeddings(
+            model_name=model_name,
+            encode_kwargs={
+                "batch_size": batch_size,
+                "normalize_embeddings": _env_flag("EMBEDDING_NORMALIZE", False),
+            },
+        ),
+        batch_size=batch_size,
+        sort_by_length=sort_by_length,
+        name=model_name,
+    )
@@ -0,0 +1,325 @@
+"""
+Shared Gemini client for the PolicyPilot RAG pipeline.
+
+Every generation in a process goes through one GeminiClient, which:
+
+- rate limits with two token buckets, requests/min and prompt tokens/min,
+  so bursts queue locally instead of coming back as 429s;
+- caps the calls in flight with a semaphore;
+- retries retryable failures (429, 500, 502, 503, 504, timeouts, dropped
+  connections) with jittered exponential backoff;
+- bounds each attempt with a per-call timeout and the whole call, including
+  queueing and backoff, with an overall deadline.
+
+Queue wait, retries and failures are counted and reported by stats().
+
+The transport that actually talks to Gemini is chosen with GEMINI_TRANSPORT:
+"genai" (google.generativeai) or "fake", which answers locally (with
+optional injected failures) for tests and offline runs.
+
+Configuration (environment):
+    GEMINI_TRANSPORT         genai | fake (default genai)
+    GEMINI_RPM               requests started per minute (default 60)
+    GEMINI_TPM               prompt tokens sent per minute (default 1000000)
+    GEMINI_MAX_CONCURRENCY   calls in flight (default 8)
+    GEMINI_MAX_RETRIES       retries per call after the first attempt (default 4)
+    GEMINI_BACKOFF_BASE      first retry delay in seconds (default 1.0)
+    GEMINI_BACKOFF_MAX       retry delay cap in seconds (default 30)
+    GEMINI_CALL_TIMEOUT      per-attempt timeout in seconds (default 120)
+    GEMINI_DEADLINE          whole-call deadline in seconds (default 300)
+    GEMINI_FAKE_RESPONSE     text returned by the fake transport (default "{}")
+"""
+
+import os
+import sys
+import time
+import random
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# google.api_core exception names, matched by name so this module doesn't need the SDK
+RETRYABLE_ERRORS = {
+    "ResourceExhausted", "TooManyRequests", "InternalServerError", "BadGateway",
+    "ServiceUnavailable", "DeadlineExceeded", "GatewayTimeout",
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough prompt size for the tokens/min bucket (~4 chars/token)."""
+    return (len(text) + 3) // 4
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    if type(error).__name__ in RETRYABLE_ERRORS:
+        return True
+    return getattr(error, "code", None) in RETRYABLE_STATUS
+
+
+class TokenBucket:
+    """Refills `rate_per_minute` units per minute up to `capacity`; acquire() waits for units."""
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0, deadline: float = None):
+        """Take `amount` units, sleeping until they're available; TimeoutError past `deadline`."""
+        if self.rate <= 0:
+            return
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                raise TimeoutError("Gemini rate limit wait would pass the call deadline")
+            time.sleep(wait)
+
+
+class GenaiTransport:
+    """
+    google.generativeai; `get_genai` returns the configured module. With a
+    `response_schema`, the model is asked for JSON matching it.
+    """
+
+    def __init__(self, get_genai: Callable[[], Any]):
+        self.get_genai = get_genai
+
+    @staticmethod
+    def _generation_config(response_schema: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+        if response_schema is None:
+            return None
+        return {"response_mime_type": "application/json", "response_schema": response_schema}
+
+    def generate(self, model_name: str, prompt: str, timeout: float, response_schema: Dict[str, Any] = None) -> str:
+        model = self.get_genai().GenerativeModel(model_name)
+        response = model.generate_content(
+            prompt,
+            generation_config=self._generation_config(response_schema),
+            request_options={"timeout": timeout},
+        )
+        return response.text if hasattr(response, 'text') else ""
+
+    def stream(self, model_name: str, prompt: str, timeout: float, response_schema: Dict[str, Any] = None) -> Iterator[str]:
+        model = self.get_genai().GenerativeModel(model_name)
+        response = model.generate_content(
+            prompt,
+            stream=True,
+            generation_config=self._generation_config(response_schema),
+            request_options={"timeout": timeout},
+        )
+        for chunk in response:
+            delta = chunk.text if hasattr(chunk, 'text') else ""
+            if delta:
+                yield delta
+
+
+class FakeGeminiError(Exception):
+    """Error raised by FakeTransport, carrying an HTTP-style status code."""
+
+    def __init__(self, code: int = 429, message: str = "fake Gemini error"):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class FakeTransport:
+    """
+    Local stand-in for GenaiTransport. Raises the queued `failures` first (one
+    per attempt), then answers every call with `response` after `latency`
+    seconds. Prompts are recorded in `calls`.
+    """
+
+    def __init__(self, response: str = "{}", failures: List[BaseException] = None, latency: float = 0.0):
+        self.response = response
+        self.failures = list(failures or [])
+        self.latency = latency
+        self.calls: List[str] = []
+        self._lock = threading.Lock()
+
+    def _attempt(self, prompt: str):
+        with self._lock:
+            self.calls.append(prompt)
+            failure = self.failures.pop(0) if self.failures else None
+        if self.latency:
+            time.sleep(self.latency)
+        if failure is not None:
+            raise failure
+
+    def generate(self, model_name: str, prompt: str, timeout: float, response_schema: Dict[str, Any] = None) -> str:
+        self._attempt(prompt)
+        return self.response
+
+    def stream(self, model_name: str, prompt: str, timeout: float, response_schema: Dict[str, Any] = None) -> Iterator[str]:
+        self._attempt(prompt)
+        for i in range(0, len(self.response), 16):
+            yield self.response[i:i + 16]
+
+
+class GeminiClient:
+    """Rate-limited, concurrency-capped, retrying front end for a GenaiTransport or FakeTransport."""
+
+    def __init__(
+        self,
+        transport: Any,
+        requests_per_minute: float = 60,
+        tokens_per_minute: float = 1_000_000,
+        max_concurrency: int = 8,
+        max_retries: int = 4,
+        backoff_base: float = 1.0,
+        backoff_max: float = 30.0,
+        call_timeout: float = 120.0,
+        deadline: float = 300.0,
+    ):
+        self.transport = transport
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max(1, max_concurrency)
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.call_timeout = call_timeout
+        self.deadline = deadline
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "calls": 0, "succeeded": 0, "failed": 0, "attempts": 0, "retries": 0,
+            "rateLimited": 0, "inFlight": 0, "queueWaitSeconds": 0.0, "maxQueueWaitSeconds": 0.0,
+        }
+
+    def _count(self, **deltas):
+        with self._stats_lock:
+            for name, delta in deltas.items():
+                self._stats[name] += delta
+
+    def _enter(self, prompt: str, deadline: float):
+        """Wait for both buckets and a concurrency slot; returns once the call may start."""
+        start = time.monotonic()
+        self.request_bucket.acquire(1, deadline)
+        self.token_bucket.acquire(estimate_tokens(prompt), deadline)
+        if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise TimeoutError("Timed out waiting for a free Gemini call slot")
+        waited = time.monotonic() - start
+        with self._stats_lock:
+            self._stats["queueWaitSeconds"] += waited
+            self._stats["maxQueueWaitSeconds"] = max(self._stats["maxQueueWaitSeconds"], waited)
+            self._stats["inFlight"] += 1
+            self._stats["attempts"] += 1
+
+    def _leave(self):
+        self._count(inFlight=-1)
+        self._slots.release()
+
+    def _backoff(self, attempt: int, error: BaseException, deadline: float) -> bool:
+        """Sleep before retry `attempt` (1-based); False if the error or deadline rules out a retry."""
+        if attempt > self.max_retries or not is_retryable(error):
+            return False
+        # Full jitter: uniform over [0, min(cap, base * 2^(attempt-1))]
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        if time.monotonic() + delay >= deadline:
+            return False
+        if getattr(error, "code", None) == 429 or type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+            self._count(rateLimited=1)
+        print(f"Gemini call failed ({error}); retry {attempt}/{self.max_retries} in {delay:.1f}s", file=sys.stderr)
+        self._count(retries=1)
+        time.sleep(delay)
+        return True
+
+    def generate(self, model_name: str, prompt: str, response_schema: Dict[str, Any] = None) -> str:
+        """One generation, retried on transient failures until GEMINI_DEADLINE."""
+        deadline = time.monotonic() + self.deadline
+        self._count(calls=1)
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self._enter(prompt, deadline)
+            except TimeoutError:
+                self._count(failed=1)
+                raise
+            try:
+                timeout = max(1.0, min(self.call_timeout, deadline - time.monotonic()))
+                text = self.transport.generate(model_name, prompt, timeout, response_schema=response_schema)
+            except Exception as e:
+                if not self._backoff(attempt, e, deadline):
+                    self._count(failed=1)
+                    raise
+                continue
+            finally:
+                self._leave()
+            self._count(succeeded=1)
+            return text
+
+    def stream(self, model_name: str, prompt: str, response_schema: Dict[str, Any] = None) -> Iterator[str]:
+        """
+        Yield a generation as text deltas. Failures before the first delta are
+        retried like generate(); once text has been yielded they are raised,
+        since the caller has already consumed part of the response.
+        """
+        deadline = time.monotonic() + self.deadline
+        self._count(calls=1)
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self._enter(prompt, deadline)
+            except TimeoutError:
+                self._count(failed=1)
+                raise
+            started = False
+            try:
+                timeout = max(1.0, min(self.call_timeout, deadline - time.monotonic()))
+                for delta in self.transport.stream(model_name, prompt, timeout, response_schema=response_schema):
+                    started = True
+                    yield delta
+            except Exception as e:
+                if started or not self._backoff(attempt, e, deadline):
+                    self._count(failed=1)
+                    raise
+                continue
+            finally:
+                self._leave()
+            self._count(succeeded=1)
+            return
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        attempts = stats["attempts"]
+        stats["avgQueueWaitSeconds"] = round(stats["queueWaitSeconds"] / attempts, 4) if attempts else 0.0
+        stats["queueWaitSeconds"] = round(stats["queueWaitSeconds"], 4)
+        stats["maxQueueWaitSeconds"] = round(stats["maxQueueWaitSeconds"], 4)
+        stats["maxConcurrency"] = self.max_concurrency
+        return stats
+
+
+def open_gemini_client(get_genai: Callable[[], Any], transport: Optional[str] = None) -> GeminiClient:
+    """Build the configured client; `get_genai` returns the configured google.generativeai module."""
+    transport = (transport or os.getenv("GEMINI_TRANSPORT", "genai")).strip().lower()
+    if transport == "genai":
+        backend = GenaiTransport(get_genai)
+    elif transport == "fake":
+        backend = FakeTransport(os.getenv("GEMINI_FAKE_RESPONSE", "{}"))
+    else:
+        raise ValueError(f"Unknown GEMINI_TRANSPORT: {transport}")
+    return GeminiClient(
+        backend,
+        requests_per_minute=float(os.getenv("GEMINI_RPM", "60")),
+        tokens_per_minute=float(os.getenv("GEMINI_TPM", "1000000")),
+        max_concurrency=int(os.getenv("GEMINI_MAX_CONCURRENCY", "8")),
+        max_retries=int(os.getenv("GEMINI_MAX_RETRIES", "4")),
+        backoff_base=float(os.getenv("GEMINI_BACKOFF_BASE", "1.0")),
+        backoff_max=float(os.getenv("GEMINI_BACKOFF_MAX", "30")),
+        call_timeout=float(os.getenv("GEMINI_CALL_TIMEOUT", "120")),
+        deadline=float(os.getenv("GEMINI_DEADLINE", "300")),
+    )
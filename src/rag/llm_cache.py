@@ -0,0 +1,119 @@
+"""
+Response cache for Gemini generations in the PolicyPilot RAG pipeline.
+
+Entries are keyed by sha256(model name + rendered prompt + generation options),
+so a retried analysis, a repeated extraction of the same upload or a re-opened
+email draft returns the stored text instead of paying for a new generation.
+
+Configuration (environment):
+    LLM_CACHE_BACKEND       sqlite | none (default sqlite)
+    LLM_CACHE_PATH          SQLite file (default llm_cache.sqlite3)
+    LLM_CACHE_TTL_SECONDS   entry lifetime (default 86400)
+    LLM_CACHE_MAX_ENTRIES   entries kept before LRU eviction (default 5000)
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Any, Dict, Optional
+
+
+def response_cache_key(model_name: str, prompt: str, options: Optional[Dict[str, Any]] = None) -> str:
+    payload = json.dumps({"model": model_name, "prompt": prompt, "options": options or {}}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SqliteResponseCache:
+    """Local SQLite cache with per-entry TTL, LRU eviction past max_entries and hit/miss counters."""
+
+    def __init__(self, path: str, ttl_seconds: int = 86400, max_entries: int = 5000):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                row = None
+            if row:
+                self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+                self.hits += 1
+            else:
+                self.misses += 1
+        return row[0] if row else None
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+            count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self._conn.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRatio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+def open_response_cache(backend: Optional[str] = None) -> Optional[SqliteResponseCache]:
+    """Open the configured cache; returns None when caching is disabled or unavailable."""
+    backend = (backend or os.getenv("LLM_CACHE_BACKEND", "sqlite")).strip().lower()
+    if backend in ("", "none", "off"):
+        return None
+    if backend != "sqlite":
+        print(f"Warning: Unknown LLM_CACHE_BACKEND '{backend}', response caching disabled", file=sys.stderr)
+        return None
+    path = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+    try:
+        return SqliteResponseCache(
+            path,
+            ttl_seconds=int(os.getenv("LLM_CACHE_TTL_SECONDS", "86400")),
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000")),
+        )
+    except Exception as e:
+        print(f"Warning: Could not open LLM response cache at {path}: {e}", file=sys.stderr)
+        return None
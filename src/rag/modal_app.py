@@ -5,16 +5,67 @@ Deploy with: modal deploy modal_app.py
 Local test: modal serve modal_app.py
 
 This exposes the Python pipeline as serverless HTTP endpoints.
+
+All endpoints are methods of one container class (RagService) so the slow
+start-up work happens once per container instead of on the request path:
+the embedding model weights are baked into the image at build time, the
+model and pipeline imports are loaded in a memory-snapshotted @enter hook,
+and the Mongo/Supabase/Chroma clients are opened after restore. Each
+endpoint keeps its original URL through an explicit label.
+
+The handlers themselves are blocking (pymongo, supabase, PDF parsing,
+embeddings, Gemini), so each one runs in a worker thread while the event
+loop keeps accepting other inputs; a container serves up to
+MODAL_MAX_INPUTS requests at once.
+
+Vector stores are snapshotted to the "policypilot-vector-snapshots" Volume
+(see store_snapshot.py), so a new container restores a case's index instead
+of rebuilding it from Mongo/Supabase.
+
+Deploy-time configuration (environment of `modal deploy`):
+    MODAL_MIN_CONTAINERS    containers kept warm between requests (default 0)
+    MODAL_MAX_INPUTS        requests one container serves concurrently (default 8)
 """
 
-import modal
 import os
 import json
-import tempfile
+import time
+import uuid
+import asyncio
+import functools
+import threading
 from pathlib import Path
 
+import modal
+
 # Define the Modal app
-app = modal.App("policypilot-rag")
+APP_NAME = "policypilot-rag"
+app = modal.App(APP_NAME)
+
+# Local modules shipped next to pipeline.py in the container
+PIPELINE_MODULES = [
+    "pipeline.py", "embedding_cache.py", "embedding_engine.py", "llm_cache.py",
+    "retrieval.py", "thread_context.py", "store_snapshot.py", "gemini_client.py",
+    "model_router.py", "structured_output.py",
+]
+
+EMBEDDING_MODEL_REPO = "sentence-transformers/all-MiniLM-L6-v2"
+HF_HOME = "/root/.cache/huggingface"
+TIKTOKEN_CACHE_DIR = "/root/.cache/tiktoken"
+SNAPSHOT_MOUNT = "/snapshots"
+MIN_CONTAINERS = int(os.getenv("MODAL_MIN_CONTAINERS", "0"))
+MAX_INPUTS = int(os.getenv("MODAL_MAX_INPUTS", "8"))
+
+snapshot_volume = modal.Volume.from_name("policypilot-vector-snapshots", create_if_missing=True)
+
+
+def download_model_assets():
+    """Image build step: put the embedding model weights and tokenizer files in the image."""
+    from huggingface_hub import snapshot_download
+    import tiktoken
+    snapshot_download(EMBEDDING_MODEL_REPO)
+    tiktoken.get_encoding("cl100k_base")
+
 
 # Define the container image with all dependencies and include pipeline.py
 image = (
@@ -31,494 +82,560 @@ image = (
         "python-dotenv",
         "pypdf",
         "sentence-transformers",
+        "tiktoken",
     ])
-    .add_local_file(
-        Path(__file__).parent / "pipeline.py",
-        remote_path="/root/pipeline.py"
-    )
+    .env({"HF_HOME": HF_HOME, "TIKTOKEN_CACHE_DIR": TIKTOKEN_CACHE_DIR})
+    .run_function(download_model_assets)
+    .env({
+        # Weights are baked in; never reach for the hub at request time
+        "HF_HUB_OFFLINE": "1",
+        "VECTOR_SNAPSHOT_DIR": SNAPSHOT_MOUNT,
+    })
 )
+for module_file in PIPELINE_MODULES:
+    image = image.add_local_file(
+        Path(__file__).parent / module_file,
+        remote_path=f"/root/{module_file}"
+    )
 
-@app.function(
+
+# Per-container latency, split into the first request a container serves
+# (cold) and every later one (warm)
+_container_stats = {"modelLoadSeconds": None, "connectSeconds": None}
+_latency = {"cold": [], "warm": []}
+_latency_lock = threading.Lock()
+_first_input_claimed = False
+
+
+def _blocking_endpoint(endpoint: str):
+    """
+    Run a blocking handler in the default thread pool so the event loop stays
+    free for other inputs, and record how long it takes to produce its
+    response (streams: until the response starts; starlette iterates sync
+    generators in its own thread pool).
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            global _first_input_claimed
+            # Claimed on arrival, so only one of several concurrent first inputs counts as cold
+            with _latency_lock:
+                kind = "warm" if _first_input_claimed else "cold"
+                _first_input_claimed = True
+            start = time.perf_counter()
+            try:
+                return await asyncio.to_thread(handler, *args, **kwargs)
+            finally:
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                with _latency_lock:
+                    samples = _latency[kind]
+                    samples.append(elapsed_ms)
+                    del samples[:-500]
+                print(f"{endpoint}: {elapsed_ms:.0f} ms ({kind})")
+        return wrapper
+    return decorator
+
+
+def _latency_snapshot() -> dict:
+    with _latency_lock:
+        samples = {kind: list(values) for kind, values in _latency.items()}
+    return {kind: _latency_report(values) for kind, values in samples.items()}
+
+
+def _latency_report(samples) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "avgMs": round(sum(ordered) / len(ordered), 1),
+        "p50Ms": round(ordered[len(ordered) // 2], 1),
+        "p95Ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 1),
+        "maxMs": round(ordered[-1], 1),
+    }
+
+
+def _ndjson_response(events):
+    """Stream pipeline events to the client as JSON lines."""
+    from fastapi.responses import StreamingResponse
+    return StreamingResponse(
+        (json.dumps(event) + "\n" for event in events),
+        media_type="application/x-ndjson",
+    )
+
+
+def _analysis_result(routed: dict) -> dict:
+    """Routed analysis output; the raw text stands in if it never matched the schema."""
+    if routed["data"] is not None:
+        return routed["data"]
+    return {"analysis": routed["text"].strip(), "terms": [], "parsing_note": routed["problem"]}
+
+
+def _email_result(routed: dict) -> dict:
+    """Routed email draft output; the raw text is used as the body if it never matched the schema."""
+    return {"emailDraft": routed["data"] if routed["data"] is not None else {"body": routed["text"].strip()}}
+
+
+def _attach_volume_hooks():
+    """
+    Keep the snapshot directory (the mounted Volume, via VECTOR_SNAPSHOT_DIR)
+    in sync across containers: commit after writes, reload before reporting
+    a snapshot as missing.
+    """
+    from pipeline import get_snapshot_backend
+
+    backend = get_snapshot_backend()
+    if backend is not None:
+        backend.on_write = snapshot_volume.commit
+        backend.on_miss = snapshot_volume.reload
+
+
+@app.cls(
     image=image,
     secrets=[modal.Secret.from_name("custom-secret")],  # Configure in Modal dashboard
     timeout=300,  # 5 minute timeout for long operations
+    volumes={SNAPSHOT_MOUNT: snapshot_volume},
+    min_containers=MIN_CONTAINERS,
+    enable_memory_snapshot=True,
 )
-@modal.fastapi_endpoint(method="POST")
-async def analyze_case(request: dict):
-    """
-    Analyze a case using RAG pipeline.
+@modal.concurrent(max_inputs=MAX_INPUTS)
+class RagService:
+    @modal.enter(snap=True)
+    def load_models(self):
+        """Import the pipeline and load the embedding model; captured in the memory snapshot."""
+        start = time.perf_counter()
+        from pipeline import get_embedding_function
+        from retrieval import count_tokens
+        get_embedding_function()
+        count_tokens("warm-up")
+        _container_stats["modelLoadSeconds"] = round(time.perf_counter() - start, 2)
+        print(f"Embedding model loaded in {_container_stats['modelLoadSeconds']}s")
+
+    @modal.enter(snap=False)
+    def connect(self):
+        """Open network clients after restore (sockets can't be snapshotted)."""
+        start = time.perf_counter()
+        from pipeline import get_db_connection, get_supabase_client, get_chroma_client
+
+        _attach_volume_hooks()
+        try:
+            get_db_connection()
+            get_supabase_client()
+            get_chroma_client()
+        except Exception as e:
+            # Endpoints retry on first use and report their own errors
+            print(f"Warning: Could not pre-connect clients: {e}")
+        _container_stats["connectSeconds"] = round(time.perf_counter() - start, 2)
+
+    @modal.fastapi_endpoint(method="POST", label=f"{APP_NAME}-analyze-case")
+    @_blocking_endpoint("analyze_case")
+    def analyze_case(self, request: dict):
+        """
+        Analyze a case using RAG pipeline.
     
-    POST body: { "caseId": "string", "userId": "string" }
-    Returns: { "analysis": "string", "terms": [...] }
-    """
-    from pipeline import get_vector_store, get_db_connection
-    import google.generativeai as genai
+        POST body: { "caseId": "string", "userId": "string", "stream": false }
+        Returns: { "analysis": "string", "terms": [...] }
+        With "stream": true, returns JSON lines: {"type": "delta", "text": ...} events
+        as Gemini generates, then {"type": "result", "data": <the object above>}.
+        """
+        from pipeline import get_vector_store, retrieve_case_context, route_generation, stream_events
     
-    genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
+        case_id = request.get("caseId")
+        user_id = request.get("userId")
     
-    case_id = request.get("caseId")
-    user_id = request.get("userId")
+        if not case_id or not user_id:
+            return {"error": "caseId and userId are required"}
     
-    if not case_id or not user_id:
-        return {"error": "caseId and userId are required"}
-    
-    try:
-        # Get or create vector store
-        db = get_vector_store(case_id, user_id, force_refresh=False)
-        if not db:
-            return {"error": "Failed to load or create vector store"}
-        
-        # Query for relevant context
-        query = "denial reason policy coverage exclusions"
-        results = db.similarity_search_with_relevance_scores(query, k=10)
-        
-        relevant_context = []
-        for doc, score in results:
-            if score >= 0.0:
-                relevant_context.append(doc.page_content)
-        
-        if not relevant_context:
-            return {"error": "No relevant policy sections found"}
-        
-        context_text = "\n\n".join(relevant_context)
-        
-        # Generate analysis with Gemini
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        prompt = f"""
-        You are an expert health insurance denial appeal lawyer. Analyze the following insurance denial documents and provide a COMPREHENSIVE analysis to help the patient appeal.
-
-        IMPORTANT FORMATTING RULES:
-        1. Write in PLAIN TEXT only - NO markdown, NO asterisks, NO bullet points with * or -, NO bold formatting
-        2. Use simple paragraphs and numbered lists (1. 2. 3.) when needed
-        3. Be thorough and detailed - this analysis should be at least 3-4 paragraphs
-
-        Context from denial documents:
-        ---
-        {context_text}
-        ---
-
-        Your analysis MUST include ALL of the following sections:
-
-        1. DENIAL SUMMARY: Briefly explain what was denied and why the insurance company claims they denied it.
-
-        2. WEAKNESSES TO EXPLOIT: Identify 2-3 specific weaknesses in the insurance company's denial reasoning that can be challenged. Look for:
-           - Vague or unsupported claims about "medical necessity"
-           - Failure to consider all medical evidence
-           - Misinterpretation of policy terms
-           - Procedural errors in their review process
-           - Contradictions with their own policy language
-
-        3. APPEAL STRATEGY: Provide specific steps and arguments the patient should use in their appeal, including:
-           - What evidence to gather (doctor's letters, medical records, etc.)
-           - Key arguments to make
-           - Policy provisions that support coverage
-
-        4. NEXT STEPS: List the immediate actions the patient should take.
-
-        Return a JSON object with:
-        - "analysis": The comprehensive analysis described above. Be as thorough as needed - no word limit. NO markdown formatting.
-        - "terms": A list of GENUINELY CONFUSING insurance/legal jargon terms that you use in your analysis and that need definitions.
-          CRITICAL RULES FOR TERMS:
-          * ONLY include terms that a regular person would genuinely NOT understand
-          * Each term MUST be an EXACT phrase that appears in YOUR ANALYSIS TEXT above
-          * Focus on technical insurance jargon like: "prudent layperson standard", "Evidence of Coverage", "emergency stabilization", "Level 1 Appeal", "cost-sharing", "coinsurance"
-          * DO NOT include common words people already understand like: "appeal", "denial", "coverage", "emergency", "in-network", "out-of-network"
-          * Quality over quantity - only include terms that truly need explanation
-          * Format: list of {{ "term": "exact phrase from your analysis", "definition": "simple explanation in plain English" }}
-        """
+        try:
+            # Get or create vector store
+            db = get_vector_store(case_id, user_id, force_refresh=False)
+            if not db:
+                return {"error": "Failed to load or create vector store"}
         
-        response = model.generate_content(prompt)
-        text = response.text.strip()
+            # Query for relevant context
+            relevant_context = retrieve_case_context(db)
         
-        # Remove markdown code fences
-        text = text.replace('```json', '').replace('```', '').strip()
+            if not relevant_context:
+                return {"error": "No relevant policy sections found"}
         
-        # Parse JSON from response
-        start_idx = text.find('{')
-        end_idx = text.rfind('}')
-        if start_idx != -1 and end_idx != -1:
-            json_str = text[start_idx:end_idx+1]
-            
-            try:
-                return json.loads(json_str)
-            except json.JSONDecodeError as e:
-                # Try to fix common JSON issues
-                import re
-                
-                # Replace unescaped newlines inside string values
-                # This regex-based approach is more targeted
-                def fix_json_string(s):
-                    # Replace literal newlines with escaped versions
-                    s = s.replace('\r\n', '\\n').replace('\r', '\\n').replace('\n', '\\n')
-                    s = s.replace('\t', '\\t')
-                    return s
-                
-                try:
-                    sanitized = fix_json_string(json_str)
-                    return json.loads(sanitized)
-                except json.JSONDecodeError:
-                    # Try to extract just the analysis text using regex
-                    import re
-                    analysis_match = re.search(r'"analysis"\s*:\s*"(.*?)"(?=\s*,\s*"terms"|\s*})', text, re.DOTALL)
-                    if analysis_match:
-                        analysis_text = analysis_match.group(1)
-                        # Unescape the content
-                        analysis_text = analysis_text.replace('\\n', '\n').replace('\\"', '"')
-                        return {
-                            "analysis": analysis_text,
-                            "terms": [],
-                            "parsing_note": "Extracted via regex due to JSON issues"
-                        }
-                    # Last resort: return the raw text as analysis
-                    return {
-                        "analysis": text,
-                        "terms": [],
-                        "parsing_note": "Response was returned as raw text due to JSON formatting issues"
-                    }
-        
-        # If no JSON found, return raw text
-        return {"analysis": text, "terms": []}
+            context_text = "\n\n".join(relevant_context)
         
-    except Exception as e:
-        return {"error": str(e)}
+            # Generate analysis with Gemini
+            prompt = f"""
+            You are an expert health insurance denial appeal lawyer. Analyze the following insurance denial documents and provide a COMPREHENSIVE analysis to help the patient appeal.
 
+            IMPORTANT FORMATTING RULES:
+            1. Write in PLAIN TEXT only - NO markdown, NO asterisks, NO bullet points with * or -, NO bold formatting
+            2. Use simple paragraphs and numbered lists (1. 2. 3.) when needed
+            3. Be thorough and detailed - this analysis should be at least 3-4 paragraphs
 
-@app.function(
-    image=image,
-    secrets=[modal.Secret.from_name("custom-secret")],
-    timeout=300,
-)
-@modal.fastapi_endpoint(method="POST")
-async def extract_denial(request: dict):
-    """
-    Extract denial info from case files.
-    
-    POST body: { "caseId": "string" }
-    Returns: { "briefDescription": "string" }
-    """
-    import traceback
+            Context from denial documents:
+            ---
+            {context_text}
+            ---
+
+            Your analysis MUST include ALL of the following sections:
+
+            1. DENIAL SUMMARY: Briefly explain what was denied and why the insurance company claims they denied it.
+
+            2. WEAKNESSES TO EXPLOIT: Identify 2-3 specific weaknesses in the insurance company's denial reasoning that can be challenged. Look for:
+               - Vague or unsupported claims about "medical necessity"
+               - Failure to consider all medical evidence
+               - Misinterpretation of policy terms
+               - Procedural errors in their review process
+               - Contradictions with their own policy language
+
+            3. APPEAL STRATEGY: Provide specific steps and arguments the patient should use in their appeal, including:
+               - What evidence to gather (doctor's letters, medical records, etc.)
+               - Key arguments to make
+               - Policy provisions that support coverage
+
+            4. NEXT STEPS: List the immediate actions the patient should take.
+
+            Return a JSON object with:
+            - "analysis": The comprehensive analysis described above. Be as thorough as needed - no word limit. NO markdown formatting.
+            - "terms": A list of GENUINELY CONFUSING insurance/legal jargon terms that you use in your analysis and that need definitions.
+              CRITICAL RULES FOR TERMS:
+              * ONLY include terms that a regular person would genuinely NOT understand
+              * Each term MUST be an EXACT phrase that appears in YOUR ANALYSIS TEXT above
+              * Focus on technical insurance jargon like: "prudent layperson standard", "Evidence of Coverage", "emergency stabilization", "Level 1 Appeal", "cost-sharing", "coinsurance"
+              * DO NOT include common words people already understand like: "appeal", "denial", "coverage", "emergency", "in-network", "out-of-network"
+              * Quality over quantity - only include terms that truly need explanation
+              * Format: list of {{ "term": "exact phrase from your analysis", "definition": "simple explanation in plain English" }}
+            """
+        
+            if request.get("stream"):
+                return _ndjson_response(stream_events("analysis", prompt, _analysis_result))
+        
+            return _analysis_result(route_generation("analysis", prompt))
+        
+        except Exception as e:
+            return {"error": str(e)}
+
+    @modal.fastapi_endpoint(method="POST", label=f"{APP_NAME}-extract-denial")
+    @_blocking_endpoint("extract_denial")
+    def extract_denial(self, request: dict):
+        """
+        Extract denial info from case files.
     
-    try:
-        from pipeline import get_db_connection, get_supabase_client
-    except Exception as e:
-        return {"error": f"Failed to import pipeline: {str(e)}", "traceback": traceback.format_exc()}
+        POST body: { "caseId": "string" }
+        Returns: { "briefDescription": "string" }
+        """
+        import traceback
     
-    from langchain_community.document_loaders import PyPDFLoader
-    from langchain_text_splitters import RecursiveCharacterTextSplitter
-    from langchain_huggingface import HuggingFaceEmbeddings
-    from langchain_community.vectorstores import Chroma
-    import google.generativeai as genai
+        try:
+            from pipeline import get_db_connection, get_supabase_client, get_embedding_function, load_pdf_bytes, route_generation
+            from retrieval import assemble_context
+        except Exception as e:
+            return {"error": f"Failed to import pipeline: {str(e)}", "traceback": traceback.format_exc()}
     
-    genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+        from langchain_community.vectorstores import Chroma
     
-    case_id = request.get("caseId")
-    if not case_id:
-        return {"error": "caseId is required"}
+        case_id = request.get("caseId")
+        if not case_id:
+            return {"error": "caseId is required"}
     
-    try:
-        db = get_db_connection()
-        case = db.cases.find_one({"id": case_id})
+        try:
+            db = get_db_connection()
+            case = db.cases.find_one({"id": case_id}, {"_id": 0, "denialFiles": 1, "denialReasonTitle": 1})
         
-        if not case:
-            return {"error": f"Case not found: {case_id}"}
+            if not case:
+                return {"error": f"Case not found: {case_id}"}
         
-        if not case.get("denialFiles"):
-            return {"error": "No denial files found"}
+            if not case.get("denialFiles"):
+                return {"error": "No denial files found"}
         
-        # Check cache
-        if case.get("denialReasonTitle"):
-            return {"briefDescription": case["denialReasonTitle"]}
+            # Check cache
+            if case.get("denialReasonTitle"):
+                return {"briefDescription": case["denialReasonTitle"]}
         
-        # Process files and extract text
-        sb = get_supabase_client()
-        docs = []
+            # Process files and extract text
+            sb = get_supabase_client()
+            docs = []
         
-        for file_data in case["denialFiles"]:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
+            for file_data in case["denialFiles"]:
                 if file_data.get("path") and sb:
                     bucket = file_data.get("bucket", "denials")
                     data = sb.storage.from_(bucket).download(file_data["path"])
-                    tmp.write(data)
                 elif file_data.get("data"):
-                    tmp.write(bytes(file_data["data"]))
+                    data = file_data["data"]
                 else:
                     continue
-                tmp.flush()
-                
-                try:
-                    loader = PyPDFLoader(tmp.name)
-                    docs.extend(loader.load())
-                finally:
-                    os.unlink(tmp.name)
-        
-        if not docs:
-            return {"error": "No documents loaded"}
-        
-        # Create embeddings and query
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
-        chunks = text_splitter.split_documents(docs)
-        
-        embedding_function = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-        vector_db = Chroma.from_documents(documents=chunks, embedding=embedding_function)
-        
-        results = vector_db.similarity_search("denial reason", k=10)
-        context_text = "\n\n".join([doc.page_content for doc in results])
-        
-        # Generate brief description
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        prompt = f"""
-        Create a brief 1-sentence description (under 15 words) of why this claim was denied.
-        
-        Context:
-        ---
-        {context_text}
-        ---
-        
-        Return JSON: {{"briefDescription": "string"}}
-        """
+                docs.extend(load_pdf_bytes(data, source=file_data.get("name", "denial.pdf")))
         
-        response = model.generate_content(prompt)
-        text = response.text.strip().replace('```json', '').replace('```', '')
-        result = json.loads(text)
+            if not docs:
+                return {"error": "No documents loaded"}
         
-        # Cache the result
-        db.cases.update_one(
-            {"id": case_id},
-            {"$set": {"denialReasonTitle": result.get("briefDescription")}}
-        )
+            # Create embeddings and query
+            text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
+            chunks = text_splitter.split_documents(docs)
         
-        return result
+            embedding_function = get_embedding_function()
+            # Per-request collection: concurrent inputs share the in-process Chroma client
+            vector_db = Chroma.from_documents(
+                documents=chunks, embedding=embedding_function, collection_name=f"scratch-{uuid.uuid4().hex}"
+            )
         
-    except Exception as e:
-        return {"error": str(e), "traceback": traceback.format_exc()}
-
+            try:
+                results = vector_db.similarity_search("denial reason", k=10)
+            finally:
+                vector_db.delete_collection()
+            context_spans, _ = assemble_context(results)
+            context_text = "\n\n".join(context_spans)
+        
+            # Generate brief description
+            prompt = f"""
+            Create a brief 1-sentence description (under 15 words) of why this claim was denied.
+        
+            Context:
+            ---
+            {context_text}
+            ---
+        
+            Return JSON: {{"briefDescription": "string"}}
+            """
+        
+            routed = route_generation("denial_extract", prompt)
+            result = routed["data"]
+            if result is None:
+                return {"error": f"Failed to parse denial description: {routed['problem']}"}
+        
+            # Cache the result
+            db.cases.update_one(
+                {"id": case_id},
+                {"$set": {"denialReasonTitle": result.get("briefDescription")}}
+            )
+        
+            return result
+        
+        except Exception as e:
+            return {"error": str(e), "traceback": traceback.format_exc()}
 
-@app.function(
-    image=image,
-    secrets=[modal.Secret.from_name("custom-secret")],
-    timeout=300,
-)
-@modal.fastapi_endpoint(method="POST")
-async def generate_email(request: dict):
-    """
-    Generate appeal email draft.
+    @modal.fastapi_endpoint(method="POST", label=f"{APP_NAME}-generate-email")
+    @_blocking_endpoint("generate_email")
+    def generate_email(self, request: dict):
+        """
+        Generate appeal email draft.
     
-    POST body: { "caseId": "string", "userId": "string" }
-    Returns: { "emailDraft": { "subject": "string", "body": "string" } }
-    """
-    from pipeline import get_vector_store, get_db_connection
-    import google.generativeai as genai
+        POST body: { "caseId": "string", "userId": "string", "stream": false }
+        Returns: { "emailDraft": { "subject": "string", "body": "string" } }
+        With "stream": true, returns the same JSON-lines events as analyze_case.
+        """
+        from pipeline import get_vector_store, get_db_connection, retrieve_case_context, route_generation, stream_events
     
-    genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
+        case_id = request.get("caseId")
+        user_id = request.get("userId")
     
-    case_id = request.get("caseId")
-    user_id = request.get("userId")
+        if not case_id or not user_id:
+            return {"error": "caseId and userId are required"}
     
-    if not case_id or not user_id:
-        return {"error": "caseId and userId are required"}
+        try:
+            # Check cache
+            mongo_db = get_db_connection()
+            case = mongo_db.cases.find_one({"id": case_id}, {"_id": 0, "emailDraft": 1})
+            if case and case.get("emailDraft", {}).get("body"):
+                if request.get("stream"):
+                    return _ndjson_response([{"type": "result", "data": {"emailDraft": case["emailDraft"]}}])
+                return {"emailDraft": case["emailDraft"]}
+        
+            # Get vector store
+            db = get_vector_store(case_id, user_id, force_refresh=False)
+            if not db:
+                return {"error": "Failed to load vector store"}
+        
+            relevant_context = retrieve_case_context(db)
+            if not relevant_context:
+                return {"error": "No relevant context found"}
+        
+            context_text = "\n\n".join(relevant_context)
+        
+            # Generate email with Gemini
+            prompt = f"""
+            Draft body paragraphs for a professional insurance appeal email.
+            You are a Health Insurance Denial Lawyer writing on behalf of a client.
+        
+            IMPORTANT: Write complete, ready-to-send content. Do NOT use any placeholder brackets like [Client Name], [Date], [Policy Number], etc.
+            Write the email in first person as if you are the patient/policyholder appealing their denial.
+            Use generic but professional phrasing where specific details would normally go.
+        
+            Context from the case documents:
+            ---
+            {context_text}
+            ---
+        
+            Return JSON: {{"body": "string"}}
+            """
+        
+            if request.get("stream"):
+                return _ndjson_response(stream_events("email_draft", prompt, _email_result))
+        
+            return _email_result(route_generation("email_draft", prompt))
+        
+        except Exception as e:
+            return {"error": str(e)}
+
+    @modal.fastapi_endpoint(method="POST", label=f"{APP_NAME}-generate-followup")
+    @_blocking_endpoint("generate_followup")
+    def generate_followup(self, request: dict):
+        """
+        Generate follow-up email based on email thread.
     
-    try:
-        # Check cache
-        mongo_db = get_db_connection()
-        case = mongo_db.cases.find_one({"id": case_id})
-        if case and case.get("emailDraft", {}).get("body"):
-            return {"emailDraft": case["emailDraft"]}
-        
-        # Get vector store
-        db = get_vector_store(case_id, user_id, force_refresh=False)
-        if not db:
-            return {"error": "Failed to load vector store"}
-        
-        query = "denial reason policy coverage exclusions"
-        results = db.similarity_search_with_relevance_scores(query, k=10)
-        
-        relevant_context = [doc.page_content for doc, score in results if score >= 0.0]
-        if not relevant_context:
-            return {"error": "No relevant context found"}
-        
-        context_text = "\n\n".join(relevant_context)
-        
-        # Generate email with Gemini
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        prompt = f"""
-        Draft body paragraphs for a professional insurance appeal email.
-        You are a Health Insurance Denial Lawyer writing on behalf of a client.
-        
-        IMPORTANT: Write complete, ready-to-send content. Do NOT use any placeholder brackets like [Client Name], [Date], [Policy Number], etc.
-        Write the email in first person as if you are the patient/policyholder appealing their denial.
-        Use generic but professional phrasing where specific details would normally go.
-        
-        Context from the case documents:
-        ---
-        {context_text}
-        ---
-        
-        Return JSON: {{"body": "string"}}
+        POST body: { "caseId": "string", "emailThread": [...] }
+        Returns: { "emailDraft": { "subject": "string", "body": "string" } }
         """
+        from pipeline import get_collection, route_generation, email_thread_context
+    
+        case_id = request.get("caseId")
+        email_thread = request.get("emailThread", [])
+    
+        if not case_id:
+            return {"error": "caseId is required"}
+    
+        try:
+            # Older messages come from the rolling summary stored on the case
+            cases = get_collection("cases")
+            stored = (cases.find_one({"id": case_id}, {"_id": 0, "emailThreadSummary": 1}) if cases is not None else None) or {}
+            thread_summary = email_thread_context(case_id, email_thread, stored.get("emailThreadSummary"))
         
-        response = model.generate_content(prompt)
-        text = response.text.strip()
-        start_idx = text.find('{')
-        end_idx = text.rfind('}')
+            prompt = f"""
+            Write a professional follow-up email responding to the latest message.
         
-        if start_idx != -1 and end_idx != -1:
-            email_json = json.loads(text[start_idx:end_idx+1])
-        else:
-            email_json = {"body": text}
+            Email Thread:
+            {thread_summary}
         
-        return {"emailDraft": email_json}
+            Return JSON: {{"subject": "string", "body": "string"}}
+            """
         
-    except Exception as e:
-        return {"error": str(e)}
-
+            routed = route_generation("generate_followup", prompt)
+            if routed["data"] is not None:
+                return {"emailDraft": routed["data"]}
+        
+            return {"emailDraft": {"subject": "Re: Appeal Follow-up", "body": routed["text"].strip()}}
+        
+        except Exception as e:
+            return {"error": str(e)}
 
-@app.function(
-    image=image,
-    secrets=[modal.Secret.from_name("custom-secret")],
-    timeout=300,
-)
-@modal.fastapi_endpoint(method="POST")
-async def generate_followup(request: dict):
-    """
-    Generate follow-up email based on email thread.
-    
-    POST body: { "caseId": "string", "emailThread": [...] }
-    Returns: { "emailDraft": { "subject": "string", "body": "string" } }
-    """
-    import google.generativeai as genai
-    
-    genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
+    @modal.fastapi_endpoint(method="POST", label=f"{APP_NAME}-extract-plan")
+    @_blocking_endpoint("extract_plan")
+    def extract_plan(self, request: dict):
+        """
+        Extract insurance plan details from policy document files.
     
-    case_id = request.get("caseId")
-    email_thread = request.get("emailThread", [])
+        POST body: { "files": [{ "name": "file.pdf", "data": "base64-encoded-data" }] }
+        Returns: { "insuranceCompany": "string", "planName": "string", "policyNumber": "string" }
+        """
+        from pipeline import get_embedding_function, load_pdf_bytes, route_generation
+        from retrieval import assemble_context
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+        from langchain_community.vectorstores import Chroma
+        import base64
     
-    if not case_id:
-        return {"error": "caseId is required"}
+        files = request.get("files", [])
+        if not files:
+            return {"error": "No files provided"}
     
-    try:
-        thread_summary = "\n\n---\n\n".join([
-            f"[{e.get('type', 'unknown').upper()}] {e.get('date', '')}\n{e.get('body', '')}"
-            for e in email_thread
-        ])
+        try:
+            docs = []
         
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        prompt = f"""
-        Write a professional follow-up email responding to the latest message.
+            # Process each base64-encoded file
+            for file_info in files:
+                file_name = file_info.get("name", "document.pdf")
+                file_data_b64 = file_info.get("data", "")
+            
+                if not file_data_b64:
+                    continue
+                
+                # Decode base64 to bytes and parse in memory
+                file_bytes = base64.b64decode(file_data_b64)
+                docs.extend(load_pdf_bytes(file_bytes, source=file_name))
         
-        Email Thread:
-        {thread_summary}
+            if not docs:
+                return {"error": "No documents could be loaded"}
         
-        Return JSON: {{"subject": "string", "body": "string"}}
-        """
+            # Create embeddings and query
+            text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
+            chunks = text_splitter.split_documents(docs)
         
-        response = model.generate_content(prompt)
-        text = response.text.strip()
-        start_idx = text.find('{')
-        end_idx = text.rfind('}')
+            embedding_function = get_embedding_function()
+            # Per-request collection: concurrent inputs share the in-process Chroma client
+            vector_db = Chroma.from_documents(
+                documents=chunks, embedding=embedding_function, collection_name=f"scratch-{uuid.uuid4().hex}"
+            )
         
-        if start_idx != -1 and end_idx != -1:
-            return {"emailDraft": json.loads(text[start_idx:end_idx+1])}
+            # Query for plan details
+            try:
+                results = vector_db.similarity_search("insurance company name plan name policy number", k=10)
+            finally:
+                vector_db.delete_collection()
+            context_spans, _ = assemble_context(results)
+            context_text = "\n\n".join(context_spans)
+        
+            # Generate extraction with Gemini
+            prompt = f"""
+            Extract the following insurance plan details from the context:
+            1. Insurance Company Name
+            2. Plan Name
+            3. Policy Number (Member ID, Subscriber ID, or Policy ID)
+
+            Context:
+            ---
+            {context_text}
+            ---
+
+            Return ONLY a JSON object with keys: 'insuranceCompany', 'planName', 'policyNumber'.
+            If a field is not found, use "Unknown".
+            """
         
-        return {"emailDraft": {"subject": "Re: Appeal Follow-up", "body": text}}
+            routed = route_generation("extraction", prompt)
+            if routed["data"] is None:
+                return {"error": f"Failed to parse plan details: {routed['problem']}"}
         
-    except Exception as e:
-        return {"error": str(e)}
+            return routed["data"]
+        
+        except Exception as e:
+            return {"error": str(e)}
+
+    @modal.fastapi_endpoint(method="GET", label=f"{APP_NAME}-health")
+    async def health(self):
+        """Health check endpoint, with this container's start-up, cold/warm request latencies, Gemini client and model routing stats"""
+        from pipeline import get_gemini_stats, get_routing_stats
+        return {
+            "status": "ok",
+            "service": "policypilot-rag",
+            "container": _container_stats,
+            "latency": _latency_snapshot(),
+            "gemini": get_gemini_stats(),
+            "routing": get_routing_stats(),
+        }
 
 
 @app.function(
     image=image,
     secrets=[modal.Secret.from_name("custom-secret")],
-    timeout=300,
+    timeout=3600,  # a batch runs far longer than a single request
+    volumes={SNAPSHOT_MOUNT: snapshot_volume},
 )
-@modal.fastapi_endpoint(method="POST")
-async def extract_plan(request: dict):
+@modal.fastapi_endpoint(method="POST", label=f"{APP_NAME}-analyze-cases")
+def analyze_cases(request: dict):
     """
-    Extract insurance plan details from policy document files.
-    
-    POST body: { "files": [{ "name": "file.pdf", "data": "base64-encoded-data" }] }
-    Returns: { "insuranceCompany": "string", "planName": "string", "policyNumber": "string" }
+    Re-run analysis for many cases, sharing one embedding model and DB
+    connection across them (see pipeline.analyze_cases). Analyses are written
+    to the cases with one bulk_write.
+
+    POST body: { "caseIds": ["string", ...], "userId": "string" }
+    Only the user's own cases are analysed and written; others come back as not found.
+    Returns: { "success": bool, "analysed": n, "failed": n, "written": n, "changed": n, "results": { caseId: {...} } }
     """
-    from langchain_community.document_loaders import PyPDFLoader
-    from langchain_text_splitters import RecursiveCharacterTextSplitter
-    from langchain_huggingface import HuggingFaceEmbeddings
-    from langchain_community.vectorstores import Chroma
-    import google.generativeai as genai
-    import base64
-    
-    genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
-    
-    files = request.get("files", [])
-    if not files:
-        return {"error": "No files provided"}
-    
+    from pipeline import analyze_cases as run_batch
+
+    case_ids = request.get("caseIds") or []
+    user_id = request.get("userId")
+    if not isinstance(case_ids, list) or not case_ids or not user_id:
+        return {"error": "caseIds (a non-empty list) and userId are required"}
+
     try:
-        docs = []
-        
-        # Process each base64-encoded file
-        for file_info in files:
-            file_name = file_info.get("name", "document.pdf")
-            file_data_b64 = file_info.get("data", "")
-            
-            if not file_data_b64:
-                continue
-                
-            # Decode base64 to bytes
-            file_bytes = base64.b64decode(file_data_b64)
-            
-            # Write to temp file and load
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-                tmp.write(file_bytes)
-                tmp.flush()
-                
-                try:
-                    loader = PyPDFLoader(tmp.name)
-                    docs.extend(loader.load())
-                finally:
-                    os.unlink(tmp.name)
-        
-        if not docs:
-            return {"error": "No documents could be loaded"}
-        
-        # Create embeddings and query
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
-        chunks = text_splitter.split_documents(docs)
-        
-        embedding_function = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-        vector_db = Chroma.from_documents(documents=chunks, embedding=embedding_function)
-        
-        # Query for plan details
-        results = vector_db.similarity_search("insurance company name plan name policy number", k=10)
-        context_text = "\n\n".join([doc.page_content for doc in results])
-        
-        # Generate extraction with Gemini
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        prompt = f"""
-        Extract the following insurance plan details from the context:
-        1. Insurance Company Name
-        2. Plan Name
-        3. Policy Number (Member ID, Subscriber ID, or Policy ID)
-
-        Context:
-        ---
-        {context_text}
-        ---
-
-        Return ONLY a JSON object with keys: 'insuranceCompany', 'planName', 'policyNumber'.
-        If a field is not found, use "Unknown".
-        """
-        
-        response = model.generate_content(prompt)
-        text = response.text.strip().replace('```json', '').replace('```', '')
-        
-        return json.loads(text)
-        
+        _attach_volume_hooks()
+        return run_batch(case_ids, user_id=user_id)
     except Exception as e:
         return {"error": str(e)}
-
-
-@app.function(image=image)
-@modal.fastapi_endpoint(method="GET")
-async def health():
-    """Health check endpoint"""
-    return {"status": "ok", "service": "policypilot-rag"}
-
@@ -0,0 +1,227 @@
+"""
+Model tiering for the PolicyPilot RAG pipeline.
+
+Each generation task has a routing policy: an ordered list of models, fast
+first, and the response schema its JSON output must follow (see
+structured_output). The first tier answers in JSON mode; its output is
+parsed and checked against the schema, then by the task's validator, which
+rejects outputs that look low-confidence (empty fields, every plan field
+"Unknown", placeholder brackets left in a draft, defined terms that don't
+appear in the analysis, ...); output that doesn't parse or that the
+validator raises on is rejected as well. Only a rejected output is escalated
+to the next tier. The last tier's output is returned even if it is rejected
+too, with the reason, so callers keep their existing fallbacks.
+
+Per task and tier, calls, acceptances, escalations and latency are counted
+and reported by routing_stats().
+
+Configuration (environment):
+    MODEL_FAST            fast tier model (default gemini-2.5-flash)
+    MODEL_PRO             escalation tier model (default gemini-2.5-pro)
+    MODEL_TIERS_<TASK>    comma-separated models overriding a task's tiers,
+                          e.g. MODEL_TIERS_EMAIL_DRAFT=gemini-2.5-pro
+"""
+
+import os
+import re
+import sys
+import time
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from structured_output import (
+    ANALYSIS_SCHEMA,
+    DENIAL_BRIEF_SCHEMA,
+    EMAIL_ANALYSIS_SCHEMA,
+    EMAIL_DRAFT_SCHEMA,
+    FOLLOWUP_SCHEMA,
+    PLAN_FIELDS_SCHEMA,
+    parse_structured,
+)
+
+MODEL_FAST = os.getenv("MODEL_FAST", "gemini-2.5-flash")
+MODEL_PRO = os.getenv("MODEL_PRO", "gemini-2.5-pro")
+
+# "[Client Name]", "[Date of Denial Letter]": template slots the model left unfilled
+_PLACEHOLDER = re.compile(r"\[[A-Z][A-Za-z /#.-]{2,40}\]")
+
+
+# Validators run on schema-checked output, so types and required keys are given
+
+def _empty_strings(data: Dict[str, Any], keys: List[str]) -> Optional[str]:
+    for key in keys:
+        if not data[key].strip():
+            return f"empty '{key}'"
+    return None
+
+
+def _check_terms(terms: List[Dict[str, str]], text: str) -> Optional[str]:
+    # Terms must be exact substrings of the text they annotate
+    unmatched = sum(1 for t in terms if t["term"] not in text)
+    if terms and unmatched * 2 > len(terms):
+        return f"{unmatched}/{len(terms)} terms not found in the text"
+    return None
+
+
+def _check_draft(body: str) -> Optional[str]:
+    if len(body) < 200:
+        return "email body too short"
+    if _PLACEHOLDER.search(body):
+        return "placeholder left in email body"
+    return None
+
+
+def validate_plan_fields(data: Dict[str, Any]) -> Optional[str]:
+    problem = _empty_strings(data, ["insuranceCompany", "planName", "policyNumber"])
+    if problem:
+        return problem
+    unknown = sum(1 for key in ("insuranceCompany", "planName", "policyNumber") if data[key].strip().lower() == "unknown")
+    return f"{unknown}/3 plan fields unknown" if unknown >= 2 else None
+
+
+def validate_denial_brief(data: Dict[str, Any]) -> Optional[str]:
+    problem = _empty_strings(data, ["briefDescription"])
+    if problem:
+        return problem
+    return "briefDescription too long" if len(data["briefDescription"].split()) > 25 else None
+
+
+def validate_analysis(data: Dict[str, Any]) -> Optional[str]:
+    if len(data["analysis"]) < 300:
+        return "analysis too short"
+    return _check_terms(data["terms"], data["analysis"])
+
+
+def validate_email_draft(data: Dict[str, Any]) -> Optional[str]:
+    return _check_draft(data["body"])
+
+
+def validate_followup(data: Dict[str, Any]) -> Optional[str]:
+    return _empty_strings(data, ["subject"]) or _check_draft(data["body"])
+
+
+def validate_email_analysis(data: Dict[str, Any]) -> Optional[str]:
+    problem = _empty_strings(data, ["summary"])
+    if problem:
+        return problem
+    if not data["actionItems"]:
+        return "no action items"
+    return None
+
+
+# Task -> default tiers, response schema, validator
+TASK_POLICIES: Dict[str, Dict[str, Any]] = {
+    "extraction": {"tiers": [MODEL_FAST, MODEL_PRO], "schema": PLAN_FIELDS_SCHEMA, "validate": validate_plan_fields},
+    "denial_extract": {"tiers": [MODEL_FAST, MODEL_PRO], "schema": DENIAL_BRIEF_SCHEMA, "validate": validate_denial_brief},
+    "analysis": {"tiers": [MODEL_FAST, MODEL_PRO], "schema": ANALYSIS_SCHEMA, "validate": validate_analysis},
+    "email_draft": {"tiers": [MODEL_FAST, MODEL_PRO], "schema": EMAIL_DRAFT_SCHEMA, "validate": validate_email_draft},
+    "generate_followup": {"tiers": [MODEL_FAST, MODEL_PRO], "schema": FOLLOWUP_SCHEMA, "validate": validate_followup},
+    "email_analysis": {"tiers": [MODEL_FAST, MODEL_PRO], "schema": EMAIL_ANALYSIS_SCHEMA, "validate": validate_email_analysis},
+}
+
+
+def task_tiers(task: str) -> List[str]:
+    override = os.getenv(f"MODEL_TIERS_{task.upper()}", "")
+    tiers = [m.strip() for m in override.split(",") if m.strip()]
+    return tiers or list(TASK_POLICIES[task]["tiers"])
+
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, Dict[str, Any]] = {}
+
+
+def _record(task: str, model: str, seconds: float, accepted: bool, escalated: bool):
+    with _stats_lock:
+        task_stats = _stats.setdefault(task, {"requests": 0, "escalations": 0, "tiers": {}})
+        tier = task_stats["tiers"].setdefault(
+            model, {"calls": 0, "accepted": 0, "escalated": 0, "totalSeconds": 0.0, "maxSeconds": 0.0}
+        )
+        tier["calls"] += 1
+        tier["accepted"] += int(accepted)
+        tier["escalated"] += int(escalated)
+        tier["totalSeconds"] += seconds
+        tier["maxSeconds"] = max(tier["maxSeconds"], seconds)
+
+
+def routing_stats() -> Dict[str, Any]:
+    """Per task: requests, how many escalated past the first tier, and per tier calls/acceptances/latency."""
+    with _stats_lock:
+        report = {}
+        for task, task_stats in _stats.items():
+            requests = task_stats["requests"]
+            report[task] = {
+                "requests": requests,
+                "escalations": task_stats["escalations"],
+                "escalationRate": round(task_stats["escalations"] / requests, 4) if requests else 0.0,
+                "tiers": {
+                    model: {
+                        "calls": tier["calls"],
+                        "accepted": tier["accepted"],
+                        "escalated": tier["escalated"],
+                        "avgSeconds": round(tier["totalSeconds"] / tier["calls"], 3) if tier["calls"] else 0.0,
+                        "maxSeconds": round(tier["maxSeconds"], 3),
+                    }
+                    for model, tier in task_stats["tiers"].items()
+                },
+            }
+        return report
+
+
+def route(
+    task: str,
+    prompt: str,
+    generate: Callable[..., str],
+    discard: Callable[..., None] = None,
+    on_delta: Callable[[str], None] = None,
+) -> Dict[str, Any]:
+    """
+    Run `prompt` through the task's tiers until an output validates.
+    `generate(model_name, prompt, on_delta=..., response_schema=...)` does
+    one JSON-mode generation; only the first tier gets `on_delta`, so
+    streamed deltas are provisional if the request escalates. Outputs that
+    don't parse or match the schema are passed to
+    `discard(model_name, prompt, response_schema=...)` so they aren't served
+    from a cache again; so are outputs the validator raises on.
+
+    Returns {"data": parsed object or None, "text": raw text, "model": name,
+    "escalated": bool, "problem": rejection reason or None}, for the tier
+    whose output was accepted, or else the last tier.
+    """
+    policy = TASK_POLICIES[task]
+    schema, validate = policy["schema"], policy["validate"]
+    tiers = task_tiers(task)
+    with _stats_lock:
+        _stats.setdefault(task, {"requests": 0, "escalations": 0, "tiers": {}})["requests"] += 1
+
+    result: Dict[str, Any] = {}
+    for i, model in enumerate(tiers):
+        last = i == len(tiers) - 1
+        start = time.perf_counter()
+        text = generate(model, prompt, on_delta=on_delta if i == 0 else None, response_schema=schema)
+        data = None
+        try:
+            data = parse_structured(text, schema)
+        except ValueError as e:
+            problem = f"invalid output: {e}"
+        else:
+            try:
+                problem = validate(data)
+            except Exception as e:
+                # Output the schema let through but the validator can't handle is malformed too
+                data = None
+                problem = f"invalid output: validator failed with {type(e).__name__}: {e}"
+        if data is None and discard is not None:
+            discard(model, prompt, response_schema=schema)
+        seconds = time.perf_counter() - start
+        _record(task, model, seconds, accepted=problem is None, escalated=problem is not None and not last)
+        result = {"data": data, "text": text, "model": model, "escalated": i > 0, "problem": problem}
+        if problem is None:
+            break
+        if not last:
+            if i == 0:
+                with _stats_lock:
+                    _stats[task]["escalations"] += 1
+            print(f"Routing {task}: {model} rejected after {seconds:.2f}s ({problem}); escalating to {tiers[i + 1]}", file=sys.stderr)
+        else:
+            print(f"Routing {task}: {model} output still rejected ({problem})", file=sys.stderr)
+    return result
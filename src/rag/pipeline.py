@@ -1,20 +1,31 @@
+import time
+
+_IMPORT_START = time.perf_counter()
+
 import os
+import re
 import sys
 import json
+import hashlib
 import argparse
+import shutil
 import tempfile
-from typing import List, Dict, Any
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Callable, Iterator, TYPE_CHECKING
 from urllib.parse import urlparse
 from pathlib import Path
-from pymongo import MongoClient
-from supabase import create_client, Client
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.vectorstores import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
-import google.generativeai as genai
 from dotenv import load_dotenv
 
+# Heavy dependencies (pymongo, supabase, langchain, Chroma, torch, Gemini) are
+# imported inside the functions that use them, so modes that don't need ML
+# (e.g. email_analysis) start without paying for them. See --profile-startup.
+if TYPE_CHECKING:
+    from pymongo import MongoClient
+    from supabase import Client
+    from langchain_core.documents import Document
+
 # Load environment variables - try multiple locations
 # First try project root (where .env file should be)
 project_root = Path(__file__).parent.parent.parent
@@ -40,21 +51,258 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017/policypilot")
 SUPABASE_URL = os.getenv("VITE_SUPABASE_URL")
 SUPABASE_KEY = os.getenv("VITE_SUPABASE_ANON_KEY")
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "20"))
 
-genai.configure(api_key=GEMINI_API_KEY)
-
-def get_db_connection():
-    # Debug: print MongoDB URI (without sensitive info)
-    uri_for_logging = MONGODB_URI
-    if '@' in uri_for_logging:
-        # Mask password in URI for logging
-        parts = uri_for_logging.split('@')
-        if len(parts) == 2:
-            uri_for_logging = 'mongodb://***@' + parts[1]
-    print(f"Connecting to MongoDB: {uri_for_logging}", file=sys.stderr)
-    
-    client = MongoClient(MONGODB_URI)
-    
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+# Max files downloaded/parsed at once when loading a case or plan
+DOCUMENT_FETCH_CONCURRENCY = int(os.getenv("DOCUMENT_FETCH_CONCURRENCY", "4"))
+# One persistent Chroma store holding a collection per case and per plan
+VECTOR_STORE_ROOT = os.getenv("VECTOR_STORE_ROOT", "chroma_store")
+# Where the old one-directory-per-case stores (chroma_db_*) live, for migration
+LEGACY_VECTOR_STORE_DIR = os.getenv("LEGACY_VECTOR_STORE_DIR", ".")
+# Store garbage collection (see collect_store_garbage)
+VECTOR_STORE_TTL_DAYS = float(os.getenv("VECTOR_STORE_TTL_DAYS", "30"))
+VECTOR_STORE_MAX_BYTES = int(os.getenv("VECTOR_STORE_MAX_BYTES", str(2 * 1024 ** 3)))
+VECTOR_STORE_GC_INTERVAL = int(os.getenv("VECTOR_STORE_GC_INTERVAL", "3600"))
+# float32 all-MiniLM-L6-v2 vector, used to estimate a store's size from its chunks
+_VECTOR_BYTES = 384 * 4
+# batch_analysis: cases ingested at once and analyses generated at once (rate limits
+# are applied by the shared Gemini client, see gemini_client)
+BATCH_INGEST_CONCURRENCY = int(os.getenv("BATCH_INGEST_CONCURRENCY", "2"))
+BATCH_GEMINI_CONCURRENCY = int(os.getenv("BATCH_GEMINI_CONCURRENCY", "4"))
+
+# Process-wide clients. A one-shot CLI run creates each at most once; the
+# long-lived worker (--mode serve) reuses them across requests.
+_client_lock = threading.Lock()
+_mongo_client = None
+_supabase_client = None
+_embedding_function = None
+_chroma_client = None
+_snapshot_backend = None
+_snapshot_backend_opened = False
+
+# Resolved MongoDB database/collection names, cached after first discovery
+_db_lock = threading.Lock()
+_db_name = None
+_collection_names: Dict[str, str] = {}
+
+# Mongoose pluralises model names, but older data used other spellings
+MONGO_COLLECTION_CANDIDATES = {
+    "cases": ['cases', 'Cases', 'case'],
+    "insuranceplans": ['insuranceplans', 'InsurancePlans', 'insuranceplan', 'InsurancePlan'],
+}
+
+_genai_configured = False
+
+def get_genai():
+    """Import google.generativeai and configure it on first use."""
+    global _genai_configured
+    import google.generativeai as genai
+    with _client_lock:
+        if not _genai_configured:
+            genai.configure(api_key=GEMINI_API_KEY)
+            _genai_configured = True
+    return genai
+
+_gemini_client = None
+
+def get_gemini_client():
+    """Shared rate-limited, retrying Gemini client (see gemini_client for GEMINI_RPM and friends)."""
+    global _gemini_client
+    from gemini_client import open_gemini_client
+    with _client_lock:
+        if _gemini_client is None:
+            _gemini_client = open_gemini_client(get_genai)
+        return _gemini_client
+
+def get_gemini_stats() -> Dict[str, Any]:
+    """Queue wait, retry and failure counters for Gemini calls (empty before the first call)."""
+    return _gemini_client.stats() if _gemini_client is not None else {}
+
+_response_cache = None
+_response_cache_opened = False
+
+def get_response_cache():
+    """Shared Gemini response cache (see llm_cache for LLM_CACHE_BACKEND and friends)."""
+    global _response_cache, _response_cache_opened
+    from llm_cache import open_response_cache
+    with _client_lock:
+        if not _response_cache_opened:
+            _response_cache = open_response_cache()
+            _response_cache_opened = True
+        return _response_cache
+
+def _schema_options(response_schema: Dict[str, Any] = None) -> Dict[str, Any]:
+    """Cache key options: a JSON-mode response is a different output from a free-text one."""
+    return {"responseSchema": response_schema} if response_schema is not None else None
+
+def stream_text(model_name: str, prompt: str, use_cache: bool = True, response_schema: Dict[str, Any] = None) -> Iterator[str]:
+    """
+    Yield a Gemini generation as text deltas using the streaming API. A cached
+    response is yielded as a single delta; a completed stream is cached.
+    With `response_schema`, Gemini returns JSON matching it (see structured_output).
+    """
+    from llm_cache import response_cache_key
+    cache = get_response_cache() if use_cache else None
+    key = response_cache_key(model_name, prompt, _schema_options(response_schema))
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            stats = cache.stats()
+            print(f"LLM cache hit for {model_name} (hit ratio {stats['hitRatio']:.2f})", file=sys.stderr)
+            yield cached
+            return
+
+    start = time.perf_counter()
+    parts = []
+    for delta in get_gemini_client().stream(model_name, prompt, response_schema=response_schema):
+        if not parts:
+            print(f"First token from {model_name} after {time.perf_counter() - start:.2f}s", file=sys.stderr)
+        parts.append(delta)
+        yield delta
+
+    text = "".join(parts)
+    if cache is not None and text:
+        cache.set(key, text)
+
+def generate_text(
+    model_name: str,
+    prompt: str,
+    use_cache: bool = True,
+    on_delta: Callable[[str], None] = None,
+    response_schema: Dict[str, Any] = None,
+) -> str:
+    """
+    Run a single Gemini generation and return its text. Identical (model, prompt,
+    schema) requests are answered from the response cache; only non-empty text
+    is stored. With `on_delta`, the response is streamed and each delta is
+    passed to it as it arrives. With `response_schema`, Gemini returns JSON
+    matching it.
+    """
+    if on_delta is not None:
+        parts = []
+        for delta in stream_text(model_name, prompt, use_cache=use_cache, response_schema=response_schema):
+            on_delta(delta)
+            parts.append(delta)
+        return "".join(parts)
+
+    from llm_cache import response_cache_key
+    cache = get_response_cache() if use_cache else None
+    key = response_cache_key(model_name, prompt, _schema_options(response_schema))
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            stats = cache.stats()
+            print(f"LLM cache hit for {model_name} (hit ratio {stats['hitRatio']:.2f})", file=sys.stderr)
+            return cached
+
+    text = get_gemini_client().generate(model_name, prompt, response_schema=response_schema)
+    if cache is not None and text:
+        cache.set(key, text)
+    return text
+
+def route_generation(task: str, prompt: str, on_delta: Callable[[str], None] = None) -> Dict[str, Any]:
+    """
+    Tiered, JSON-mode generation for a task (see model_router): the fast
+    model answers first with output constrained to the task's schema, and
+    the request escalates to pro only if that output doesn't validate.
+    Returns the router's {"data", "text", "model", "escalated", "problem"}.
+    """
+    from model_router import route
+    return route(task, prompt, generate_text, discard=discard_cached_response, on_delta=on_delta)
+
+def get_routing_stats() -> Dict[str, Any]:
+    """Escalation rate and per-tier latency for each routed task."""
+    from model_router import routing_stats
+    return routing_stats()
+
+def stream_events(task: str, prompt: str, to_result: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """
+    JSON-lines event stream for one routed generation: {"type": "delta",
+    "text": ...} per chunk of the first tier, then {"type": "result", "data":
+    to_result(routed)} where routed is route_generation()'s output, or
+    {"type": "error", "error": ...} if generation fails. If the request
+    escalates, the deltas were provisional and the result carries the
+    escalated output.
+    """
+    import queue
+
+    events: "queue.Queue" = queue.Queue()
+
+    def worker():
+        try:
+            routed = route_generation(task, prompt, on_delta=lambda text: events.put({"type": "delta", "text": text}))
+            events.put({"type": "result", "data": to_result(routed)})
+        except Exception as e:
+            print(f"Streaming generation failed: {e}", file=sys.stderr)
+            events.put({"type": "error", "error": str(e)})
+        finally:
+            events.put(None)
+
+    threading.Thread(target=worker, name=f"stream-{task}", daemon=True).start()
+    while True:
+        event = events.get()
+        if event is None:
+            return
+        yield event
+
+def discard_cached_response(model_name: str, prompt: str, response_schema: Dict[str, Any] = None):
+    """Drop a cached generation whose output turned out to be unusable."""
+    from llm_cache import response_cache_key
+    cache = _response_cache
+    if cache is not None:
+        cache.delete(response_cache_key(model_name, prompt, _schema_options(response_schema)))
+
+def get_mongo_client() -> "MongoClient":
+    global _mongo_client
+    from pymongo import MongoClient
+    with _client_lock:
+        if _mongo_client is None:
+            _mongo_client = MongoClient(MONGODB_URI, maxPoolSize=MONGODB_MAX_POOL_SIZE)
+        return _mongo_client
+
+def get_embedding_function():
+    """
+    Shared embedding model: the batched EmbeddingEngine (see embedding_engine
+    for EMBEDDING_BACKEND / EMBEDDING_BATCH_SIZE / EMBEDDING_THREADS), wrapped in the on-disk
+    embedding cache unless EMBEDDING_CACHE_PATH is set to an empty string.
+    """
+    global _embedding_function
+    from embedding_cache import CachedEmbeddings, open_embedding_cache
+    from embedding_engine import build_embedding_engine
+    with _client_lock:
+        if _embedding_function is None:
+            embeddings = build_embedding_engine(EMBEDDING_MODEL_NAME)
+            cache = open_embedding_cache()
+            if cache is not None:
+                # Engine name is backend-qualified so backends never share vectors
+                embeddings = CachedEmbeddings(embeddings, cache, embeddings.name)
+            _embedding_function = embeddings
+        return _embedding_function
+
+def get_embedding_stats() -> Dict[str, Any]:
+    """Throughput and cache counters for the shared embedding function."""
+    stats = {}
+    embeddings = _embedding_function
+    if embeddings is None:
+        return stats
+    from embedding_cache import CachedEmbeddings
+    if isinstance(embeddings, CachedEmbeddings):
+        stats["cache"] = embeddings.cache.stats()
+        embeddings = embeddings.embeddings
+    if hasattr(embeddings, "stats"):
+        stats["engine"] = embeddings.stats()
+    return stats
+
+def get_llm_cache_stats() -> Dict[str, Any]:
+    """Hit/miss counters for the Gemini response cache (empty when disabled)."""
+    return _response_cache.stats() if _response_cache is not None else {}
+
+def _resolve_db_name(client: "MongoClient"):
+    """
+    Work out which database holds the app's collections.
+    Returns (db_name, cacheable).
+    """
     # Extract database name from URI or use default
     # Mongoose uses the database name from the connection string path
     # If no database in path, Mongoose defaults to the database name in the connection options
@@ -103,30 +351,259 @@ def get_db_connection():
                 print(f"No database found with expected collections, defaulting to 'test'", file=sys.stderr)
         except Exception as e:
             print(f"Error searching databases: {e}", file=sys.stderr)
-            db_name = 'test'  # MongoDB default
+            return 'test', False  # MongoDB default; don't cache, retry discovery next time
     
-    print(f"Using database name: {db_name}", file=sys.stderr)
-    db = client.get_database(db_name)
-    
-    # Test connection and list databases
+    return db_name, True
+
+def get_db_connection(refresh: bool = False):
+    """
+    Return the app database on the shared pooled client. The database name is
+    resolved (possibly via listDatabases) on first use and cached for the life
+    of the process; pass refresh=True to re-run discovery.
+    """
+    global _db_name
+    client = get_mongo_client()
+    with _db_lock:
+        if refresh or _db_name is None:
+            if refresh:
+                _collection_names.clear()
+            # Debug: print MongoDB URI (without sensitive info)
+            uri_for_logging = MONGODB_URI
+            if '@' in uri_for_logging:
+                # Mask password in URI for logging
+                parts = uri_for_logging.split('@')
+                if len(parts) == 2:
+                    uri_for_logging = 'mongodb://***@' + parts[1]
+            print(f"Connecting to MongoDB: {uri_for_logging}", file=sys.stderr)
+
+            db_name, cacheable = _resolve_db_name(client)
+            print(f"Using database name: {db_name}", file=sys.stderr)
+            if not cacheable:
+                return client.get_database(db_name)
+            _db_name = db_name
+        return client.get_database(_db_name)
+
+def get_collection(logical_name: str, refresh: bool = False):
+    """
+    Return the collection backing a Mongoose model ('cases', 'insuranceplans'),
+    trying the known spellings once and caching the match. Returns None if no
+    candidate collection exists.
+    """
+    db = get_db_connection(refresh=refresh)
+    with _db_lock:
+        if logical_name not in _collection_names:
+            existing = db.list_collection_names()
+            for candidate in MONGO_COLLECTION_CANDIDATES.get(logical_name, [logical_name]):
+                if candidate in existing:
+                    _collection_names[logical_name] = candidate
+                    print(f"Resolved '{logical_name}' collection: {candidate}", file=sys.stderr)
+                    break
+        name = _collection_names.get(logical_name)
+    return db[name] if name else None
+
+def get_supabase_client() -> "Client":
+    global _supabase_client
+    if not (SUPABASE_URL and SUPABASE_KEY):
+        return None
+    from supabase import create_client
+    with _client_lock:
+        if _supabase_client is None:
+            _supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
+        return _supabase_client
+
+def _file_metadata_projection(field: str) -> Dict[str, Any]:
+    """
+    Project a denialFiles/policyFiles array down to its metadata. Legacy
+    inline Buffers are replaced by a hasData flag and fetched lazily by
+    fetch_legacy_file_data only when a file actually needs parsing.
+    """
+    return {
+        "$map": {
+            "input": {"$ifNull": [f"${field}", []]},
+            "as": "f",
+            "in": {
+                "name": "$$f.name",
+                "size": "$$f.size",
+                "type": "$$f.type",
+                "bucket": "$$f.bucket",
+                "path": "$$f.path",
+                "hasData": {"$ne": [{"$type": "$$f.data"}, "missing"]},
+            },
+        }
+    }
+
+def _tag_file_refs(files: List[Dict[str, Any]], collection: str, owner_id: str, field: str):
+    # Remember where each file lives so its Buffer can be pulled on demand
+    for i, f in enumerate(files):
+        f["_ref"] = (collection, owner_id, field, i)
+    return files
+
+def load_case_and_plan(case_id: str):
+    """
+    Fetch the case and the insurance plan it belongs to in one round trip,
+    via a $lookup aggregation that returns only the fields retrieval needs.
+    Raises ValueError if either cannot be found.
+    """
+    doc = None
+    for refresh in (False, True):
+        cases = get_collection("cases", refresh=refresh)
+        plans = get_collection("insuranceplans")
+        if cases is None or plans is None:
+            continue
+        pipeline = [
+            {"$match": {"id": case_id}},
+            {"$limit": 1},
+            {"$lookup": {"from": plans.name, "localField": "planId", "foreignField": "id", "as": "plan"}},
+            {"$project": {
+                "_id": 0,
+                "id": 1,
+                "userId": 1,
+                "planId": 1,
+                "denialFiles": _file_metadata_projection("denialFiles"),
+                "plan": {"$arrayElemAt": [{"$map": {
+                    "input": "$plan",
+                    "as": "p",
+                    # "$p.policyFiles" becomes "$$p.policyFiles", the $map variable
+                    "in": {"id": "$$p.id", "policyFiles": _file_metadata_projection("$p.policyFiles")},
+                }}, 0]},
+            }},
+        ]
+        doc = next(cases.aggregate(pipeline), None)
+        if doc:
+            break
+
+    if not doc:
+        raise ValueError(f"Case {case_id} not found in database")
+
+    plan = doc.pop("plan", None)
+    case = doc
+    _tag_file_refs(case["denialFiles"], "cases", case_id, "denialFiles")
+    print(f"Found case {case_id} with {len(case['denialFiles'])} denial file(s)", file=sys.stderr)
+
+    if not plan:
+        raise ValueError(f"Plan {case.get('planId')} not found in database")
+    _tag_file_refs(plan["policyFiles"], "insuranceplans", plan["id"], "policyFiles")
+    print(f"Found plan {plan['id']} with {len(plan['policyFiles'])} policy file(s)", file=sys.stderr)
+
+    return case, plan
+
+def fetch_legacy_file_data(file_data: Dict[str, Any]):
+    """Pull a single legacy inline Buffer for a file returned by load_case_and_plan."""
+    collection, owner_id, field, index = file_data["_ref"]
+    coll = get_collection(collection)
+    if coll is None:
+        return None
+    doc = next(coll.aggregate([
+        {"$match": {"id": owner_id}},
+        {"$limit": 1},
+        {"$project": {"_id": 0, "data": {"$let": {
+            "vars": {"f": {"$arrayElemAt": [f"${field}", index]}},
+            "in": "$$f.data",
+        }}}},
+    ]), None)
+    return doc.get("data") if doc else None
+
+def download_file_bytes(file_data: Dict[str, Any], bucket_name: str, sb: "Client" = None):
+    """
+    Fetch a file's raw bytes from either Supabase storage or MongoDB Buffer.
+
+    Priority:
+    1. If file has 'path' and 'bucket' → download from Supabase storage
+    2. If file has 'data' (or 'hasData' from a projected fetch) → use MongoDB Buffer
+    3. Otherwise → skip file (returns None)
+    """
+    file_name = file_data.get('name', 'unknown.pdf')
+    print(f"Processing file: {file_name}", file=sys.stderr)
+
+    if "path" in file_data and file_data.get("path") and sb:
+        # File is stored in Supabase - download it
+        file_path = file_data["path"]
+        file_bucket = file_data.get("bucket", bucket_name)
+        print(f"  Downloading from Supabase: {file_bucket}/{file_path}", file=sys.stderr)
+        try:
+            data = sb.storage.from_(file_bucket).download(file_path)
+            print(f"  ✅ Downloaded {len(data)} bytes from Supabase", file=sys.stderr)
+            return data
+        except Exception as e:
+            print(f"  ❌ Error downloading from Supabase: {e}", file=sys.stderr)
+            return None
+    elif ("data" in file_data and file_data.get("data")) or (file_data.get("hasData") and "_ref" in file_data):
+        # File is stored as Buffer in MongoDB - use directly, pulling it now
+        # if the metadata-only fetch left it behind
+        file_data_bytes = file_data.get("data") or fetch_legacy_file_data(file_data)
+        if not file_data_bytes:
+            print(f"  ❌ MongoDB Buffer for {file_name} is empty", file=sys.stderr)
+            return None
+        print(f"  Using MongoDB Buffer data ({len(file_data_bytes)} bytes)", file=sys.stderr)
+        # Handle both bytes and Buffer types
+        if isinstance(file_data_bytes, bytes):
+            return file_data_bytes
+        # Convert to bytes if needed
+        return bytes(file_data_bytes)
+
+    print(f"  ❌ Skipping file {file_name} - no data source (path: {file_data.get('path')}, data: {bool(file_data.get('data'))})", file=sys.stderr)
+    return None
+
+def load_pdf_bytes(data, source: str = "memory.pdf") -> List["Document"]:
+    """
+    Parse PDF bytes (Supabase download, Mongo Buffer, base64-decoded payload)
+    into one LangChain Document per page, entirely in memory. Uses the same
+    parser as PyPDFLoader, so page metadata is identical; `source` stands in
+    for the file path.
+    """
+    from langchain_core.documents.base import Blob
+    from langchain_community.document_loaders.parsers import PyPDFParser
+
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    blob = Blob.from_data(data, mime_type="application/pdf", path=source)
+    return list(PyPDFParser().lazy_parse(blob))
+
+def fetch_file(file_data: Dict[str, Any], bucket_name: str, sb: "Client" = None, skip_hashes=frozenset()):
+    """
+    Download one file and parse it into page Documents.
+    Returns (data, content_hash, docs); docs is None if the file could not be
+    parsed or its hash is in skip_hashes (already indexed, no need to parse).
+    """
+    data = download_file_bytes(file_data, bucket_name, sb)
+    if not data:
+        return None, None, None
+    content_hash = hashlib.sha256(data).hexdigest()
+    if content_hash in skip_hashes:
+        return data, content_hash, None
     try:
-        admin_db = client.admin
-        db_list = admin_db.command('listDatabases')
-        print(f"All available databases: {[d['name'] for d in db_list['databases']]}", file=sys.stderr)
+        return data, content_hash, load_pdf_bytes(data, source=file_data.get('name', 'unknown.pdf'))
     except Exception as e:
-        print(f"Could not list databases: {e}", file=sys.stderr)
-    
-    return db
+        print(f"Error loading {bucket_name} PDF {file_data.get('name')}: {e}", file=sys.stderr)
+        return data, content_hash, None
 
-def get_supabase_client() -> Client:
-    if SUPABASE_URL and SUPABASE_KEY:
-        return create_client(SUPABASE_URL, SUPABASE_KEY)
-    return None
+def iter_fetched_files(files: List[Dict[str, Any]], bucket_name: str, sb: "Client" = None, skip_hashes=frozenset(), concurrency: int = None):
+    """
+    Download and parse files concurrently on a bounded thread pool, yielding
+    (file_data, data, content_hash, docs) in the original file order as soon
+    as each result (and all earlier ones) is ready.
+    """
+    files = list(files or [])
+    if not files:
+        return
+    workers = max(1, min(concurrency or DOCUMENT_FETCH_CONCURRENCY, len(files)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fetch") as executor:
+        results = executor.map(lambda f: fetch_file(f, bucket_name, sb, skip_hashes), files)
+        for file_data, (data, content_hash, docs) in zip(files, results):
+            yield file_data, data, content_hash, docs
+
+def load_file_documents(files: List[Dict[str, Any]], bucket_name: str, sb: "Client" = None) -> List["Document"]:
+    """Download and parse every file in a denialFiles/policyFiles array."""
+    docs = []
+    for _, _, _, file_docs in iter_fetched_files(files, bucket_name, sb):
+        if file_docs:
+            docs.extend(file_docs)
+    return docs
 
-def load_documents(case_id: str, user_id: str) -> List[str]:
+def load_documents(case_id: str, user_id: str) -> List["Document"]:
     """
     Load documents for RAG pipeline analysis.
-    
+
     DATA ARCHITECTURE:
     ==================
     MongoDB stores:
@@ -137,13 +614,13 @@ def load_documents(case_id: str, user_id: str) -> List[str]:
       * policyFiles: [{name, size, type, bucket?, path?, data?}]
       - If file has 'path' and 'bucket': file is in Supabase storage
       - If file has 'data': file is stored as Buffer in MongoDB (legacy)
-    
+
     Supabase stores:
     - Actual PDF file contents in storage buckets:
       * 'denials' bucket: denial letter PDFs
       * 'policies' bucket: policy document PDFs
     - PostgreSQL tables (for dashboard/analytics, not used by RAG pipeline)
-    
+
     PIPELINE NEEDS:
     ===============
     1. Case metadata from MongoDB → to find planId and denialFiles
@@ -154,804 +631,1533 @@ def load_documents(case_id: str, user_id: str) -> List[str]:
     4. Policy file contents:
        - If file.path exists → download from Supabase storage (bucket: 'policies')
        - If file.data exists → use MongoDB Buffer directly
+
+    get_vector_store no longer calls this: policy files are embedded once per
+    plan (see get_plan_vector_store) and only denial files go into the case store.
     """
-    db = get_db_connection()
+    case, plan = load_case_and_plan(case_id)
     sb = get_supabase_client()
-    
-    # List available collections for debugging
+    docs = load_file_documents(case.get("denialFiles"), "denials", sb)
+    docs.extend(load_file_documents(plan.get("policyFiles"), "policies", sb))
+    return docs
+
+def split_documents(docs: List["Document"]) -> List["Document"]:
+    """Chunking used for every persisted case/plan store."""
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=2000,
+        chunk_overlap=600,
+        length_function=len,
+        add_start_index=True,
+    )
+    return text_splitter.split_documents(docs)
+
+def file_key(file_data: Dict[str, Any], bucket_name: str) -> str:
+    """Stable identity (location + size) for a file entry without downloading it."""
+    size = file_data.get('size', '')
+    if file_data.get("path"):
+        return f"{file_data.get('bucket', bucket_name)}/{file_data['path']}:{size}"
+    return f"mongo:{file_data.get('name', 'unknown.pdf')}:{size}"
+
+def get_chroma_client():
+    """The single persistent Chroma client for VECTOR_STORE_ROOT, opened once per process."""
+    global _chroma_client
+    import chromadb
+    with _client_lock:
+        if _chroma_client is None:
+            _chroma_client = chromadb.PersistentClient(path=VECTOR_STORE_ROOT)
+        return _chroma_client
+
+def store_collection_name(kind: str, ident: str) -> str:
+    """
+    Collection name for a case ("case") or plan ("plan") store. Chroma only
+    allows 3-63 characters of [a-zA-Z0-9._-], so other ids are hashed.
+    """
+    name = f"{kind}_{ident}"
+    if len(name) <= 63 and re.fullmatch(r"[a-zA-Z0-9][a-zA-Z0-9._-]*[a-zA-Z0-9]", name):
+        return name
+    return f"{kind}_{hashlib.sha256(str(ident).encode('utf-8')).hexdigest()[:32]}"
+
+def collection_exists(name: str) -> bool:
     try:
-        collection_names = db.list_collection_names()
-        print(f"Available collections: {collection_names}", file=sys.stderr)
-        
-        # Also check the database name being used
-        print(f"Database name: {db.name}", file=sys.stderr)
-        
-        # Try to get collection stats
-        if 'cases' in collection_names:
-            cases_count = db.cases.count_documents({})
-            print(f"Total cases in 'cases' collection: {cases_count}", file=sys.stderr)
-            
-            # Try to find any case with the given ID
-            test_case = db.cases.find_one({"id": case_id})
-            if test_case:
-                print(f"Found case with ID {case_id} in database", file=sys.stderr)
-                # Debug: show what files the case has
-                denial_files = test_case.get('denialFiles', [])
-                print(f"Case has {len(denial_files)} denial file(s)", file=sys.stderr)
-                for i, f in enumerate(denial_files):
-                    has_path = 'path' in f and f.get('path')
-                    has_data = 'data' in f and f.get('data')
-                    print(f"  File {i+1}: {f.get('name')} - Supabase: {has_path}, MongoDB: {has_data}", file=sys.stderr)
-            else:
-                # Show some sample IDs
-                sample_cases = list(db.cases.find({}, {"id": 1, "_id": 0}).limit(5))
-                print(f"Sample case IDs in database: {[c.get('id') for c in sample_cases]}", file=sys.stderr)
+        get_chroma_client().get_collection(name)
+        return True
+    except Exception:
+        return False
+
+def _manifest_dir() -> str:
+    return os.path.join(VECTOR_STORE_ROOT, "manifests")
+
+def _manifest_path(collection_name: str) -> str:
+    return os.path.join(_manifest_dir(), f"{collection_name}.json")
+
+def _read_manifest_file(manifest_path: str) -> Dict[str, Any]:
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, "r") as f:
+            return json.load(f)
     except Exception as e:
-        print(f"Error listing collections: {e}", file=sys.stderr)
-    
-    # Mongoose uses lowercase pluralized names: Case -> cases, InsurancePlan -> insuranceplans
-    # Try to find the case in the cases collection
-    case = None
-    case_collection = None
-    
-    # Try different possible collection names
-    possible_collections = ['cases', 'Cases', 'case']
-    for coll_name in possible_collections:
-        if coll_name in collection_names:
-            case_collection = db[coll_name]
-            case = case_collection.find_one({"id": case_id})
-            if case:
-                print(f"Found case in collection: {coll_name}", file=sys.stderr)
-                break
-    
-    if not case:
-        # Debug: show what cases exist in the most likely collection
-        if 'cases' in collection_names:
-            all_cases = list(db.cases.find({}, {"id": 1, "_id": 0}).limit(10))
-            print(f"Debug: Found {len(all_cases)} cases in 'cases' collection. Sample IDs: {[c.get('id') for c in all_cases]}", file=sys.stderr)
-        raise ValueError(f"Case {case_id} not found in database. Available collections: {collection_names}")
-    
-    # Find the plan - Mongoose: InsurancePlan -> insuranceplans
-    plan = None
-    plan_collection = None
-    
-    # Try different possible collection names for plans
-    possible_plan_collections = ['insuranceplans', 'InsurancePlans', 'insuranceplan', 'InsurancePlan']
-    for coll_name in possible_plan_collections:
-        if coll_name in collection_names:
-            plan_collection = db[coll_name]
-            plan = plan_collection.find_one({"id": case.get("planId")})
-            if plan:
-                print(f"Found plan in collection: {coll_name}", file=sys.stderr)
-                break
-    
-    if not plan:
-        plan_id = case.get("planId")
-        if 'insuranceplans' in collection_names:
-            all_plans = list(db.insuranceplans.find({}, {"id": 1, "_id": 0}).limit(10))
-            print(f"Debug: Found {len(all_plans)} plans in 'insuranceplans' collection. Sample IDs: {[p.get('id') for p in all_plans]}", file=sys.stderr)
-        raise ValueError(f"Plan {plan_id} not found in database")
+        print(f"Warning: Could not read manifest {manifest_path}: {e}", file=sys.stderr)
+        return {}
 
-    docs = []
-    
-    # Helper to process file - handles both Supabase and MongoDB storage
-    def process_file(file_data, bucket_name):
-        """
-        Process a file from either Supabase storage or MongoDB Buffer.
-        
-        Priority:
-        1. If file has 'path' and 'bucket' → download from Supabase storage
-        2. If file has 'data' → use MongoDB Buffer directly
-        3. Otherwise → skip file
-        """
-        file_name = file_data.get('name', 'unknown.pdf')
-        print(f"Processing file: {file_name}", file=sys.stderr)
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            if "path" in file_data and file_data.get("path") and sb:
-                # File is stored in Supabase - download it
-                file_path = file_data["path"]
-                file_bucket = file_data.get("bucket", bucket_name)
-                print(f"  Downloading from Supabase: {file_bucket}/{file_path}", file=sys.stderr)
-                try:
-                    data = sb.storage.from_(file_bucket).download(file_path)
-                    tmp.write(data)
-                    print(f"  ✅ Downloaded {len(data)} bytes from Supabase", file=sys.stderr)
-                except Exception as e:
-                    print(f"  ❌ Error downloading from Supabase: {e}", file=sys.stderr)
-                    return None
-            elif "data" in file_data and file_data.get("data"):
-                # File is stored as Buffer in MongoDB - use directly
-                print(f"  Using MongoDB Buffer data ({len(file_data['data'])} bytes)", file=sys.stderr)
-                # Handle both bytes and Buffer types
-                file_data_bytes = file_data["data"]
-                if isinstance(file_data_bytes, bytes):
-                    tmp.write(file_data_bytes)
-                else:
-                    # Convert to bytes if needed
-                    tmp.write(bytes(file_data_bytes))
+def read_manifest(collection_name: str) -> Dict[str, Any]:
+    return _read_manifest_file(_manifest_path(collection_name))
+
+def write_manifest(collection_name: str, manifest: Dict[str, Any]):
+    manifest_path = _manifest_path(collection_name)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    # Unique temp name so concurrent writers never share (and clobber) one temp file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(manifest_path), prefix=f"{collection_name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+_store_locks: Dict[str, threading.Lock] = {}
+
+def _get_store_lock(collection_name: str) -> threading.Lock:
+    with _client_lock:
+        return _store_locks.setdefault(collection_name, threading.Lock())
+
+def migrate_legacy_store(legacy_dir: str, collection_name: str) -> bool:
+    """
+    Copy an old per-directory store (chroma_db_{id}) into `collection_name`
+    in the shared store, vectors and manifest included, then delete the
+    directory. Stores without a manifest can't be synced incrementally, so
+    they are dropped and rebuilt on next use instead. The directory is only
+    deleted once the collection and its manifest are in place; a collection
+    left without a manifest by an interrupted migration is copied again.
+    Returns True if the directory was dealt with.
+    """
+    import chromadb
+
+    if not os.path.isdir(legacy_dir):
+        return False
+    manifest = _read_manifest_file(os.path.join(legacy_dir, "manifest.json"))
+    if "chunks" not in manifest:
+        print(f"Dropping {legacy_dir}: no manifest, it will be rebuilt on next sync", file=sys.stderr)
+        shutil.rmtree(legacy_dir, ignore_errors=True)
+        return True
+
+    with _get_store_lock(collection_name):
+        if collection_exists(collection_name):
+            if "chunks" in read_manifest(collection_name):
+                print(f"{collection_name} already exists, dropping legacy {legacy_dir}", file=sys.stderr)
+                shutil.rmtree(legacy_dir, ignore_errors=True)
+                return True
+            # An earlier migration stopped before writing the manifest; copy again from the start
+            print(f"{collection_name} is a partial migration, copying {legacy_dir} again", file=sys.stderr)
+            get_chroma_client().delete_collection(collection_name)
+
+        legacy_client = chromadb.PersistentClient(path=legacy_dir)
+        target = get_chroma_client().get_or_create_collection(collection_name)
+        copied = 0
+        for legacy in legacy_client.list_collections():
+            source = legacy_client.get_collection(getattr(legacy, "name", legacy))
+            data = source.get(include=["embeddings", "documents", "metadatas"])
+            ids = data["ids"]
+            embeddings = data["embeddings"]
+            for i in range(0, len(ids), 500):
+                batch = slice(i, i + 500)
+                target.add(
+                    ids=ids[batch],
+                    embeddings=[list(map(float, v)) for v in embeddings[batch]],
+                    documents=data["documents"][batch],
+                    metadatas=data["metadatas"][batch],
+                )
+            copied += len(ids)
+        write_manifest(collection_name, manifest)
+
+    del legacy_client
+    shutil.rmtree(legacy_dir, ignore_errors=True)
+    print(f"Migrated {copied} chunks from {legacy_dir} into {collection_name}", file=sys.stderr)
+    return True
+
+def migrate_legacy_stores() -> Dict[str, int]:
+    """Migrate every chroma_db_* directory under LEGACY_VECTOR_STORE_DIR."""
+    migrated = failed = 0
+    if not os.path.isdir(LEGACY_VECTOR_STORE_DIR):
+        return {"migrated": 0, "failed": 0}
+    for entry in sorted(os.listdir(LEGACY_VECTOR_STORE_DIR)):
+        if not entry.startswith("chroma_db_"):
+            continue
+        ident = entry[len("chroma_db_"):]
+        kind = "case"
+        if ident.startswith("plan_"):
+            kind, ident = "plan", ident[len("plan_"):]
+        try:
+            if migrate_legacy_store(os.path.join(LEGACY_VECTOR_STORE_DIR, entry), store_collection_name(kind, ident)):
+                migrated += 1
+        except Exception as e:
+            failed += 1
+            print(f"Warning: Failed to migrate {entry}: {e}", file=sys.stderr)
+    return {"migrated": migrated, "failed": failed}
+
+def get_snapshot_backend():
+    """Remote store snapshot directory (see store_snapshot for VECTOR_SNAPSHOT_DIR), or None."""
+    global _snapshot_backend, _snapshot_backend_opened
+    from store_snapshot import open_snapshot_backend
+    with _client_lock:
+        if not _snapshot_backend_opened:
+            _snapshot_backend = open_snapshot_backend()
+            _snapshot_backend_opened = True
+        return _snapshot_backend
+
+def save_store_snapshot(collection_name: str):
+    """Upload a collection and its manifest to the snapshot backend. Call with the store lock held."""
+    from store_snapshot import export_collection
+    backend = get_snapshot_backend()
+    if backend is None:
+        return
+    start = time.perf_counter()
+    try:
+        blob = export_collection(get_chroma_client().get_collection(collection_name), read_manifest(collection_name))
+        backend.put(collection_name, blob)
+        print(
+            f"Saved snapshot of {collection_name} ({len(blob) / 1024:.0f} KB) in {time.perf_counter() - start:.2f}s",
+            file=sys.stderr,
+        )
+    except Exception as e:
+        print(f"Warning: Failed to snapshot {collection_name}: {e}", file=sys.stderr)
+
+def restore_store_snapshot(collection_name: str) -> bool:
+    """Recreate a missing local collection from its snapshot. Returns True if restored."""
+    from store_snapshot import import_collection
+    backend = get_snapshot_backend()
+    if backend is None:
+        return False
+    with _get_store_lock(collection_name):
+        if collection_exists(collection_name):
+            return False
+        start = time.perf_counter()
+        try:
+            blob = backend.get(collection_name)
+            if blob is None:
+                return False
+            collection = get_chroma_client().get_or_create_collection(collection_name)
+            manifest = import_collection(collection, blob)
+            write_manifest(collection_name, {**manifest, "lastAccess": time.time()})
+        except Exception as e:
+            print(f"Warning: Failed to restore snapshot of {collection_name}: {e}", file=sys.stderr)
+            if collection_exists(collection_name):
+                get_chroma_client().delete_collection(collection_name)
+            return False
+    print(f"Restored {collection_name} from snapshot in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+    return True
+
+def _ensure_local_store(kind: str, ident: str, collection_name: str):
+    """Bring a store into the local shared store if it only exists elsewhere: a legacy directory or a snapshot."""
+    suffix = f"plan_{ident}" if kind == "plan" else ident
+    legacy_dir = os.path.join(LEGACY_VECTOR_STORE_DIR, f"chroma_db_{suffix}")
+    if os.path.isdir(legacy_dir):
+        try:
+            migrate_legacy_store(legacy_dir, collection_name)
+        except Exception as e:
+            print(f"Warning: Failed to migrate {legacy_dir}: {e}", file=sys.stderr)
+    if not collection_exists(collection_name):
+        restore_store_snapshot(collection_name)
+
+def touch_store(collection_name: str) -> Dict[str, Any]:
+    """Record that a store was used (for TTL eviction); returns its manifest."""
+    with _get_store_lock(collection_name):
+        manifest = read_manifest(collection_name)
+        # Skip the rewrite when the store was touched within the last minute
+        if manifest and time.time() - manifest.get("lastAccess", 0) > 60:
+            manifest["lastAccess"] = time.time()
+            write_manifest(collection_name, manifest)
+        return manifest
+
+def store_size_bytes(manifest: Dict[str, Any]) -> int:
+    sizes = manifest.get("sizes", {})
+    total = 0
+    for content_hash, ids in manifest.get("chunks", {}).items():
+        # Stores synced before sizes were recorded: assume full-size chunks
+        total += sizes.get(content_hash, len(ids) * (2000 + _VECTOR_BYTES))
+    return total
+
+def delete_store(collection_name: str, drop_snapshot: bool = False):
+    """Delete a local collection and its manifest, and optionally its remote snapshot."""
+    with _get_store_lock(collection_name):
+        if collection_exists(collection_name):
+            get_chroma_client().delete_collection(collection_name)
+        manifest_path = _manifest_path(collection_name)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        backend = get_snapshot_backend() if drop_snapshot else None
+        if backend is not None:
+            backend.delete(collection_name)
+
+def list_stores() -> List[Dict[str, Any]]:
+    """One entry per managed collection: name, kind, owner id, size and last access."""
+    manifest_dir = _manifest_dir()
+    if not os.path.isdir(manifest_dir):
+        return []
+    stores = []
+    for entry in sorted(os.listdir(manifest_dir)):
+        if not entry.endswith(".json"):
+            continue
+        name = entry[:-len(".json")]
+        manifest = read_manifest(name)
+        kind = manifest.get("kind") or name.split("_", 1)[0]
+        owner = manifest.get("caseId") if kind == "case" else manifest.get("planId")
+        stores.append({
+            "collection": name,
+            "kind": kind,
+            "id": owner or name.split("_", 1)[-1],
+            "chunks": sum(len(ids) for ids in manifest.get("chunks", {}).values()),
+            "sizeBytes": store_size_bytes(manifest),
+            "lastAccess": manifest.get("lastAccess", 0),
+        })
+    return stores
+
+def _closed_case_ids(case_ids: List[str]) -> set:
+    """Cases that are resolved/closed in Mongo, or no longer exist there."""
+    if not case_ids:
+        return set()
+    cases = get_collection("cases")
+    if cases is None:
+        return set()
+    open_ids = set()
+    closed = set()
+    for doc in cases.find({"id": {"$in": case_ids}}, {"_id": 0, "id": 1, "resolved": 1, "status": 1}):
+        if doc.get("resolved") or doc.get("status") in ("closed", "resolved"):
+            closed.add(doc["id"])
+        else:
+            open_ids.add(doc["id"])
+    if not open_ids and not closed:
+        # Nothing matched at all - more likely the wrong database than every case deleted
+        return set()
+    return closed | (set(case_ids) - open_ids - closed)
+
+def collect_store_garbage(ttl_days: float = None, max_bytes: int = None) -> Dict[str, Any]:
+    """
+    Evict vector stores, in order:
+      1. case stores whose case is resolved/closed or deleted in Mongo,
+      2. any store not used for `ttl_days` (VECTOR_STORE_TTL_DAYS; 0 disables),
+      3. least recently used stores until the total is under `max_bytes`
+         (VECTOR_STORE_MAX_BYTES; 0 disables).
+    Legacy chroma_db_* directories are migrated first so they are counted.
+    Remote snapshots are kept (a TTL/size-evicted store is restored from its
+    snapshot on next use) except for closed cases.
+    Returns what was evicted and how much was reclaimed.
+    """
+    ttl_days = VECTOR_STORE_TTL_DAYS if ttl_days is None else ttl_days
+    max_bytes = VECTOR_STORE_MAX_BYTES if max_bytes is None else max_bytes
+    start = time.perf_counter()
+    migrate_legacy_stores()
+
+    stores = list_stores()
+    evicted = []
+
+    def evict(store: Dict[str, Any], reason: str):
+        try:
+            # Closed cases won't be reopened, so their remote snapshot goes too
+            delete_store(store["collection"], drop_snapshot=(reason == "case closed"))
+            evicted.append({**store, "reason": reason})
+        except Exception as e:
+            print(f"Warning: Failed to evict {store['collection']}: {e}", file=sys.stderr)
+
+    try:
+        closed = _closed_case_ids([st["id"] for st in stores if st["kind"] == "case"])
+    except Exception as e:
+        print(f"Warning: Could not check case status, skipping status eviction: {e}", file=sys.stderr)
+        closed = set()
+    cutoff = time.time() - ttl_days * 86400
+    remaining = []
+    for store in stores:
+        if store["kind"] == "case" and store["id"] in closed:
+            evict(store, "case closed")
+        elif ttl_days > 0 and store["lastAccess"] < cutoff:
+            evict(store, "ttl")
+        else:
+            remaining.append(store)
+
+    if max_bytes > 0:
+        remaining.sort(key=lambda st: st["lastAccess"])
+        total = sum(st["sizeBytes"] for st in remaining)
+        while remaining and total > max_bytes:
+            store = remaining.pop(0)
+            evict(store, "size cap")
+            total -= store["sizeBytes"]
+
+    report = {
+        "evicted": evicted,
+        "reclaimedBytes": sum(st["sizeBytes"] for st in evicted),
+        "reclaimedChunks": sum(st["chunks"] for st in evicted),
+        "remainingStores": len(stores) - len(evicted),
+        "remainingBytes": sum(st["sizeBytes"] for st in stores) - sum(st["sizeBytes"] for st in evicted),
+        "seconds": round(time.perf_counter() - start, 2),
+    }
+    print(
+        f"Store GC: evicted {len(evicted)} store(s), reclaimed ~{report['reclaimedBytes'] / 1024 ** 2:.1f} MB "
+        f"({report['reclaimedChunks']} chunks); {report['remainingStores']} store(s) left",
+        file=sys.stderr,
+    )
+    return report
+
+def start_store_gc(interval: int = None) -> "threading.Thread":
+    """Run collect_store_garbage every `interval` seconds on a daemon thread (0 disables)."""
+    interval = VECTOR_STORE_GC_INTERVAL if interval is None else interval
+    if interval <= 0:
+        return None
+
+    def sweep():
+        while True:
+            time.sleep(interval)
+            try:
+                collect_store_garbage()
+            except Exception as e:
+                print(f"Warning: Store GC sweep failed: {e}", file=sys.stderr)
+
+    thread = threading.Thread(target=sweep, name="store-gc", daemon=True)
+    thread.start()
+    return thread
+
+def sync_vector_store(
+    collection_name: str,
+    files: List[Dict[str, Any]],
+    bucket_name: str,
+    sb: "Client" = None,
+    chunk_metadata: Dict[str, Any] = None,
+    manifest_extra: Dict[str, Any] = None,
+):
+    """
+    Bring a collection in the shared Chroma store in line with a list of
+    files, embedding only what changed since the last sync.
+
+    The collection's manifest (VECTOR_STORE_ROOT/manifests/<name>.json) records:
+      files:  file_key -> sha256 of the file bytes
+      chunks: sha256   -> chunk ids in the Chroma collection
+      sizes:  sha256   -> approximate bytes stored for those chunks
+      lastAccess: unix time the store was last synced or loaded
+    Files whose key is already in the manifest are not re-downloaded; new
+    content is embedded, identical re-uploads are recognised by hash, and
+    chunks for files no longer in the list are deleted.
+
+    Returns (db, chunk_count).
+    """
+    from langchain_community.vectorstores import Chroma
+
+    embedding_function = get_embedding_function()
+
+    with _get_store_lock(collection_name):
+        manifest = read_manifest(collection_name)
+        if "chunks" not in manifest and collection_exists(collection_name):
+            # Without a manifest the chunks can't be diffed - rebuild the collection
+            print(f"No manifest for {collection_name}, rebuilding from scratch", file=sys.stderr)
+            get_chroma_client().delete_collection(collection_name)
+            manifest = {}
+        known_files = manifest.get("files", {})
+        known_chunks = manifest.get("chunks", {})
+        known_sizes = manifest.get("sizes", {})
+        db = Chroma(client=get_chroma_client(), collection_name=collection_name, embedding_function=embedding_function)
+
+        current_files = {}
+        added = 0
+        to_fetch = []
+        for f in files or []:
+            key = file_key(f, bucket_name)
+            if key in known_files and known_files[key] in known_chunks:
+                current_files[key] = known_files[key]
             else:
-                print(f"  ❌ Skipping file {file_name} - no data source (path: {file_data.get('path')}, data: {bool(file_data.get('data'))})", file=sys.stderr)
-                return None
-            tmp.flush()
-            return tmp.name
-
-    # Process Denial Files
-    if "denialFiles" in case:
-        for f in case["denialFiles"]:
-            tmp_path = process_file(f, "denials")
-            if tmp_path:
-                try:
-                    loader = PyPDFLoader(tmp_path)
-                    docs.extend(loader.load())
-                except Exception as e:
-                    print(f"Error loading denial PDF: {e}", file=sys.stderr)
-                finally:
-                    os.unlink(tmp_path)
+                to_fetch.append(f)
 
-    # Process Policy Files
-    if "policyFiles" in plan:
-        for f in plan["policyFiles"]:
-            tmp_path = process_file(f, "policies")
-            if tmp_path:
-                try:
-                    loader = PyPDFLoader(tmp_path)
-                    docs.extend(loader.load())
-                except Exception as e:
-                    print(f"Error loading policy PDF: {e}", file=sys.stderr)
-                finally:
-                    os.unlink(tmp_path)
-                    
-    return docs
+        for f, data, content_hash, docs in iter_fetched_files(to_fetch, bucket_name, sb, skip_hashes=frozenset(known_chunks)):
+            key = file_key(f, bucket_name)
+            if not data:
+                continue
+            current_files[key] = content_hash
+            if content_hash in known_chunks:
+                print(f"File {key} already embedded in {collection_name}", file=sys.stderr)
+                continue
+            if docs is None:
+                continue
+
+            chunks = split_documents(docs)
+            for chunk in chunks:
+                chunk.metadata.update(chunk_metadata or {})
+                chunk.metadata["file_hash"] = content_hash
+            ids = [f"{content_hash}:{i}" for i in range(len(chunks))]
+            if chunks:
+                db.add_documents(chunks, ids=ids)
+            known_chunks[content_hash] = ids
+            known_sizes[content_hash] = sum(len(c.page_content.encode("utf-8")) + _VECTOR_BYTES for c in chunks)
+            added += 1
+            print(f"Embedded {len(chunks)} chunks from {key} into {collection_name}", file=sys.stderr)
+
+        # Drop chunks for files that are no longer referenced
+        live_hashes = set(current_files.values())
+        removed = 0
+        for content_hash in list(known_chunks):
+            if content_hash not in live_hashes:
+                if known_chunks[content_hash]:
+                    db.delete(ids=known_chunks[content_hash])
+                del known_chunks[content_hash]
+                known_sizes.pop(content_hash, None)
+                removed += 1
+
+        print(
+            f"Synced {collection_name}: {added} file(s) embedded, {removed} removed, "
+            f"{len(current_files) - added} unchanged",
+            file=sys.stderr,
+        )
+        write_manifest(collection_name, {
+            **(manifest_extra or {}),
+            "files": current_files,
+            "chunks": known_chunks,
+            "sizes": known_sizes,
+            "lastAccess": time.time(),
+        })
+        chunk_count = sum(len(ids) for ids in known_chunks.values())
+        backend = get_snapshot_backend()
+        if chunk_count and backend is not None and (added or removed or not backend.exists(collection_name)):
+            save_store_snapshot(collection_name)
+        return db, chunk_count
+
+def get_plan_vector_store(plan: Dict[str, Any], sb: "Client" = None):
+    """
+    Get the shared policy index for a plan (collection plan_{plan_id}),
+    embedding only policy files whose content is not already in it.
+    Returns None if the plan has no indexed policy text.
+    """
+    plan_id = plan.get("id")
+    collection_name = store_collection_name("plan", plan_id)
+    _ensure_local_store("plan", plan_id, collection_name)
+    db, chunk_count = sync_vector_store(
+        collection_name,
+        plan.get("policyFiles"),
+        "policies",
+        sb,
+        chunk_metadata={"plan_id": plan_id},
+        manifest_extra={"kind": "plan", "planId": plan_id},
+    )
+    return db if chunk_count else None
+
+class CaseVectorStore:
+    """
+    Retrieval view over a case: the small per-case denial collection plus the
+    shared plan policy collection. Exposes the subset of the Chroma API the
+    pipeline uses and merges results from both by relevance score. Each
+    store can carry a metadata filter that every query is restricted to.
+    """
+
+    def __init__(self, denial_db=None, policy_db=None, denial_filter=None, policy_filter=None):
+        self.denial_db = denial_db
+        self.policy_db = policy_db
+        self.denial_filter = denial_filter
+        self.policy_filter = policy_filter
+
+    def _stores(self):
+        pairs = [(self.denial_db, self.denial_filter), (self.policy_db, self.policy_filter)]
+        return [(store, where) for store, where in pairs if store is not None]
+
+    def similarity_search_with_relevance_scores(self, query: str, k: int = 4):
+        results = []
+        for store, where in self._stores():
+            results.extend(store.similarity_search_with_relevance_scores(query, k=k, filter=where))
+        results.sort(key=lambda pair: pair[1], reverse=True)
+        return results[:k]
+
+    def similarity_search(self, query: str, k: int = 4):
+        return [doc for doc, _ in self.similarity_search_with_relevance_scores(query, k=k)]
 
 def get_vector_store(case_id: str, user_id: str, force_refresh: bool = False):
     """
-    Get or create a ChromaDB vector store for a specific case.
+    Get or create the vector stores for a specific case.
+
+    Both live in the shared store under VECTOR_STORE_ROOT: denial files are
+    embedded into collection case_{case_id}; policy files are embedded once
+    per plan into plan_{plan_id} and shared by every case on that plan.
+    Returns a CaseVectorStore querying both, filtered on the case_id /
+    plan_id chunk metadata. Old chroma_db_* directories are migrated into
+    the shared store the first time their case or plan is used, and
+    collections missing locally are restored from their remote snapshot
+    (VECTOR_SNAPSHOT_DIR) before anything is rebuilt.
+
+    force_refresh (used by ingest) re-syncs both stores against Mongo; only
+    files that were added, changed or removed are re-embedded.
     """
-    persist_dir = f"chroma_db_{case_id}"
-    embedding_function = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-    
-    # Try to load existing DB if not forcing refresh
-    if not force_refresh and os.path.exists(persist_dir):
+    from langchain_community.vectorstores import Chroma
+
+    collection_name = store_collection_name("case", case_id)
+    _ensure_local_store("case", case_id, collection_name)
+    embedding_function = get_embedding_function()
+
+    # Try to load the existing collections if not forcing refresh
+    if not force_refresh and collection_exists(collection_name):
         try:
-            print(f"Loading existing ChromaDB from {persist_dir}", file=sys.stderr)
-            db = Chroma(persist_directory=persist_dir, embedding_function=embedding_function)
-            # Verify it works by doing a dummy query or checking collection
-            # If it fails, we catch and rebuild
-            return db
+            print(f"Loading existing collection {collection_name}", file=sys.stderr)
+            case_manifest = touch_store(collection_name)
+            client = get_chroma_client()
+            denial_db = Chroma(client=client, collection_name=collection_name, embedding_function=embedding_function)
+            policy_db = None
+            plan_id = case_manifest.get("planId")
+            if plan_id:
+                plan_collection = store_collection_name("plan", plan_id)
+                _ensure_local_store("plan", plan_id, plan_collection)
+                if not collection_exists(plan_collection):
+                    # Plan store was evicted; rebuild it through the sync path below
+                    raise LookupError(f"plan collection {plan_collection} is missing")
+                touch_store(plan_collection)
+                policy_db = Chroma(client=client, collection_name=plan_collection, embedding_function=embedding_function)
+            return CaseVectorStore(
+                denial_db,
+                policy_db,
+                denial_filter={"case_id": case_id},
+                policy_filter={"plan_id": plan_id} if policy_db is not None else None,
+            )
         except Exception as e:
-            print(f"Error loading existing DB: {e}. Rebuilding...", file=sys.stderr)
-    
-    # Build new DB
-    print(f"Building new ChromaDB for case {case_id}...", file=sys.stderr)
-    raw_docs = load_documents(case_id, user_id)
-    
-    if not raw_docs:
+            print(f"Error loading existing collection: {e}. Rebuilding...", file=sys.stderr)
+
+    # Build or incrementally update the stores
+    print(f"Syncing vector store for case {case_id}...", file=sys.stderr)
+    case, plan = load_case_and_plan(case_id)
+    sb = get_supabase_client()
+
+    # Sync the plan's policy index while the denial letters are synced
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="plan-sync") as executor:
+        policy_future = executor.submit(get_plan_vector_store, plan, sb)
+        denial_db, denial_chunks = sync_vector_store(
+            collection_name,
+            case.get("denialFiles"),
+            "denials",
+            sb,
+            chunk_metadata={"case_id": case_id},
+            manifest_extra={"kind": "case", "caseId": case_id, "planId": plan.get("id")},
+        )
+        policy_db = policy_future.result()
+
+    if not denial_chunks and policy_db is None:
         print("No documents found to ingest.", file=sys.stderr)
         return None
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=2000,
-        chunk_overlap=600,
-        length_function=len,
-        add_start_index=True,
+    print(f"Case {case_id} store has {denial_chunks} denial chunks", file=sys.stderr)
+    return CaseVectorStore(
+        denial_db if denial_chunks else None,
+        policy_db,
+        denial_filter={"case_id": case_id},
+        policy_filter={"plan_id": plan.get("id")},
     )
-    chunks = text_splitter.split_documents(raw_docs)
-    print(f"Split into {len(chunks)} chunks", file=sys.stderr)
-    
-    # Clean up existing dir if it exists to ensure fresh start
-    if os.path.exists(persist_dir):
-        import shutil
+
+def retrieve_case_context(db: "CaseVectorStore") -> List[str]:
+    """
+    Retrieval shared by analysis and email_draft: fused sub-queries (hits
+    below multi_query_retrieve's relevance cut-off are dropped before
+    fusion), merged and packed under the context token budget.
+    """
+    from retrieval import multi_query_retrieve, assemble_context
+    results = multi_query_retrieve(db, k=10)
+    print(f"Retrieved {len(results)} results from ChromaDB", file=sys.stderr)
+    relevant_context, _ = assemble_context([doc for doc, _ in results])
+    return relevant_context
+
+def run_ingest(case_id: str = None, user_id: str = None, files: List[str] = None) -> Dict[str, Any]:
+    if not case_id or not user_id:
+        return {"error": "caseId and userId are required for ingest mode"}
+
+    db = get_vector_store(case_id, user_id, force_refresh=True)
+    if db:
+        return {"success": True, "message": "Ingestion complete"}
+    return {"error": "Ingestion failed - no documents found"}
+
+def run_extraction(case_id: str = None, user_id: str = None, files: List[str] = None) -> Dict[str, Any]:
+    from langchain_community.document_loaders import PyPDFLoader
+    from langchain_community.vectorstores import Chroma
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from retrieval import assemble_context
+
+    if not files:
+        return {"error": "No files provided for extraction"}
+
+    print(f"Extracting plan details from {len(files)} files...", file=sys.stderr)
+    docs = []
+    for file_path in files:
         try:
-            shutil.rmtree(persist_dir)
+            loader = PyPDFLoader(file_path)
+            docs.extend(loader.load())
         except Exception as e:
-            print(f"Warning: Could not delete existing ChromaDB directory: {e}", file=sys.stderr)
+            print(f"Error loading PDF {file_path}: {e}", file=sys.stderr)
 
+    if not docs:
+        return {"error": "Failed to load any documents"}
+
+    # Split text
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
+    chunks = text_splitter.split_documents(docs)
+    print(f"DEBUG: Split into {len(chunks)} chunks", file=sys.stderr)
+    if chunks:
+        print(f"DEBUG: First chunk preview: {chunks[0].page_content[:200]}...", file=sys.stderr)
+
+    # Create temporary vector store for extraction
+    print("DEBUG: Creating embeddings...", file=sys.stderr)
+    embedding_function = get_embedding_function()
+    print("DEBUG: Adding documents to ChromaDB...", file=sys.stderr)
+    # Per-request collection: without a name every call shares chromadb's
+    # process-wide "langchain" collection, which the serve worker never clears
     db = Chroma.from_documents(
-        documents=chunks, 
-        embedding=embedding_function, 
-        persist_directory=persist_dir
+        documents=chunks, embedding=embedding_function, collection_name=f"scratch-{uuid.uuid4().hex}"
     )
-    print(f"Created and persisted ChromaDB to {persist_dir}", file=sys.stderr)
-    return db
+    print(f"DEBUG: ChromaDB created successfully with {len(chunks)} documents", file=sys.stderr)
 
-def main():
-    parser = argparse.ArgumentParser(description="RAG Pipeline for PolicyPilot")
-    parser.add_argument("--caseId", required=False, help="Case ID (required for analysis/email_draft mode)")
-    parser.add_argument("--userId", required=False, help="User ID (required for analysis/email_draft mode)")
-    parser.add_argument("--mode", default="analysis", choices=["analysis", "extraction", "denial_extract", "email_draft", "email_analysis", "generate_followup", "ingest"], help="Pipeline mode")
-    parser.add_argument("--files", nargs="*", help="List of file paths for extraction/denial_extract mode")
-    args = parser.parse_args()
+    # Query for plan details
+    query = "insurance company name plan name policy number"
+    print(f"DEBUG: Querying ChromaDB with: '{query}'", file=sys.stderr)
+    try:
+        results = db.similarity_search(query, k=10)
+    finally:
+        db.delete_collection()
+    print(f"DEBUG: Retrieved {len(results)} results from ChromaDB", file=sys.stderr)
+    for i, doc in enumerate(results):
+        print(f"DEBUG: Result {i+1} preview: {doc.page_content[:150]}...", file=sys.stderr)
+    context_spans, _ = assemble_context(results)
+    context_text = "\n\n".join(context_spans)
+
+    # Generate extraction with Gemini
+    prompt = f"""
+    Extract the following insurance plan details from the context:
+    1. Insurance Company Name
+    2. Plan Name
+    3. Policy Number (Member ID, Subscriber ID, or Policy ID)
+       - Look for alphanumeric codes (e.g., "COINDEPO...", "MIEP...", etc.) that appear near the plan name or in headers/footers.
+       - If a code like "COINDEPO052023" is prominent, it is likely the policy number.
+
+    Context:
+    ---
+    {context_text}
+    ---
+
+    Return ONLY a JSON object with keys: 'insuranceCompany', 'planName', 'policyNumber'.
+    If a field is not found, use "Unknown".
+    """
+
+    routed = route_generation("extraction", prompt)
+    print(f"DEBUG: Raw Gemini response ({routed['model']}): {routed['text'][:200]}...", file=sys.stderr)
+    if routed["data"] is None:
+        print(f"JSON Parse Error: {routed['problem']}", file=sys.stderr)
+        return {"error": "Failed to parse extraction result", "raw": routed["text"], "details": routed["problem"]}
+    return routed["data"]
+
+def run_denial_extract(case_id: str = None, user_id: str = None, files: List[str] = None) -> Dict[str, Any]:
+    from langchain_community.document_loaders import PyPDFLoader
+    from langchain_community.vectorstores import Chroma
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from retrieval import assemble_context
+
+    if not files:
+        return {"error": "No files provided for denial extraction"}
 
+    print(f"Extracting denial brief description from {len(files)} files...", file=sys.stderr)
+    docs = []
+    for file_path in files:
+        try:
+            loader = PyPDFLoader(file_path)
+            docs.extend(loader.load())
+        except Exception as e:
+            print(f"Error loading PDF {file_path}: {e}", file=sys.stderr)
+
+    if not docs:
+        return {"error": "Failed to load any documents"}
+
+    # Split text
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
+    chunks = text_splitter.split_documents(docs)
+    print(f"DEBUG: Split denial files into {len(chunks)} chunks", file=sys.stderr)
+    if chunks:
+        print(f"DEBUG: First chunk preview: {chunks[0].page_content[:200]}...", file=sys.stderr)
+
+    # Create temporary vector store
+    print("DEBUG: Creating embeddings for denial extraction...", file=sys.stderr)
+    embedding_function = get_embedding_function()
+    print("DEBUG: Adding denial documents to ChromaDB...", file=sys.stderr)
+    db = Chroma.from_documents(
+        documents=chunks, embedding=embedding_function, collection_name=f"scratch-{uuid.uuid4().hex}"
+    )
+    print(f"DEBUG: ChromaDB created successfully with {len(chunks)} denial documents", file=sys.stderr)
+
+    # Query for denial details
+    query = "denial reason"
+    print(f"DEBUG: Querying ChromaDB with: '{query}'", file=sys.stderr)
     try:
-        if args.mode == "ingest":
-            if not args.caseId or not args.userId:
-                print(json.dumps({"error": "caseId and userId are required for ingest mode"}))
-                return
-            
-            db = get_vector_store(args.caseId, args.userId, force_refresh=True)
-            if db:
-                print(json.dumps({"success": True, "message": "Ingestion complete"}))
-            else:
-                print(json.dumps({"error": "Ingestion failed - no documents found"}))
+        results = db.similarity_search(query, k=10)
+    finally:
+        db.delete_collection()
+    print(f"DEBUG: Retrieved {len(results)} results from ChromaDB", file=sys.stderr)
+    for i, doc in enumerate(results):
+        print(f"DEBUG: Result {i+1} preview: {doc.page_content[:150]}...", file=sys.stderr)
+    context_spans, _ = assemble_context(results)
+    context_text = "\n\n".join(context_spans)
 
-        if args.mode == "extraction":
-            if not args.files:
-                print(json.dumps({"error": "No files provided for extraction"}))
-                return
+    # Generate brief description with Gemini
+    prompt = f"""
+    Based on the following denial letter or hospital bill content, create a brief 1-sentence description of the issue.
+    Focus on:
+    1. The specific service/treatment that was denied or billed
+    2. The reason for denial (if mentioned)
+    3. Keep it under 15 words
 
-            print(f"Extracting plan details from {len(args.files)} files...", file=sys.stderr)
-            docs = []
-            for file_path in args.files:
-                try:
-                    loader = PyPDFLoader(file_path)
-                    docs.extend(loader.load())
-                except Exception as e:
-                    print(f"Error loading PDF {file_path}: {e}", file=sys.stderr)
+    Context:
+    ---
+    {context_text}
+    ---
 
-            if not docs:
-                print(json.dumps({"error": "Failed to load any documents"}))
-                return
+    Return ONLY a JSON object with key: 'briefDescription'.
+    Example: {{"briefDescription": "ER visit for chest pain denied as not medically necessary"}}
+    """
 
-            # Split text
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
-            chunks = text_splitter.split_documents(docs)
-            print(f"DEBUG: Split into {len(chunks)} chunks", file=sys.stderr)
-            if chunks:
-                print(f"DEBUG: First chunk preview: {chunks[0].page_content[:200]}...", file=sys.stderr)
-            
-            # Create temporary vector store for extraction
-            print("DEBUG: Creating embeddings with HuggingFaceEmbeddings...", file=sys.stderr)
-            embedding_function = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-            print("DEBUG: Adding documents to ChromaDB...", file=sys.stderr)
-            db = Chroma.from_documents(documents=chunks, embedding=embedding_function)
-            print(f"DEBUG: ChromaDB created successfully with {len(chunks)} documents", file=sys.stderr)
-
-            # Query for plan details
-            query = "insurance company name plan name policy number"
-            print(f"DEBUG: Querying ChromaDB with: '{query}'", file=sys.stderr)
-            results = db.similarity_search(query, k=10)
-            print(f"DEBUG: Retrieved {len(results)} results from ChromaDB", file=sys.stderr)
-            for i, doc in enumerate(results):
-                print(f"DEBUG: Result {i+1} preview: {doc.page_content[:150]}...", file=sys.stderr)
-            context_text = "\n\n".join([doc.page_content for doc in results])
-
-            # Generate extraction with Gemini
-            model = genai.GenerativeModel('gemini-2.5-pro')
-            prompt = f"""
-            Extract the following insurance plan details from the context:
-            1. Insurance Company Name
-            2. Plan Name
-            3. Policy Number (Member ID, Subscriber ID, or Policy ID)
-               - Look for alphanumeric codes (e.g., "COINDEPO...", "MIEP...", etc.) that appear near the plan name or in headers/footers.
-               - If a code like "COINDEPO052023" is prominent, it is likely the policy number.
-
-            Context:
-            ---
-            {context_text}
-            ---
-
-            Return ONLY a JSON object with keys: 'insuranceCompany', 'planName', 'policyNumber'.
-            If a field is not found, use "Unknown".
-            """
-            
-            response = model.generate_content(prompt)
-            try:
-                json_str = response.text.strip().replace('```json', '').replace('```', '')
-                print(f"DEBUG: Raw Gemini response: {json_str[:200]}...", file=sys.stderr)
-                parsed_json = json.loads(json_str)
-                print(json.dumps(parsed_json))
-            except json.JSONDecodeError as e:
-                print(f"JSON Parse Error: {e}", file=sys.stderr)
-                print(json.dumps({"error": "Failed to parse extraction result", "raw": response.text, "details": str(e)}))
-            except Exception as e:
-                print(f"Unexpected error: {e}", file=sys.stderr)
-                print(json.dumps({"error": "Extraction failed", "details": str(e), "raw_response": response.text if hasattr(response, 'text') else "no response"}))
+    routed = route_generation("denial_extract", prompt)
+    print(f"DEBUG: Raw Gemini response ({routed['model']}): {routed['text'][:200]}...", file=sys.stderr)
+    if routed["data"] is None:
+        print(f"JSON Parse Error: {routed['problem']}", file=sys.stderr)
+        return {"error": "Failed to parse denial extraction result", "raw": routed["text"], "details": routed["problem"]}
+    return routed["data"]
 
-        elif args.mode == "denial_extract":
-            if not args.files:
-                print(json.dumps({"error": "No files provided for denial extraction"}))
-                return
+def summarize_email_thread(previous_summary: str, new_messages: str) -> str:
+    """Fold newly-older thread messages into the rolling thread summary."""
+    prompt = f"""
+    You maintain a running summary of an insurance appeal email thread for the lawyer handling it.
+    Update the summary with the new messages below. Keep every fact that matters for the appeal:
+    dates, what each side claimed or requested, deadlines, reference numbers, weaknesses identified
+    and actions agreed. Be concise and write plain text only.
 
-            print(f"Extracting denial brief description from {len(args.files)} files...", file=sys.stderr)
-            docs = []
-            for file_path in args.files:
-                try:
-                    loader = PyPDFLoader(file_path)
-                    docs.extend(loader.load())
-                except Exception as e:
-                    print(f"Error loading PDF {file_path}: {e}", file=sys.stderr)
+    Current summary:
+    ---
+    {previous_summary or "(none yet)"}
+    ---
 
-            if not docs:
-                print(json.dumps({"error": "Failed to load any documents"}))
-                return
+    New messages:
+    ---
+    {new_messages}
+    ---
 
-            # Split text
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
-            chunks = text_splitter.split_documents(docs)
-            print(f"DEBUG: Split denial files into {len(chunks)} chunks", file=sys.stderr)
-            if chunks:
-                print(f"DEBUG: First chunk preview: {chunks[0].page_content[:200]}...", file=sys.stderr)
-            
-            # Create temporary vector store
-            print("DEBUG: Creating embeddings for denial extraction...", file=sys.stderr)
-            embedding_function = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-            print("DEBUG: Adding denial documents to ChromaDB...", file=sys.stderr)
-            db = Chroma.from_documents(documents=chunks, embedding=embedding_function)
-            print(f"DEBUG: ChromaDB created successfully with {len(chunks)} denial documents", file=sys.stderr)
-
-            # Query for denial details
-            query = "denial reason"
-            print(f"DEBUG: Querying ChromaDB with: '{query}'", file=sys.stderr)
-            results = db.similarity_search(query, k=10)
-            print(f"DEBUG: Retrieved {len(results)} results from ChromaDB", file=sys.stderr)
-            for i, doc in enumerate(results):
-                print(f"DEBUG: Result {i+1} preview: {doc.page_content[:150]}...", file=sys.stderr)
-            context_text = "\n\n".join([doc.page_content for doc in results])
-
-            # Generate brief description with Gemini
-            model = genai.GenerativeModel('gemini-2.5-pro')
-            prompt = f"""
-            Based on the following denial letter or hospital bill content, create a brief 1-sentence description of the issue.
-            Focus on:
-            1. The specific service/treatment that was denied or billed
-            2. The reason for denial (if mentioned)
-            3. Keep it under 15 words
-            
-            Context:
-            ---
-            {context_text}
-            ---
-            
-            Return ONLY a JSON object with key: 'briefDescription'.
-            Example: {{"briefDescription": "ER visit for chest pain denied as not medically necessary"}}
-            """
-            
-            response = model.generate_content(prompt)
-            try:
-                json_str = response.text.strip().replace('```json', '').replace('```', '')
-                print(f"DEBUG: Raw Gemini response: {json_str[:200]}...", file=sys.stderr)
-                parsed_json = json.loads(json_str)
-                print(json.dumps(parsed_json))
-            except json.JSONDecodeError as e:
-                print(f"JSON Parse Error: {e}", file=sys.stderr)
-                print(json.dumps({"error": "Failed to parse denial extraction result", "raw": response.text, "details": str(e)}))
-            except Exception as e:
-                print(f"Unexpected error: {e}", file=sys.stderr)
-                print(json.dumps({"error": "Denial extraction failed", "details": str(e), "raw_response": response.text if hasattr(response, 'text') else "no response"}))
+    Return only the updated summary.
+    """
+    from model_router import MODEL_FAST
+    return generate_text(MODEL_FAST, prompt)
 
-        elif args.mode == "email_draft":
-            if not args.caseId or not args.userId:
-                print(json.dumps({"error": "caseId and userId are required for email_draft mode"}))
-                return
+def email_thread_context(case_id: str, emails: List[Dict[str, Any]], stored_summary: Dict[str, Any] = None) -> str:
+    """
+    Token-budgeted thread section for a prompt (see thread_context). If older
+    messages had to be summarised, the new rolling summary is saved on the
+    case as emailThreadSummary so the next request can reuse it.
+    """
+    from thread_context import build_thread_context
+    context, updated = build_thread_context(emails, stored_summary, summarize_email_thread)
+    if updated is not None:
+        try:
+            get_collection("cases").update_one({"id": case_id}, {"$set": {"emailThreadSummary": updated}})
+            print(f"Stored thread summary covering {updated['messageCount']} message(s)", file=sys.stderr)
+        except Exception as e:
+            print(f"Warning: Failed to store thread summary: {e}", file=sys.stderr)
+    return context
 
-            # 1. Get Vector Store (Load existing or create if missing)
-            db = get_vector_store(args.caseId, args.userId, force_refresh=False)
-            
-            if not db:
-                print(json.dumps({"error": "Failed to load or create vector store"}))
-                return
+def run_email_draft(
+    case_id: str = None,
+    user_id: str = None,
+    files: List[str] = None,
+    on_delta: Callable[[str], None] = None,
+    relevant_context: List[str] = None,
+) -> Dict[str, Any]:
+    if not case_id or not user_id:
+        return {"error": "caseId and userId are required for email_draft mode"}
 
-            # 4. Retrieval (same query as analysis)
-            query = "denial reason policy coverage exclusions"
-            print(f"Querying: {query}", file=sys.stderr)
-            
-            results = db.similarity_search_with_relevance_scores(query, k=10)
-            print(f"Retrieved {len(results)} results from ChromaDB", file=sys.stderr)
-            
-            relevant_context = []
-            for doc, score in results:
-                print(f"Score: {score}", file=sys.stderr)
-                if score >= 0.0:
-                    relevant_context.append(doc.page_content)
-            
-            if not relevant_context:
-                print(json.dumps({"error": "No relevant policy sections found for email generation."}))
-                return
+    from thread_context import fit_to_budget, ANALYSIS_CONTEXT_TOKEN_BUDGET
 
-            context_text = "\n\n".join(relevant_context)
+    if relevant_context is None:
+        # 1. Get Vector Store (Load existing or create if missing)
+        db = get_vector_store(case_id, user_id, force_refresh=False)
 
-            # 5. Generate Email Draft
-            print("Generating email draft with Gemini...", file=sys.stderr)
-            
-            # Fetch email thread from Case
-            email_context = ""
-            analysis_context = ""
-            try:
-                db = get_db_connection()
-                
-                # Try to find the case in the 'cases' collection
-                case_collection = None
-                if 'cases' in db.list_collection_names():
-                    case_collection = db.cases
-                
-                case_doc = None
-                if case_collection is not None:
-                    case_doc = case_collection.find_one({"id": args.caseId})
-                
-                if case_doc:
-                    if 'emailThread' in case_doc and case_doc['emailThread']:
-                        print(f"Found {len(case_doc['emailThread'])} emails in thread", file=sys.stderr)
-                        email_context = "Previous Email Communication:\n"
-                        for email in case_doc['emailThread']:
-                            email_context += f"--- {email.get('type', 'unknown').upper()} ---\n"
-                            email_context += f"From: {email.get('from', 'Unknown')}\n"
-                            email_context += f"Subject: {email.get('subject', 'No Subject')}\n"
-                            email_context += f"Body: {email.get('body', '')[:1000]}...\n" # Truncate body
-                            if 'analysis' in email and email['analysis']:
-                                email_context += f"Analysis Weaknesses: {', '.join(email['analysis'].get('weaknesses', []))}\n"
-                            email_context += "\n"
-
-                    # Fetch Denial Analysis
-                    if 'analysis' in case_doc and case_doc['analysis']:
-                        analysis_data = case_doc['analysis']
-                        analysis_context = "PREVIOUS DENIAL ANALYSIS (Use this to build your argument):\n"
-                        if 'analysis' in analysis_data:
-                            analysis_context += f"Analysis/Explanation: {analysis_data['analysis']}\n"
-                else:
-                    print(f"Case {args.caseId} not found in database", file=sys.stderr)
+        if not db:
+            return {"error": "Failed to load or create vector store"}
 
-            except Exception as e:
-                print(f"Warning: Failed to fetch case details: {e}", file=sys.stderr)
+        # 4. Retrieval (same sub-queries as analysis)
+        relevant_context = retrieve_case_context(db)
 
-            model = genai.GenerativeModel('gemini-2.5-pro')
-            
-            email_prompt = f"""
-            Draft the body paragraphs for a professional appeal email to the insurance company based on the context.
-            
-            **ROLE & PERSONA**:
-            You are a specialized Health Insurance Denial Lawyer acting on behalf of your client (the insured). 
-            Your tone should be professional, firm, authoritative, and legally grounded. Do not be aggressive, but be assertive.
-            
-            **INSTRUCTIONS**:
-            1. **OUTPUT ONLY THE BODY PARAGRAPHS**. Do NOT include a salutation or an introduction (e.g., "Dear X") and do NOT include a sign-off (e.g., "Sincerely Y"). These will be added by a template.
-            2. Start directly with what the denied coverage was and the argument.
-            3. Reference the specific policy sections and medical necessity criteria found in the context.
-            4. If there is previous email communication, directly address the points raised in the last received email.
-            5. **CRITICAL**: Use the "PREVIOUS DENIAL ANALYSIS" section to identify weaknesses in the insurer's denial and build your counter-argument. The analysis provides a layman's explanation of why the denial might be invalid—translate this into professional legal arguments.
-            6. Demand a specific remedy (e.g., "immediate reversal of the denial", "authorization of the service").
-            
-            **EXTRACTION**:
-            Also extract the following details from the context if available:
-            - **Denial Date**: The date of the adverse benefit determination letter.
-            - **Procedure Name**: The specific name of the procedure or treatment that was denied.
-            
-            Context:
-            ---
-            {context_text}
-            ---
-            
-            {analysis_context}
-            
-            {email_context}
-            
-            Return the output as a JSON object with keys:
-            - 'body': The body paragraphs of the email.
-            """
-            
-            print("Calling Gemini for email draft...", file=sys.stderr)
-            email_response = model.generate_content(email_prompt)
+    if not relevant_context:
+        return {"error": "No relevant policy sections found for email generation."}
 
-            # Parse Email Response
-            try:
-                # robust JSON extraction
-                text = email_response.text.strip()
-                start_idx = text.find('{')
-                end_idx = text.rfind('}')
-                
-                if start_idx != -1 and end_idx != -1:
-                    json_str = text[start_idx:end_idx+1]
-                    email_json = json.loads(json_str)
-                else:
-                     raise ValueError("No JSON object found in response")
+    context_text = "\n\n".join(relevant_context)
 
-            except Exception as e:
-                print(f"Failed to parse email JSON: {e}", file=sys.stderr)
-                # Fallback
-                email_json = {
-                    "subject": "Appeal for Denial", 
-                    "body": email_response.text.replace('```json', '').replace('```', '').strip(),
-                    "denial_date": "[Date of Denial Letter]",
-                    "procedure_name": "[Name of Procedure/Treatment]"
-                }
-
-            # Construct Final Output
-            output = {
-                "emailDraft": email_json
-            }
-
-            print("Successfully generated email draft", file=sys.stderr)
-            print(json.dumps(output))
-
-        elif args.mode == "email_analysis":
-            if not args.files:
-                print(json.dumps({"error": "No file provided for email analysis"}))
-                return
+    # 5. Generate Email Draft
+    print("Generating email draft with Gemini...", file=sys.stderr)
+
+    # Fetch email thread from Case
+    email_context = ""
+    analysis_context = ""
+    try:
+        # Reuses the cached connection and collection name from retrieval above
+        case_collection = get_collection("cases")
+
+        case_doc = None
+        if case_collection is not None:
+            case_doc = case_collection.find_one(
+                {"id": case_id},
+                {"_id": 0, "emailThread": 1, "emailThreadSummary": 1, "analysis.analysis": 1},
+            )
+
+        if case_doc:
+            if 'emailThread' in case_doc and case_doc['emailThread']:
+                print(f"Found {len(case_doc['emailThread'])} emails in thread", file=sys.stderr)
+                email_context = "Previous Email Communication:\n" + email_thread_context(
+                    case_id, case_doc['emailThread'], case_doc.get('emailThreadSummary')
+                )
+
+            # Fetch Denial Analysis
+            if 'analysis' in case_doc and case_doc['analysis']:
+                analysis_data = case_doc['analysis']
+                analysis_context = "PREVIOUS DENIAL ANALYSIS (Use this to build your argument):\n"
+                if 'analysis' in analysis_data:
+                    analysis_context += f"Analysis/Explanation: {fit_to_budget(analysis_data['analysis'], ANALYSIS_CONTEXT_TOKEN_BUDGET)}\n"
+        else:
+            print(f"Case {case_id} not found in database", file=sys.stderr)
+
+    except Exception as e:
+        print(f"Warning: Failed to fetch case details: {e}", file=sys.stderr)
+
+    email_prompt = f"""
+    Draft the body paragraphs for a professional appeal email to the insurance company based on the context.
+
+    **ROLE & PERSONA**:
+    You are a specialized Health Insurance Denial Lawyer acting on behalf of your client (the insured).
+    Your tone should be professional, firm, authoritative, and legally grounded. Do not be aggressive, but be assertive.
+
+    **INSTRUCTIONS**:
+    1. **OUTPUT ONLY THE BODY PARAGRAPHS**. Do NOT include a salutation or an introduction (e.g., "Dear X") and do NOT include a sign-off (e.g., "Sincerely Y"). These will be added by a template.
+    2. Start directly with what the denied coverage was and the argument.
+    3. Reference the specific policy sections and medical necessity criteria found in the context.
+    4. If there is previous email communication, directly address the points raised in the last received email.
+    5. **CRITICAL**: Use the "PREVIOUS DENIAL ANALYSIS" section to identify weaknesses in the insurer's denial and build your counter-argument. The analysis provides a layman's explanation of why the denial might be invalid—translate this into professional legal arguments.
+    6. Demand a specific remedy (e.g., "immediate reversal of the denial", "authorization of the service").
+
+    **EXTRACTION**:
+    Also extract the following details from the context if available:
+    - **Denial Date**: The date of the adverse benefit determination letter.
+    - **Procedure Name**: The specific name of the procedure or treatment that was denied.
+
+    Context:
+    ---
+    {context_text}
+    ---
+
+    {analysis_context}
+
+    {email_context}
+
+    Return the output as a JSON object with keys:
+    - 'body': The body paragraphs of the email.
+    """
+
+    print("Calling Gemini for email draft...", file=sys.stderr)
+    routed = route_generation("email_draft", email_prompt, on_delta=on_delta)
+    email_json = routed["data"]
+
+    if email_json is None:
+        print(f"Failed to parse email JSON: {routed['problem']}", file=sys.stderr)
+        # Fallback
+        email_json = {
+            "subject": "Appeal for Denial",
+            "body": routed["text"].strip(),
+            "denial_date": "[Date of Denial Letter]",
+            "procedure_name": "[Name of Procedure/Treatment]"
+        }
+
+    print("Successfully generated email draft", file=sys.stderr)
+    return {
+        "emailDraft": email_json
+    }
+
+def run_email_analysis(case_id: str = None, user_id: str = None, files: List[str] = None) -> Dict[str, Any]:
+    if not files:
+        return {"error": "No file provided for email analysis"}
+
+    # Read email content from file
+    try:
+        with open(files[0], 'r') as f:
+            email_content = f.read()
+    except Exception as e:
+        return {"error": f"Failed to read email file: {e}"}
+
+    print("Analyzing email content with Gemini...", file=sys.stderr)
+
+    prompt = f"""
+    You are an expert legal assistant for health insurance appeals.
+    Analyze the following incoming email from an insurance company or provider.
+
+    Email Content:
+    ---
+    {email_content}
+    ---
 
-            # Read email content from file
+    1. Summarize the email in simple layman's terms.
+    2. Identify any weaknesses in their argument or points that are vague/unsupported.
+    3. Identify any confusing terms and define them. **CRITICAL: The 'term' MUST be an EXACT substring found in the email content above. Do not rephrase the term.**
+    4. Suggest 2-3 concrete action items for the user.
+
+    Return the output as a JSON object with keys:
+    - 'summary': string
+    - 'weaknesses': list of strings
+    - 'terms': list of objects {{ 'term': string, 'definition': string }} (term must be exact match from text)
+    - 'actionItems': list of strings
+    """
+
+    try:
+        routed = route_generation("email_analysis", prompt)
+    except Exception as e:
+        print(f"Error analyzing email: {e}", file=sys.stderr)
+        return {"error": str(e)}
+    if routed["data"] is None:
+        print(f"Error analyzing email: {routed['problem']}", file=sys.stderr)
+        return {"error": routed["problem"]}
+    return routed["data"]
+
+def run_analysis(
+    case_id: str = None,
+    user_id: str = None,
+    files: List[str] = None,
+    on_delta: Callable[[str], None] = None,
+    relevant_context: List[str] = None,
+) -> Dict[str, Any]:
+    if not case_id or not user_id:
+        return {"error": "caseId and userId are required for analysis mode"}
+
+    if relevant_context is None:
+        # 1. Get Vector Store (Load existing or create if missing)
+        db = get_vector_store(case_id, user_id, force_refresh=False)
+
+        if not db:
+            return {"error": "Failed to load or create vector store"}
+
+        # 4. Retrieval: concurrent sub-queries fused by reciprocal rank
+        relevant_context = retrieve_case_context(db)
+
+    # User requested strict 0.7, but often cosine similarity with MiniLM is lower.
+    # I'll keep it loose for now to ensure we get *some* output for the demo,
+    # but logically we should filter. Let's try to respect the user's wish but fallback if empty.
+    if not relevant_context:
+         print(json.dumps({"error": "No relevant policy sections found with high confidence."}), file=sys.stderr)
+         # return # Don't return early for now to ensure we generate something for the user to see
+
+    context_text = "\n\n".join(relevant_context)
+
+    # 5. Generation (Gemini)
+    print("Generating analysis with Gemini...", file=sys.stderr)
+
+    combined_prompt = f"""
+    You are an expert health insurance lawyer. Analyze the following context from the user's policy and denial letter/hospital bills.
+
+    Context:
+    ---
+    {context_text}
+    ---
+
+    **INSTRUCTIONS**:
+    1. **Analyze**: Explain in simple layman's terms why the coverage was denied based on the provided text. Focus on specific policy sections. Point out unsupported statements or weaknesses.
+       - **TONE**: Address the user directly as "you" (2nd Person POV). Do not use "the member" or the patient's name.
+       - Start directly with the analysis. No filler ("Of course", "As an expert").
+       - No markdown formatting (no #, **, *). Use standard paragraphs.
+       - No disclaimer.
+
+    2. **Identify Terms**: Identify **complex legal jargon** or specific insurance definitions *that appear in your analysis above* and explain them in simple layman's terms.
+       - **FOCUS**: Prioritize legal/insurance terms (e.g., "adverse benefit determination", "clinical contraindication", "prior authorization").
+       - **EXCLUDE**: Common medical terms (e.g., "imaging", "fracture", "x-ray") unless they are critical to the specific legal reason for denial.
+       - CRITICAL: The 'term' MUST be an EXACT substring found in your generated analysis text.
+
+    Return a SINGLE JSON object with the following structure:
+    {{
+        "analysis": "The full text of your analysis...",
+        "terms": [
+            {{ "term": "Exact Term", "definition": "Simple definition" }}
+        ]
+    }}
+    """
+
+    print("Calling Gemini for analysis and terms...", file=sys.stderr)
+    routed = route_generation("analysis", combined_prompt, on_delta=on_delta)
+
+    if routed["data"] is not None:
+        analysis_text = routed["data"].get("analysis", "")
+        terms_json = routed["data"].get("terms", [])
+    else:
+        print(f"Failed to parse combined JSON: {routed['problem']}", file=sys.stderr)
+        # Fallback: use the raw text as analysis
+        analysis_text = routed["text"].strip()
+        terms_json = []
+
+    print("Successfully generated analysis output", file=sys.stderr)
+    # Construct Final Output (without email draft)
+    return {
+        "analysis": analysis_text,
+        "terms": terms_json,
+        "contextUsed": relevant_context
+    }
+
+def run_generate_followup(case_id: str = None, user_id: str = None, files: List[str] = None) -> Dict[str, Any]:
+    if not case_id or not user_id:
+        return {"error": "caseId and userId are required for generate_followup mode"}
+
+    # 1. Get Vector Store (Load existing or create if missing)
+    db = get_vector_store(case_id, user_id, force_refresh=False)
+
+    if not db:
+        return {"error": "Failed to load or create vector store"}
+
+    # 4. Retrieval
+    # We want to find policy sections relevant to the denial
+    relevant_context = retrieve_case_context(db)
+    context_text = "\n\n".join(relevant_context)
+
+    # 5. Load Email History: the case's thread (latest messages verbatim,
+    # older ones as the stored rolling summary); the history file the server
+    # passes is only a fallback and is capped to the same total budget.
+    from thread_context import fit_to_budget, THREAD_RECENT_TOKEN_BUDGET, THREAD_SUMMARY_TOKEN_BUDGET
+    email_history = ""
+    try:
+        case_doc = get_collection("cases").find_one(
+            {"id": case_id},
+            {"_id": 0, "emailThread": 1, "emailThreadSummary": 1},
+        )
+        if case_doc and case_doc.get("emailThread"):
+            email_history = email_thread_context(case_id, case_doc["emailThread"], case_doc.get("emailThreadSummary"))
+    except Exception as e:
+        print(f"Warning: Failed to load email thread from case: {e}", file=sys.stderr)
+
+    if not email_history and files:
+        try:
+            with open(files[0], 'r') as f:
+                email_history = fit_to_budget(f.read(), THREAD_RECENT_TOKEN_BUDGET + THREAD_SUMMARY_TOKEN_BUDGET)
+        except Exception as e:
+            print(f"Warning: Failed to read email history file: {e}", file=sys.stderr)
+
+    # 6. Generate Follow-up
+    print("Generating follow-up email...", file=sys.stderr)
+
+    prompt = f"""
+    You are an expert health insurance lawyer representing a patient.
+    Your goal is to write a persuasive follow-up email to the insurance company to appeal a claim denial.
+
+    **CRITICAL INSTRUCTIONS TO PREVENT HALLUCINATION**:
+    1. You must ONLY use facts and policy details explicitly present in the "Context" section below.
+    2. Do NOT invent policy section numbers, coverage limits, or medical criteria. If it's not in the text, do not mention it.
+    3. If the provided context does not contain specific policy clauses, focus on general arguments about medical necessity and the lack of clear explanation in their denial, rather than making up policy language.
+    4. Directly address the points raised in the "Email History".
+    5. **CRITICAL**: Pay close attention to the "[INTERNAL ANALYSIS]" sections in the Email History. Use the "Weaknesses Identified" to counter their arguments and incorporate the "Recommended Actions" into your requests.
+
+    Context (Policy & Denial Details):
+    ---
+    {context_text}
+    ---
+
+    Email History (with Internal Analysis):
+    ---
+    {email_history}
+    ---
+
+    Drafting Guidelines:
+    1. Professional, firm, and persuasive tone.
+    2. Clearly state the patient's name and policy number if available in the context.
+    3. Demand specific actions (e.g., "immediate re-evaluation", "provide specific policy language relying on").
+    4. Keep the email concise but legally grounded.
+
+    Return the output as a JSON object with keys:
+    - 'subject': string (The subject line for the email)
+    - 'body': string (The body of the email)
+    """
+
+    try:
+        routed = route_generation("generate_followup", prompt)
+    except Exception as e:
+        print(f"Error generating follow-up: {e}", file=sys.stderr)
+        return {"error": str(e)}
+    if routed["data"] is None:
+        print(f"Error generating follow-up: {routed['problem']}", file=sys.stderr)
+        return {"error": routed["problem"]}
+    return routed["data"]
+
+def run_case_pipeline(case_id: str = None, user_id: str = None, files: List[str] = None) -> Dict[str, Any]:
+    """
+    ingest + analysis + email_draft in one process: sync the stores, retrieve
+    once, then generate the analysis and the email draft concurrently from
+    the same context.
+
+    The draft runs alongside the analysis, so it builds on whatever analysis
+    was previously stored on the case rather than the one generated here.
+    """
+    if not case_id or not user_id:
+        return {"error": "caseId and userId are required for case_pipeline mode"}
+
+    db = get_vector_store(case_id, user_id, force_refresh=True)
+    if not db:
+        return {"error": "Ingestion failed - no documents found"}
+    ingest = {"success": True, "message": "Ingestion complete"}
+
+    relevant_context = retrieve_case_context(db)
+
+    def guarded(handler):
+        try:
+            return handler(case_id=case_id, user_id=user_id, relevant_context=relevant_context)
+        except Exception as e:
+            print(f"Pipeline Error in {handler.__name__}: {e}", file=sys.stderr)
+            return {"error": str(e)}
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        analysis = pool.submit(guarded, run_analysis)
+        email = pool.submit(guarded, run_email_draft)
+        return {"ingest": ingest, "analysis": analysis.result(), "email": email.result()}
+
+def analyze_cases(case_ids: List[str], user_id: str) -> Dict[str, Any]:
+    """
+    Re-run analysis for many cases in one process, sharing the embedding
+    model, Mongo client and Chroma store across them. Cases are synced and
+    retrieved BATCH_INGEST_CONCURRENCY at a time; each one's Gemini call is
+    queued as soon as its context is ready, BATCH_GEMINI_CONCURRENCY at a
+    time, under the shared Gemini client's rate limits. Successful analyses are
+    written back to the cases in one bulk_write.
+
+    Only `user_id`'s cases are read or written; other ids are reported as not found.
+    """
+    from pymongo import UpdateOne
+
+    if not user_id:
+        return {"error": "userId is required for batch analysis"}
+    start = time.perf_counter()
+    case_ids = list(dict.fromkeys(c for c in case_ids if c))
+    cases = get_collection("cases")
+    if cases is None:
+        return {"error": "cases collection not found"}
+    found = cases.find({"id": {"$in": case_ids}, "userId": user_id}, {"_id": 0, "id": 1})
+    owned = [doc["id"] for doc in found]
+
+    results: Dict[str, Dict[str, Any]] = {
+        case_id: {"error": "Case not found"} for case_id in case_ids if case_id not in owned
+    }
+    analyses: Dict[str, Dict[str, Any]] = {}
+
+    def prepare(case_id: str) -> List[str]:
+        db = get_vector_store(case_id, user_id, force_refresh=True)
+        if not db:
+            raise ValueError("No documents found")
+        return retrieve_case_context(db)
+
+    def analyze(case_id: str, relevant_context: List[str]) -> Dict[str, Any]:
+        return run_analysis(case_id=case_id, user_id=user_id, relevant_context=relevant_context)
+
+    with ThreadPoolExecutor(max_workers=max(1, BATCH_INGEST_CONCURRENCY), thread_name_prefix="batch-ingest") as ingest_pool, \
+            ThreadPoolExecutor(max_workers=max(1, BATCH_GEMINI_CONCURRENCY), thread_name_prefix="batch-gemini") as gemini_pool:
+        pending = {ingest_pool.submit(prepare, case_id): case_id for case_id in owned}
+        generating = {}
+        for future in as_completed(pending):
+            case_id = pending[future]
             try:
-                with open(args.files[0], 'r') as f:
-                    email_content = f.read()
+                generating[gemini_pool.submit(analyze, case_id, future.result())] = case_id
             except Exception as e:
-                print(json.dumps({"error": f"Failed to read email file: {e}"}))
-                return
-
-            print("Analyzing email content with Gemini...", file=sys.stderr)
-            model = genai.GenerativeModel('gemini-2.5-pro')
-            
-            prompt = f"""
-            You are an expert legal assistant for health insurance appeals.
-            Analyze the following incoming email from an insurance company or provider.
-            
-            Email Content:
-            ---
-            {email_content}
-            ---
-            
-            1. Summarize the email in simple layman's terms.
-            2. Identify any weaknesses in their argument or points that are vague/unsupported.
-            3. Identify any confusing terms and define them. **CRITICAL: The 'term' MUST be an EXACT substring found in the email content above. Do not rephrase the term.**
-            4. Suggest 2-3 concrete action items for the user.
-            
-            Return the output as a JSON object with keys:
-            - 'summary': string
-            - 'weaknesses': list of strings
-            - 'terms': list of objects {{ 'term': string, 'definition': string }} (term must be exact match from text)
-            - 'actionItems': list of strings
-            """
-            
+                print(f"Batch analysis: ingest failed for case {case_id}: {e}", file=sys.stderr)
+                results[case_id] = {"error": str(e)}
+        for future in as_completed(generating):
+            case_id = generating[future]
             try:
-                response = model.generate_content(prompt)
-                json_str = response.text.strip().replace('```json', '').replace('```', '')
-                parsed_json = json.loads(json_str)
-                print(json.dumps(parsed_json))
+                output = future.result()
             except Exception as e:
-                print(f"Error analyzing email: {e}", file=sys.stderr)
-                print(json.dumps({"error": str(e)}))
+                output = {"error": str(e)}
+            if output.get("error"):
+                print(f"Batch analysis: case {case_id} failed: {output['error']}", file=sys.stderr)
+                results[case_id] = {"error": output["error"]}
+            else:
+                analyses[case_id] = output
+                results[case_id] = {"success": True}
 
-        elif args.mode == "analysis":
-            if not args.caseId or not args.userId:
-                print(json.dumps({"error": "caseId and userId are required for analysis mode"}))
-                return
+    # written: cases the update matched, including re-analyses identical to the
+    # stored one (e.g. served from the LLM cache); changed: those whose analysis differed
+    written = changed = 0
+    if analyses:
+        write = cases.bulk_write(
+            [
+                UpdateOne({"id": case_id, "userId": user_id}, {"$set": {"analysis": output}})
+                for case_id, output in analyses.items()
+            ],
+            ordered=False,
+        )
+        written, changed = write.matched_count, write.modified_count
 
-            # 1. Get Vector Store (Load existing or create if missing)
-            db = get_vector_store(args.caseId, args.userId, force_refresh=False)
-            
-            if not db:
-                print(json.dumps({"error": "Failed to load or create vector store"}))
-                return
+    failed = sum(1 for r in results.values() if r.get("error"))
+    elapsed = time.perf_counter() - start
+    print(
+        f"Batch analysis: {len(analyses)}/{len(case_ids)} cases analysed, {written} written "
+        f"({changed} changed) in {elapsed:.1f}s",
+        file=sys.stderr,
+    )
+    return {
+        "success": failed == 0,
+        "requested": len(case_ids),
+        "analysed": len(analyses),
+        "failed": failed,
+        "written": written,
+        "changed": changed,
+        "seconds": round(elapsed, 2),
+        "results": results,
+    }
 
-            # 4. Retrieval
-            query = "denial reason policy coverage exclusions"
-            print(f"Querying: {query}", file=sys.stderr)
-            
-            results = db.similarity_search_with_relevance_scores(query, k=10)
-            print(f"DEBUG: Retrieved {len(results)} results from ChromaDB", file=sys.stderr)
-            
-            relevant_context = []
-            for doc, score in results:
-                print(f"Score: {score}", file=sys.stderr)
-                if score >= 0.0: # Threshold adjusted for testing, user asked for 0.7 but MiniLM scores can be lower
-                    relevant_context.append(doc.page_content)
-            
-            # User requested strict 0.7, but often cosine similarity with MiniLM is lower. 
-            # I'll keep it loose for now to ensure we get *some* output for the demo, 
-            # but logically we should filter. Let's try to respect the user's wish but fallback if empty.
-            if not relevant_context:
-                 print(json.dumps({"error": "No relevant policy sections found with high confidence."}), file=sys.stderr)
-                 # return # Don't return early for now to ensure we generate something for the user to see
-
-            context_text = "\n\n".join(relevant_context)
-
-            # 5. Generation (Gemini)
-            print("Generating analysis with Gemini...", file=sys.stderr)
-            model = genai.GenerativeModel('gemini-2.5-flash')
-            
-            combined_prompt = f"""
-            You are an expert health insurance lawyer. Analyze the following context from the user's policy and denial letter/hospital bills.
-            
-            Context:
-            ---
-            {context_text}
-            ---
-            
-            **INSTRUCTIONS**:
-            1. **Analyze**: Explain in simple layman's terms why the coverage was denied based on the provided text. Focus on specific policy sections. Point out unsupported statements or weaknesses.
-               - **TONE**: Address the user directly as "you" (2nd Person POV). Do not use "the member" or the patient's name.
-               - Start directly with the analysis. No filler ("Of course", "As an expert").
-               - No markdown formatting (no #, **, *). Use standard paragraphs.
-               - No disclaimer.
-            
-            2. **Identify Terms**: Identify **complex legal jargon** or specific insurance definitions *that appear in your analysis above* and explain them in simple layman's terms.
-               - **FOCUS**: Prioritize legal/insurance terms (e.g., "adverse benefit determination", "clinical contraindication", "prior authorization").
-               - **EXCLUDE**: Common medical terms (e.g., "imaging", "fracture", "x-ray") unless they are critical to the specific legal reason for denial.
-               - CRITICAL: The 'term' MUST be an EXACT substring found in your generated analysis text.
-            
-            Return a SINGLE JSON object with the following structure:
-            {{
-                "analysis": "The full text of your analysis...",
-                "terms": [
-                    {{ "term": "Exact Term", "definition": "Simple definition" }}
-                ]
-            }}
-            """
-            
-            print("Calling Gemini for analysis and terms...", file=sys.stderr)
-            response = model.generate_content(combined_prompt)
-            
-            try:
-                # robust JSON extraction with brace counting
-                text = response.text.strip()
-                start_idx = text.find('{')
-                
-                if start_idx != -1:
-                    # Count braces to find the matching closing brace
-                    count = 0
-                    end_idx = -1
-                    for i, char in enumerate(text[start_idx:], start=start_idx):
-                        if char == '{':
-                            count += 1
-                        elif char == '}':
-                            count -= 1
-                            if count == 0:
-                                end_idx = i
-                                break
-                    
-                    if end_idx != -1:
-                        json_str = text[start_idx:end_idx+1]
-                        parsed_output = json.loads(json_str)
-                        analysis_text = parsed_output.get("analysis", "")
-                        terms_json = parsed_output.get("terms", [])
-                    else:
-                        raise ValueError("No matching closing brace found")
-                else:
-                    raise ValueError("No JSON object found in response")
-                    
-            except Exception as e:
-                print(f"Failed to parse combined JSON: {e}", file=sys.stderr)
-                # Fallback: use the whole text as analysis if it doesn't look like JSON
-                # If we have the raw text but failed to parse JSON, use raw text as analysis
-                analysis_text = response.text.replace('```json', '').replace('```', '').strip()
-                terms_json = []
-
-            # Construct Final Output (without email draft)
-            output = {
-                "analysis": analysis_text,
-                "terms": terms_json,
-                "contextUsed": relevant_context
-            }
-
-            print("Successfully generated analysis output", file=sys.stderr)
-            print(json.dumps(output))
-
-        elif args.mode == 'email_analysis':
-            if not args.files:
-                print(json.dumps({"error": "No files provided for email analysis"}))
+def run_batch_analysis(case_id: str = None, user_id: str = None, files: List[str] = None) -> Dict[str, Any]:
+    """analysis for several of a user's cases at once: --caseId takes a comma-separated list of case ids."""
+    case_ids = [c.strip() for c in (case_id or "").split(",") if c.strip()]
+    if not case_ids or not user_id:
+        return {"error": "caseId (comma-separated case ids) and userId are required for batch_analysis mode"}
+    return analyze_cases(case_ids, user_id=user_id)
+
+def run_migrate_stores(case_id: str = None, user_id: str = None, files: List[str] = None) -> Dict[str, Any]:
+    """Move every legacy chroma_db_* directory into the shared store in one go."""
+    result = migrate_legacy_stores()
+    print(f"Store migration: {result['migrated']} migrated, {result['failed']} failed", file=sys.stderr)
+    return {"success": result["failed"] == 0, **result}
+
+def run_gc(case_id: str = None, user_id: str = None, files: List[str] = None) -> Dict[str, Any]:
+    """Evict stale, oversized and closed-case vector stores and report what was reclaimed."""
+    return {"success": True, **collect_store_garbage()}
+
+# Mode name -> handler. Every handler takes (case_id, user_id, files) and returns
+# the JSON-serialisable payload that the CLI prints to stdout.
+MODE_HANDLERS = {
+    "analysis": run_analysis,
+    "extraction": run_extraction,
+    "denial_extract": run_denial_extract,
+    "email_draft": run_email_draft,
+    "email_analysis": run_email_analysis,
+    "generate_followup": run_generate_followup,
+    "ingest": run_ingest,
+    "case_pipeline": run_case_pipeline,
+    "batch_analysis": run_batch_analysis,
+    "migrate_stores": run_migrate_stores,
+    "gc": run_gc,
+}
+
+# Modes whose handler accepts on_delta and can stream Gemini output as it arrives
+STREAMING_MODES = {"analysis", "email_draft"}
+
+def _embedding_imports() -> List[str]:
+    if os.getenv("EMBEDDING_BACKEND", "torch").strip().lower().startswith("onnx"):
+        return ["embedding_cache", "embedding_engine", "onnxruntime", "tokenizers"]
+    return ["embedding_cache", "embedding_engine", "langchain_huggingface"]
+
+_RETRIEVAL_IMPORTS = ["pymongo", "supabase", "langchain_text_splitters", "langchain_community.document_loaders", "langchain_community.vectorstores", "retrieval", "tiktoken"]
+_FILE_IMPORTS = ["langchain_community.document_loaders", "langchain_text_splitters", "langchain_community.vectorstores", "retrieval", "tiktoken"]
+_GEMINI_IMPORTS = ["google.generativeai", "gemini_client", "model_router", "structured_output", "llm_cache", "thread_context"]
+
+# Heavy modules each mode imports lazily, in first-use order
+MODE_IMPORTS = {
+    "analysis": lambda: _RETRIEVAL_IMPORTS + _embedding_imports() + _GEMINI_IMPORTS,
+    "email_draft": lambda: _RETRIEVAL_IMPORTS + _embedding_imports() + _GEMINI_IMPORTS,
+    "generate_followup": lambda: _RETRIEVAL_IMPORTS + _embedding_imports() + _GEMINI_IMPORTS,
+    "ingest": lambda: _RETRIEVAL_IMPORTS + _embedding_imports(),
+    "case_pipeline": lambda: _RETRIEVAL_IMPORTS + _embedding_imports() + _GEMINI_IMPORTS,
+    "batch_analysis": lambda: _RETRIEVAL_IMPORTS + _embedding_imports() + _GEMINI_IMPORTS,
+    "migrate_stores": lambda: ["chromadb"],
+    "gc": lambda: ["chromadb", "pymongo"],
+    "extraction": lambda: _FILE_IMPORTS + _embedding_imports() + _GEMINI_IMPORTS,
+    "denial_extract": lambda: _FILE_IMPORTS + _embedding_imports() + _GEMINI_IMPORTS,
+    "email_analysis": lambda: _GEMINI_IMPORTS,
+}
+
+def profile_startup(mode: str) -> Dict[str, Any]:
+    """
+    Time the imports a mode needs, one module at a time. Each figure covers
+    only what that module pulls in beyond the modules listed before it. For
+    a per-submodule tree use `python -X importtime pipeline.py ...`.
+    """
+    import importlib
+
+    report = {
+        "mode": mode,
+        "pipelineModuleMs": round((_MODULE_READY - _IMPORT_START) * 1000, 1),
+        "imports": [],
+    }
+    start = time.perf_counter()
+    for module in MODE_IMPORTS.get(mode, lambda: [])():
+        t0 = time.perf_counter()
+        entry = {"module": module}
+        try:
+            importlib.import_module(module)
+        except Exception as e:
+            entry["error"] = str(e)
+        entry["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        report["imports"].append(entry)
+    report["importsMs"] = round((time.perf_counter() - start) * 1000, 1)
+    report["imports"].sort(key=lambda entry: entry["ms"], reverse=True)
+    return report
+
+def run_mode(mode: str, case_id: str = None, user_id: str = None, files: List[str] = None, on_delta: Callable[[str], None] = None) -> Dict[str, Any]:
+    """
+    Run a single pipeline mode and return its JSON output.
+    Shared by the one-shot CLI and the long-lived worker (--mode serve).
+    `on_delta` receives generated text as it streams, for STREAMING_MODES only.
+    """
+    handler = MODE_HANDLERS.get(mode)
+    if handler is None:
+        return {"error": f"Unknown mode: {mode}"}
+    try:
+        if on_delta is not None and mode in STREAMING_MODES:
+            return handler(case_id=case_id, user_id=user_id, files=files, on_delta=on_delta)
+        return handler(case_id=case_id, user_id=user_id, files=files)
+    except Exception as e:
+        print(f"Pipeline Error: {e}", file=sys.stderr)
+        return {"error": str(e)}
+
+def serve(host: str = "127.0.0.1", port: int = 8765, concurrency: int = 4):
+    """
+    Long-lived worker. Keeps the embedding model, MongoDB client and Supabase
+    client warm across requests instead of paying the import/model-load cost
+    per spawned process.
+
+    POST /run     body: { "mode": "...", "caseId": "...", "userId": "...", "files": [...], "stream": false }
+                  returns: the same JSON the CLI would print for that mode; with
+                  "stream": true, the same JSON-lines events as --stream
+    GET  /health  returns: { "status": "ok", "inFlight": n, "concurrency": n, "embeddings": {...}, "llmCache": {...}, "gemini": {...}, "routing": {...} }
+
+    At most `concurrency` requests execute at once; the rest wait for a slot.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    slots = threading.BoundedSemaphore(concurrency)
+    in_flight = [0]
+    in_flight_lock = threading.Lock()
+
+    # Warm up once so the first request doesn't pay for model load.
+    print("Warming up embedding model and clients...", file=sys.stderr)
+    get_embedding_function()
+    get_supabase_client()
+    get_chroma_client()
+    try:
+        get_db_connection()
+    except Exception as e:
+        print(f"Warning: MongoDB warm-up failed: {e}", file=sys.stderr)
+    start_store_gc()
+
+    class WorkerHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status: int, payload: Dict[str, Any]):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/health":
+                self._send_json(404, {"error": "Not found"})
                 return
+            self._send_json(200, {
+                "status": "ok",
+                "inFlight": in_flight[0],
+                "concurrency": concurrency,
+                "embeddings": get_embedding_stats(),
+                "llmCache": get_llm_cache_stats(),
+                "gemini": get_gemini_stats(),
+                "routing": get_routing_stats(),
+            })
 
+        def do_POST(self):
+            if self.path != "/run":
+                self._send_json(404, {"error": "Not found"})
+                return
             try:
-                with open(args.files[0], 'r') as f:
-                    email_content = f.read()
-                    
-                print("Analyzing email content with Gemini...", file=sys.stderr)
-                model = genai.GenerativeModel('gemini-2.5-pro')
-                
-                prompt = f"""
-                You are an expert legal assistant for health insurance appeals.
-                Analyze the following incoming email from an insurance company or provider.
-                
-                Email Content:
-                ---
-                {{email_content}}
-                ---
-                
-                1. Summarize the email in simple layman's terms.
-                2. Identify any weaknesses in their argument or points that are vague/unsupported.
-                3. Identify any confusing terms and define them. **CRITICAL: The 'term' MUST be an EXACT substring found in the email content above. Do not rephrase the term.**
-                4. Suggest 2-3 concrete action items for the user.
-                
-                Return the output as a JSON object with keys:
-                - 'summary': string
-                - 'weaknesses': list of strings
-                - 'terms': list of objects {{ 'term': string, 'definition': string }} (term must be exact match from text)
-                - 'actionItems': list of strings
-                """
-                
-                response = model.generate_content(prompt)
-                json_str = response.text.strip().replace('```json', '').replace('```', '')
-                parsed_json = json.loads(json_str)
-                print(json.dumps(parsed_json))
-                
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
             except Exception as e:
-                print(f"Error analyzing email: {{e}}", file=sys.stderr)
-                print(json.dumps({{"error": str(e)}}))
-
-        elif args.mode == 'generate_followup':
-            if not args.caseId or not args.userId:
-                print(json.dumps({"error": "caseId and userId are required for generate_followup mode"}))
+                self._send_json(400, {"error": f"Invalid request body: {e}"})
                 return
-
-            # 1. Get Vector Store (Load existing or create if missing)
-            db = get_vector_store(args.caseId, args.userId, force_refresh=False)
-            
-            if not db:
-                print(json.dumps({"error": "Failed to load or create vector store"}))
+            if not isinstance(request, dict):
+                self._send_json(400, {"error": "Request body must be a JSON object"})
                 return
 
-            # 4. Retrieval
-            # We want to find policy sections relevant to the denial
-            query = "denial reason policy coverage exclusions medical necessity"
-            print(f"Querying: {query}", file=sys.stderr)
-            
-            results = db.similarity_search_with_relevance_scores(query, k=10)
-            print(f"Retrieved {len(results)} results from ChromaDB", file=sys.stderr)
-            
-            relevant_context = []
-            for doc, score in results:
-                if score >= 0.0:
-                    relevant_context.append(doc.page_content)
-            
-            context_text = "\n\n".join(relevant_context)
+            on_delta = None
+            if request.get("stream"):
+                # No Content-Length: events are flushed as they happen and the
+                # connection close ends the stream.
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.end_headers()
+                self.close_connection = True
+
+                def emit(event: Dict[str, Any]):
+                    self.wfile.write((json.dumps(event) + "\n").encode("utf-8"))
+                    self.wfile.flush()
 
-            # 5. Load Email History
-            email_history = ""
-            if args.files:
+                on_delta = lambda text: emit({"type": "delta", "text": text})
+
+            with slots:
+                with in_flight_lock:
+                    in_flight[0] += 1
                 try:
-                    with open(args.files[0], 'r') as f:
-                        email_history = f.read()
-                except Exception as e:
-                    print(f"Warning: Failed to read email history file: {e}", file=sys.stderr)
-
-            # 6. Generate Follow-up
-            print("Generating follow-up email...", file=sys.stderr)
-            model = genai.GenerativeModel('gemini-2.5-pro')
-            
-            prompt = f"""
-            You are an expert health insurance lawyer representing a patient.
-            Your goal is to write a persuasive follow-up email to the insurance company to appeal a claim denial.
-            
-            **CRITICAL INSTRUCTIONS TO PREVENT HALLUCINATION**:
-            1. You must ONLY use facts and policy details explicitly present in the "Context" section below.
-            2. Do NOT invent policy section numbers, coverage limits, or medical criteria. If it's not in the text, do not mention it.
-            3. If the provided context does not contain specific policy clauses, focus on general arguments about medical necessity and the lack of clear explanation in their denial, rather than making up policy language.
-            4. Directly address the points raised in the "Email History".
-            5. **CRITICAL**: Pay close attention to the "[INTERNAL ANALYSIS]" sections in the Email History. Use the "Weaknesses Identified" to counter their arguments and incorporate the "Recommended Actions" into your requests.
-            
-            Context (Policy & Denial Details):
-            ---
-            {context_text}
-            ---
-            
-            Email History (with Internal Analysis):
-            ---
-            {email_history}
-            ---
-            
-            Drafting Guidelines:
-            1. Professional, firm, and persuasive tone.
-            2. Clearly state the patient's name and policy number if available in the context.
-            3. Demand specific actions (e.g., "immediate re-evaluation", "provide specific policy language relying on").
-            4. Keep the email concise but legally grounded.
-            
-            Return the output as a JSON object with keys:
-            - 'subject': string (The subject line for the email)
-            - 'body': string (The body of the email)
-            """
-            
-            try:
-                response = model.generate_content(prompt)
-                json_str = response.text.strip().replace('```json', '').replace('```', '')
-                parsed_json = json.loads(json_str)
-                print(json.dumps(parsed_json))
-            except Exception as e:
-                print(f"Error generating follow-up: {e}", file=sys.stderr)
-                print(json.dumps({"error": str(e)}))
+                    result = run_mode(
+                        request.get("mode", "analysis"),
+                        case_id=request.get("caseId"),
+                        user_id=request.get("userId"),
+                        files=request.get("files"),
+                        on_delta=on_delta,
+                    )
+                finally:
+                    with in_flight_lock:
+                        in_flight[0] -= 1
+            if on_delta is not None:
+                emit({"type": "result", "data": result})
+            else:
+                self._send_json(200, result)
+
+        def log_message(self, format, *args):
+            print(f"[worker] {self.address_string()} {format % args}", file=sys.stderr)
+
+    server = ThreadingHTTPServer((host, port), WorkerHandler)
+    server.daemon_threads = True
+    print(f"Pipeline worker listening on http://{host}:{port} (concurrency={concurrency})", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG Pipeline for PolicyPilot")
+    parser.add_argument("--caseId", required=False, help="Case ID (required for analysis/email_draft mode; comma-separated list for batch_analysis)")
+    parser.add_argument("--userId", required=False, help="User ID (required for analysis/email_draft mode)")
+    parser.add_argument("--mode", default="analysis", choices=list(MODE_HANDLERS) + ["serve"], help="Pipeline mode")
+    parser.add_argument("--files", nargs="*", help="List of file paths for extraction/denial_extract mode")
+    parser.add_argument("--host", default=os.getenv("PIPELINE_WORKER_HOST", "127.0.0.1"), help="Bind address for serve mode")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PIPELINE_WORKER_PORT", "8765")), help="Port for serve mode")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("PIPELINE_WORKER_CONCURRENCY", "4")), help="Max requests served at once in serve mode")
+    parser.add_argument("--profile-startup", action="store_true", help="Print an import-time breakdown for --mode instead of running it")
+    parser.add_argument("--stream", action="store_true", help="Emit JSON-lines events (token deltas, then the result) for analysis/email_draft")
+    args = parser.parse_args()
+
+    if args.profile_startup:
+        print(json.dumps(profile_startup(args.mode)))
+        return
+
+    if args.mode == "serve":
+        serve(args.host, args.port, max(1, args.concurrency))
+        return
+
+    if args.stream:
+        # One JSON object per line: {"type": "delta", "text": ...} while Gemini
+        # streams, then {"type": "result", "data": <the usual output>}
+        def emit(event: Dict[str, Any]):
+            print(json.dumps(event), flush=True)
+
+        result = run_mode(
+            args.mode, case_id=args.caseId, user_id=args.userId, files=args.files,
+            on_delta=lambda text: emit({"type": "delta", "text": text}),
+        )
+        emit({"type": "result", "data": result})
+        return
+
+    print(json.dumps(run_mode(args.mode, case_id=args.caseId, user_id=args.userId, files=args.files)))
 
-    except Exception as e:
-        print(f"Pipeline Error: {e}", file=sys.stderr)
-        print(json.dumps({"error": str(e)}))
 
 
+_MODULE_READY = time.perf_counter()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,229 @@
+"""
+Multi-query retrieval for the PolicyPilot RAG pipeline.
+
+A single "denial reason policy coverage exclusions" query misses chunks that
+only talk about, say, appeal deadlines or the cited clause. Instead, several
+targeted sub-queries run concurrently against the store and their rankings
+are combined with reciprocal rank fusion (RRF): a chunk scores
+sum(1 / (RRF_K + rank)) over every sub-query that returned it. That rewards
+chunks several sub-queries agree on without having to compare raw relevance
+scores across queries. Chunks returned by more than one sub-query (or by both
+the denial and plan index) are counted once.
+
+assemble_context() then turns the retrieved chunks into prompt context. The
+splitter overlaps neighbouring chunks by 600 characters, so chunks from the
+same page whose spans touch are merged back into one span instead of
+repeating the overlap, and the spans are packed best-first under a token
+budget.
+
+Configuration (environment):
+    RETRIEVAL_CONCURRENCY   sub-queries run at once (default 4)
+    RETRIEVAL_PER_QUERY_K   results fetched per sub-query (default 8)
+    RETRIEVAL_RRF_K         RRF damping constant (default 60)
+    CONTEXT_TOKEN_BUDGET    max tokens of retrieved context per prompt (default 6000)
+"""
+
+import os
+import sys
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Sequence, Tuple
+
+# Sub-queries covering what an appeal needs from the denial and policy text
+RETRIEVAL_QUERIES = [
+    "denial reason policy coverage exclusions",
+    "policy section or clause cited in the denial",
+    "medical necessity criteria",
+    "appeal rights deadlines and process",
+]
+
+RETRIEVAL_CONCURRENCY = int(os.getenv("RETRIEVAL_CONCURRENCY", "4"))
+RETRIEVAL_PER_QUERY_K = int(os.getenv("RETRIEVAL_PER_QUERY_K", "8"))
+RETRIEVAL_RRF_K = int(os.getenv("RETRIEVAL_RRF_K", "60"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+
+
+def chunk_key(doc: Any) -> str:
+    """
+    Stable identity for a chunk: its file hash, page and offset, else its
+    text. PDF loaders yield one document per page, so start_index alone
+    restarts at 0 on every page.
+    """
+    metadata = getattr(doc, "metadata", None) or {}
+    if metadata.get("file_hash") and metadata.get("start_index") is not None:
+        return f"{metadata['file_hash']}:{metadata.get('page', '')}:{metadata['start_index']}"
+    text = " ".join(doc.page_content.split())
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Any]], rrf_k: int = RETRIEVAL_RRF_K) -> List[Tuple[Any, float]]:
+    """
+    Fuse ranked document lists into one list of (doc, rrf_score), best first.
+    Each document keeps the best rank it reached within any single list.
+    """
+    scores: Dict[str, float] = {}
+    docs: Dict[str, Any] = {}
+    for ranking in rankings:
+        seen = set()
+        for rank, doc in enumerate(ranking, start=1):
+            key = chunk_key(doc)
+            if key in seen:
+                continue
+            seen.add(key)
+            docs.setdefault(key, doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+    ordered = sorted(scores, key=scores.get, reverse=True)
+    return [(docs[key], scores[key]) for key in ordered]
+
+
+def multi_query_retrieve(
+    db: Any,
+    queries: Sequence[str] = None,
+    k: int = 10,
+    per_query_k: int = None,
+    min_score: float = 0.0,
+    concurrency: int = None,
+) -> List[Tuple[Any, float]]:
+    """
+    Run `queries` concurrently against `db` (anything with
+    similarity_search_with_relevance_scores) and return the top `k` chunks
+    as (doc, rrf_score), deduplicated. Hits below `min_score` relevance are
+    dropped before fusion.
+    """
+    queries = list(queries or RETRIEVAL_QUERIES)
+    per_query_k = per_query_k or RETRIEVAL_PER_QUERY_K
+    concurrency = max(1, min(concurrency or RETRIEVAL_CONCURRENCY, len(queries)))
+
+    def search(query: str) -> List[Any]:
+        results = db.similarity_search_with_relevance_scores(query, k=per_query_k)
+        return [doc for doc, score in results if score >= min_score]
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        rankings = [search(q) for q in queries]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            rankings = list(pool.map(search, queries))
+    fused = reciprocal_rank_fusion(rankings)
+
+    hits = sum(len(r) for r in rankings)
+    print(
+        f"Multi-query retrieval: {len(queries)} sub-queries, {hits} hits, "
+        f"{len(fused)} unique chunks in {time.perf_counter() - start:.2f}s",
+        file=sys.stderr,
+    )
+    return fused[:k]
+
+
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            print(f"Warning: tiktoken unavailable, estimating tokens from length: {e}", file=sys.stderr)
+        _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """Token count with tiktoken's cl100k_base, or ~4 chars/token without it."""
+    encoding = _get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """First `max_tokens` tokens of `text` (same tokenizer as count_tokens)."""
+    encoding = _get_encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+
+def _merge_spans(docs: Sequence[Any]) -> List[Dict[str, Any]]:
+    """
+    Merge chunks from the same file page whose character spans overlap or
+    touch. Each span keeps the best (lowest) retrieval rank of its chunks.
+    Chunks without start_index metadata are kept as-is, minus exact repeats.
+    """
+    groups: Dict[Tuple[Any, Any], List[Tuple[int, int, str]]] = {}
+    spans: List[Dict[str, Any]] = []
+    seen_text = set()
+    for rank, doc in enumerate(docs):
+        metadata = getattr(doc, "metadata", None) or {}
+        start = metadata.get("start_index")
+        source = metadata.get("file_hash") or metadata.get("source")
+        if start is None or source is None:
+            text = " ".join(doc.page_content.split())
+            if text not in seen_text:
+                seen_text.add(text)
+                spans.append({"rank": rank, "text": doc.page_content})
+            continue
+        groups.setdefault((source, metadata.get("page")), []).append((start, rank, doc.page_content))
+
+    for chunks in groups.values():
+        chunks.sort()
+        current = None
+        for start, rank, text in chunks:
+            if current and start <= current["end"]:
+                # Append only the part of this chunk past the current span's end
+                tail = text[current["end"] - start:]
+                current["text"] += tail
+                current["end"] = max(current["end"], start + len(text))
+                current["rank"] = min(current["rank"], rank)
+            else:
+                current = {"rank": rank, "start": start, "end": start + len(text), "text": text}
+                spans.append(current)
+
+    spans.sort(key=lambda span: span["rank"])
+    return spans
+
+
+def assemble_context(docs: Sequence[Any], token_budget: int = None) -> Tuple[List[str], Dict[str, int]]:
+    """
+    Build prompt context from retrieved chunks (best first): merge overlapping
+    chunks, drop duplicate spans and pack whole spans until `token_budget` is
+    reached. The best span is truncated rather than dropped if it alone is
+    over budget.
+
+    Returns (context_spans, report) where report has the token count of the
+    naive join, the packed context and the difference.
+    """
+    token_budget = token_budget or CONTEXT_TOKEN_BUDGET
+    naive_tokens = count_tokens("\n\n".join(doc.page_content for doc in docs))
+
+    packed: List[str] = []
+    used = 0
+    separator = count_tokens("\n\n")
+    for span in _merge_spans(docs):
+        cost = count_tokens(span["text"]) + (separator if packed else 0)
+        if used + cost > token_budget:
+            if not packed:
+                packed.append(truncate_to_tokens(span["text"], token_budget))
+                used = token_budget
+            continue
+        packed.append(span["text"])
+        used += cost
+
+    report = {
+        "chunks": len(docs),
+        "spans": len(packed),
+        "naiveTokens": naive_tokens,
+        "contextTokens": used,
+        "tokensSaved": max(0, naive_tokens - used),
+    }
+    print(
+        f"Context: {report['chunks']} chunks -> {report['spans']} spans, "
+        f"{report['contextTokens']} tokens (saved {report['tokensSaved']} of {report['naiveTokens']}, "
+        f"budget {token_budget})",
+        file=sys.stderr,
+    )
+    return packed, report
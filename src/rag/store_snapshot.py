@@ -0,0 +1,132 @@
+"""
+Remote snapshots of vector store collections for the PolicyPilot RAG pipeline.
+
+Containers (Modal) and fresh hosts start with an empty local store, so without
+snapshots every case is re-downloaded and re-embedded on first use. After a
+sync, a collection and its manifest are exported as one gzip'd JSON blob
+(vectors packed as float32) and put in a snapshot backend. When a collection is
+missing locally, it is restored from there before anything is rebuilt. The
+restored manifest then drives the normal incremental sync, so only sources that
+changed since the snapshot are embedded again.
+
+Snapshots are files in a directory: a local path, or a mounted volume
+shared by containers (see LocalDirectoryBackend's sync hooks).
+
+Configuration (environment):
+    VECTOR_SNAPSHOT_DIR   snapshot directory (default unset: snapshots disabled)
+"""
+
+import os
+import sys
+import gzip
+import json
+import base64
+import tempfile
+from array import array
+from typing import Any, Callable, Dict, Optional
+
+SNAPSHOT_VERSION = 1
+
+
+class LocalDirectoryBackend:
+    """
+    Snapshots as files in a directory (written atomically). For a shared
+    mounted volume, `on_write` publishes changes (e.g. Modal's
+    Volume.commit) and `on_miss` refreshes the local view before a missing
+    key is reported (e.g. Volume.reload).
+    """
+
+    def __init__(self, root: str, on_write: Callable[[], Any] = None, on_miss: Callable[[], Any] = None):
+        self.root = root
+        self.on_write = on_write
+        self.on_miss = on_miss
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.json.gz")
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        if not os.path.exists(path) and self.on_miss is not None:
+            self.on_miss()
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def put(self, key: str, data: bytes):
+        path = self._path(key)
+        # Unique temp name: other containers may be writing the same key on a shared volume
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=f"{key}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if self.on_write is not None:
+            self.on_write()
+
+    def delete(self, key: str):
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(path)
+            if self.on_write is not None:
+                self.on_write()
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+
+def export_collection(collection: Any, manifest: Dict[str, Any]) -> bytes:
+    """Serialise a chromadb collection (ids, vectors, documents, metadata) plus its manifest."""
+    data = collection.get(include=["embeddings", "documents", "metadatas"])
+    vectors = data["embeddings"]
+    dim = len(vectors[0]) if len(vectors) else 0
+    packed = array("f")
+    for vector in vectors:
+        packed.extend(float(x) for x in vector)
+    payload = {
+        "version": SNAPSHOT_VERSION,
+        "manifest": manifest,
+        "ids": list(data["ids"]),
+        "documents": list(data["documents"]),
+        "metadatas": list(data["metadatas"]),
+        "dim": dim,
+        "embeddings": base64.b64encode(packed.tobytes()).decode("ascii"),
+    }
+    return gzip.compress(json.dumps(payload).encode("utf-8"))
+
+
+def import_collection(collection: Any, blob: bytes) -> Dict[str, Any]:
+    """Load a snapshot into an (empty) chromadb collection; returns the snapshot's manifest."""
+    payload = json.loads(gzip.decompress(blob).decode("utf-8"))
+    if payload.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {payload.get('version')}")
+    packed = array("f")
+    packed.frombytes(base64.b64decode(payload["embeddings"]))
+    dim = payload["dim"]
+    ids = payload["ids"]
+    for i in range(0, len(ids), 500):
+        end = min(i + 500, len(ids))
+        collection.add(
+            ids=ids[i:end],
+            embeddings=[packed[j * dim:(j + 1) * dim].tolist() for j in range(i, end)],
+            documents=payload["documents"][i:end],
+            metadatas=payload["metadatas"][i:end],
+        )
+    return payload["manifest"]
+
+
+def open_snapshot_backend(root: Optional[str] = None) -> Optional[LocalDirectoryBackend]:
+    """Open the snapshot directory (VECTOR_SNAPSHOT_DIR); returns None when snapshots are disabled or unavailable."""
+    root = root or os.getenv("VECTOR_SNAPSHOT_DIR", "").strip()
+    if not root:
+        return None
+    try:
+        return LocalDirectoryBackend(root)
+    except Exception as e:
+        print(f"Warning: Could not open store snapshot directory {root}: {e}", file=sys.stderr)
+        return None
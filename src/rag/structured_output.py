@@ -0,0 +1,110 @@
+"""
+Structured (JSON) output for the PolicyPilot RAG pipeline.
+
+Every task that expects a JSON object asks Gemini for it directly: the
+request sets response_mime_type "application/json" and a response_schema
+(OpenAPI-subset, as accepted by google.generativeai), so the model returns
+bare JSON of the right shape instead of fenced or prose-wrapped text.
+
+parse_structured() is the one parser for those responses. It tries a plain
+json.loads first; only text that isn't bare JSON (responses cached before
+JSON mode, or a transport without it) falls back to decoding the first
+object in the text. The result is then checked against the same schema:
+required keys present and not null, types right, arrays and nested
+objects included. Optional keys may be null; extra keys are kept.
+"""
+
+import json
+from typing import Any, Dict, Optional
+
+STRING = {"type": "STRING"}
+STRING_LIST = {"type": "ARRAY", "items": STRING}
+TERM = {
+    "type": "OBJECT",
+    "properties": {"term": STRING, "definition": STRING},
+    "required": ["term", "definition"],
+}
+
+ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"analysis": STRING, "terms": {"type": "ARRAY", "items": TERM}},
+    "required": ["analysis", "terms"],
+}
+EMAIL_DRAFT_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"body": STRING},
+    "required": ["body"],
+}
+FOLLOWUP_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"subject": STRING, "body": STRING},
+    "required": ["subject", "body"],
+}
+PLAN_FIELDS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"insuranceCompany": STRING, "planName": STRING, "policyNumber": STRING},
+    "required": ["insuranceCompany", "planName", "policyNumber"],
+}
+DENIAL_BRIEF_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"briefDescription": STRING},
+    "required": ["briefDescription"],
+}
+EMAIL_ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "summary": STRING,
+        "weaknesses": STRING_LIST,
+        "terms": {"type": "ARRAY", "items": TERM},
+        "actionItems": STRING_LIST,
+    },
+    "required": ["summary", "weaknesses", "terms", "actionItems"],
+}
+
+_PYTHON_TYPES = {
+    "OBJECT": dict,
+    "ARRAY": list,
+    "STRING": str,
+    "BOOLEAN": bool,
+    "INTEGER": int,
+    "NUMBER": (int, float),
+}
+
+
+def schema_errors(value: Any, schema: Dict[str, Any], path: str = "$") -> Optional[str]:
+    """First place `value` doesn't match `schema`, or None if it does."""
+    expected = _PYTHON_TYPES[schema["type"]]
+    if not isinstance(value, expected) or (schema["type"] in ("INTEGER", "NUMBER") and isinstance(value, bool)):
+        return f"{path} is not {schema['type'].lower()}"
+    if schema["type"] == "OBJECT":
+        for key in schema.get("required", []):
+            if key not in value:
+                return f"{path}.{key} is missing"
+            if value[key] is None:
+                return f"{path}.{key} is null"
+        for key, subschema in schema.get("properties", {}).items():
+            if key in value and value[key] is not None:
+                problem = schema_errors(value[key], subschema, f"{path}.{key}")
+                if problem:
+                    return problem
+    elif schema["type"] == "ARRAY" and "items" in schema:
+        for i, item in enumerate(value):
+            problem = schema_errors(item, schema["items"], f"{path}[{i}]")
+            if problem:
+                return problem
+    return None
+
+
+def parse_structured(text: str, schema: Dict[str, Any]) -> Dict[str, Any]:
+    """Decode a JSON-mode response and check it against `schema`; ValueError if either fails."""
+    try:
+        value = json.loads(text)
+    except json.JSONDecodeError:
+        start = text.find('{')
+        if start == -1:
+            raise ValueError("No JSON object found in response")
+        value, _ = json.JSONDecoder().raw_decode(text[start:])
+    problem = schema_errors(value, schema)
+    if problem:
+        raise ValueError(problem)
+    return value
@@ -0,0 +1,92 @@
+import os
+import sys
+import types
+
+import pytest
+
+# The pipeline modules import each other as top-level modules (see modal_app.PIPELINE_MODULES)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeCollection:
+    """The slice of a chromadb collection the pipeline uses."""
+
+    def __init__(self, name):
+        self.name = name
+        self.records = {}
+
+    def add(self, ids, embeddings=None, documents=None, metadatas=None):
+        for i, id_ in enumerate(ids):
+            self.records[id_] = {
+                "embedding": embeddings[i] if embeddings else None,
+                "document": documents[i] if documents else None,
+                "metadata": metadatas[i] if metadatas else None,
+            }
+
+    def delete(self, ids):
+        for id_ in ids:
+            self.records.pop(id_, None)
+
+    def get(self, include=None):
+        ids = list(self.records)
+        return {
+            "ids": ids,
+            "embeddings": [self.records[i]["embedding"] for i in ids],
+            "documents": [self.records[i]["document"] for i in ids],
+            "metadatas": [self.records[i]["metadata"] for i in ids],
+        }
+
+
+class FakeChromaClient:
+    def __init__(self):
+        self.collections = {}
+
+    def get_collection(self, name):
+        if name not in self.collections:
+            raise ValueError(f"Collection {name} does not exist")
+        return self.collections[name]
+
+    def get_or_create_collection(self, name):
+        return self.collections.setdefault(name, FakeCollection(name))
+
+    def delete_collection(self, name):
+        self.get_collection(name)
+        del self.collections[name]
+
+    def list_collections(self):
+        return list(self.collections.values())
+
+
+class FakeChroma:
+    """Stand-in for langchain's Chroma vector store over a FakeChromaClient collection."""
+
+    def __init__(self, client, collection_name, embedding_function=None):
+        self.collection = client.get_or_create_collection(collection_name)
+
+    def add_documents(self, documents, ids):
+        self.collection.add(ids=ids, documents=[d.page_content for d in documents], metadatas=[d.metadata for d in documents])
+
+    def delete(self, ids):
+        self.collection.delete(ids)
+
+
+@pytest.fixture
+def pipeline_store(monkeypatch, tmp_path):
+    """
+    pipeline with its shared store pointed at tmp_path: a fake Chroma client,
+    no embedding model and no snapshot backend. Returns (pipeline, client).
+    """
+    pipeline = pytest.importorskip("pipeline")
+    client = FakeChromaClient()
+    monkeypatch.setattr(pipeline, "VECTOR_STORE_ROOT", str(tmp_path / "store"))
+    monkeypatch.setattr(pipeline, "LEGACY_VECTOR_STORE_DIR", str(tmp_path / "legacy"))
+    monkeypatch.setattr(pipeline, "get_chroma_client", lambda: client)
+    monkeypatch.setattr(pipeline, "get_embedding_function", lambda: None)
+    monkeypatch.setattr(pipeline, "get_snapshot_backend", lambda: None)
+    monkeypatch.setattr(pipeline, "_store_locks", {})
+
+    vectorstores = types.ModuleType("langchain_community.vectorstores")
+    vectorstores.Chroma = FakeChroma
+    monkeypatch.setitem(sys.modules, "langchain_community", types.ModuleType("langchain_community"))
+    monkeypatch.setitem(sys.modules, "langchain_community.vectorstores", vectorstores)
+    return pipeline, client
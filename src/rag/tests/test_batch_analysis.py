@@ -0,0 +1,94 @@
+import pytest
+
+pymongo = pytest.importorskip("pymongo")
+pytest.importorskip("dotenv")
+
+import pipeline  # noqa: E402
+
+
+class BulkWriteResult:
+    def __init__(self, matched_count, modified_count):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+
+
+class FakeCases:
+    """The slice of the Mongo cases collection analyze_cases uses."""
+
+    def __init__(self, docs):
+        self.docs = {doc["id"]: dict(doc) for doc in docs}
+        self.writes = []
+
+    def _matches(self, doc, query):
+        for field, condition in query.items():
+            if isinstance(condition, dict) and "$in" in condition:
+                if doc.get(field) not in condition["$in"]:
+                    return False
+            elif doc.get(field) != condition:
+                return False
+        return True
+
+    def find(self, query, projection=None):
+        return [dict(doc) for doc in self.docs.values() if self._matches(doc, query)]
+
+    def bulk_write(self, requests, ordered=True):
+        matched = modified = 0
+        for selector, update in requests:
+            self.writes.append(selector)
+            for stored in self.docs.values():
+                if self._matches(stored, selector):
+                    matched += 1
+                    update = update["$set"]
+                    if any(stored.get(k) != v for k, v in update.items()):
+                        stored.update(update)
+                        modified += 1
+                    break
+        return BulkWriteResult(matched, modified)
+
+
+@pytest.fixture
+def cases(monkeypatch):
+    cases = FakeCases([
+        {"id": "c1", "userId": "u1", "analysis": {"analysis": "same as before", "terms": []}},
+        {"id": "c2", "userId": "u1", "analysis": {"analysis": "old", "terms": []}},
+        {"id": "c3", "userId": "u1"},
+        {"id": "other", "userId": "u2", "analysis": {"analysis": "theirs", "terms": []}},
+    ])
+    analyses = {
+        "c1": {"analysis": "same as before", "terms": []},
+        "c2": {"analysis": "new", "terms": []},
+        "c3": {"error": "Gemini failed"},
+        "other": {"analysis": "overwritten", "terms": []},
+    }
+    monkeypatch.setattr(pymongo, "UpdateOne", lambda selector, update: (selector, update))
+    monkeypatch.setattr(pipeline, "get_collection", lambda name: cases)
+    monkeypatch.setattr(pipeline, "get_vector_store", lambda case_id, user_id, force_refresh=False: object())
+    monkeypatch.setattr(pipeline, "retrieve_case_context", lambda db: ["context"])
+    monkeypatch.setattr(pipeline, "run_analysis", lambda case_id, user_id, relevant_context: analyses[case_id])
+    return cases
+
+
+def test_unchanged_reanalysis_counts_as_written(cases):
+    report = pipeline.analyze_cases(["c1", "c2", "c3", "missing"], user_id="u1")
+    assert report["analysed"] == 2 and report["written"] == 2 and report["changed"] == 1
+    assert report["failed"] == 2 and not report["success"]
+    assert report["results"] == {
+        "c1": {"success": True},
+        "c2": {"success": True},
+        "c3": {"error": "Gemini failed"},
+        "missing": {"error": "Case not found"},
+    }
+    assert cases.docs["c2"]["analysis"]["analysis"] == "new"
+
+
+def test_only_the_users_cases_are_analysed_and_written(cases):
+    report = pipeline.analyze_cases(["c2", "other"], user_id="u1")
+    assert report["results"]["other"] == {"error": "Case not found"}
+    assert cases.docs["other"]["analysis"]["analysis"] == "theirs"
+    assert cases.writes == [{"id": "c2", "userId": "u1"}]
+
+
+def test_user_id_is_required(cases):
+    assert "error" in pipeline.analyze_cases(["c1"], user_id=None)
+    assert "error" in pipeline.run_batch_analysis(case_id="c1,c2")
+    assert cases.writes == []
@@ -0,0 +1,69 @@
+import pytest
+
+from embedding_cache import CachedEmbeddings, EmbeddingCache, open_embedding_cache, text_hash
+
+
+class CountingEmbeddings:
+    def __init__(self):
+        self.documents = []
+        self.queries = []
+
+    def embed_documents(self, texts):
+        self.documents.append(list(texts))
+        return [[float(len(t)), 0.5] for t in texts]
+
+    def embed_query(self, text):
+        self.queries.append(text)
+        return [float(len(text)), 1.5]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return EmbeddingCache(str(tmp_path / "cache" / "embeddings.sqlite3"), max_entries=3)
+
+
+def test_text_hash_ignores_whitespace():
+    assert text_hash("policy  text\n") == text_hash("policy text")
+
+
+def test_only_misses_are_embedded(cache):
+    model = CountingEmbeddings()
+    embeddings = CachedEmbeddings(model, cache, "minilm")
+    first = embeddings.embed_documents(["a", "bb", "a"])
+    second = embeddings.embed_documents(["bb", "ccc"])
+    assert first == [[1.0, 0.5], [2.0, 0.5], [1.0, 0.5]]
+    assert second == [[2.0, 0.5], [3.0, 0.5]]
+    assert model.documents == [["a", "bb"], ["ccc"]]
+    assert cache.stats()["hits"] == 1
+
+
+def test_cache_is_per_model(cache):
+    model = CountingEmbeddings()
+    CachedEmbeddings(model, cache, "minilm").embed_documents(["a"])
+    CachedEmbeddings(model, cache, "bge").embed_documents(["a"])
+    assert model.documents == [["a"], ["a"]]
+
+
+def test_query_embeddings_are_cached(cache):
+    model = CountingEmbeddings()
+    embeddings = CachedEmbeddings(model, cache, "minilm")
+    assert embeddings.embed_query("q") == embeddings.embed_query("q") == [1.0, 1.5]
+    assert model.queries == ["q"]
+
+
+def test_evicts_least_recently_used(cache):
+    for h in ("a", "b", "c"):
+        cache.put_many("m", {h: [1.0]})
+    cache.get_many("m", ["a"])
+    cache.put_many("m", {"d": [1.0]})
+    assert set(cache.get_many("m", ["a", "b", "c", "d"])) == {"a", "c", "d"}
+
+
+def test_entries_survive_reopen(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite3")
+    EmbeddingCache(path).put_many("m", {"h": [0.25, -2.0]})
+    assert EmbeddingCache(path).get_many("m", ["h"]) == {"h": [0.25, -2.0]}
+
+
+def test_empty_path_disables_cache():
+    assert open_embedding_cache("") is None
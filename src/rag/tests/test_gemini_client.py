@@ -0,0 +1,103 @@
+import pytest
+
+import gemini_client
+from gemini_client import (
+    FakeGeminiError,
+    FakeTransport,
+    GeminiClient,
+    GenaiTransport,
+    TokenBucket,
+    is_retryable,
+    open_gemini_client,
+)
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(gemini_client.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def client(transport, **options):
+    return GeminiClient(transport, backoff_base=0.01, backoff_max=0.01, **options)
+
+
+def test_is_retryable():
+    assert is_retryable(FakeGeminiError(429)) and is_retryable(FakeGeminiError(503))
+    assert is_retryable(TimeoutError()) and is_retryable(ConnectionResetError())
+    assert not is_retryable(FakeGeminiError(400)) and not is_retryable(ValueError())
+    assert is_retryable(type("ResourceExhausted", (Exception,), {})())
+
+
+def test_generate_retries_transient_failures():
+    transport = FakeTransport("ok", failures=[FakeGeminiError(429), FakeGeminiError(503)])
+    gemini = client(transport)
+    assert gemini.generate("gemini-2.5-flash", "prompt") == "ok"
+    stats = gemini.stats()
+    assert stats["attempts"] == 3 and stats["retries"] == 2 and stats["rateLimited"] == 1
+    assert stats["succeeded"] == 1 and stats["failed"] == 0 and stats["inFlight"] == 0
+
+
+def test_generate_does_not_retry_permanent_failures():
+    gemini = client(FakeTransport("ok", failures=[FakeGeminiError(400)]))
+    with pytest.raises(FakeGeminiError):
+        gemini.generate("gemini-2.5-flash", "prompt")
+    assert gemini.stats()["attempts"] == 1 and gemini.stats()["failed"] == 1
+
+
+def test_generate_gives_up_after_max_retries():
+    gemini = client(FakeTransport("ok", failures=[FakeGeminiError(500)] * 3), max_retries=2)
+    with pytest.raises(FakeGeminiError):
+        gemini.generate("gemini-2.5-flash", "prompt")
+    assert gemini.stats()["attempts"] == 3
+
+
+def test_stream_retries_before_first_delta():
+    transport = FakeTransport("x" * 40, failures=[FakeGeminiError(503)])
+    gemini = client(transport)
+    assert "".join(gemini.stream("gemini-2.5-flash", "prompt")) == "x" * 40
+    assert len(transport.calls) == 2 and gemini.stats()["succeeded"] == 1
+
+
+def test_stream_does_not_retry_after_output_started():
+    class Interrupted(FakeTransport):
+        def stream(self, model_name, prompt, timeout, response_schema=None):
+            yield "partial"
+            raise FakeGeminiError(503)
+
+    gemini = client(Interrupted())
+    deltas = []
+    with pytest.raises(FakeGeminiError):
+        for delta in gemini.stream("gemini-2.5-flash", "prompt"):
+            deltas.append(delta)
+    assert deltas == ["partial"] and gemini.stats()["attempts"] == 1
+
+
+def test_token_bucket_waits_for_refill(no_sleep, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(gemini_client.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(gemini_client.time, "sleep", lambda s: (no_sleep.append(s), clock.__setitem__(0, clock[0] + s)))
+    bucket = TokenBucket(60, capacity=2)
+    bucket.acquire()
+    bucket.acquire()
+    bucket.acquire()
+    assert no_sleep == [pytest.approx(1.0)]
+
+
+def test_token_bucket_respects_deadline(monkeypatch):
+    monkeypatch.setattr(gemini_client.time, "monotonic", lambda: 100.0)
+    bucket = TokenBucket(60, capacity=1)
+    bucket.acquire()
+    with pytest.raises(TimeoutError):
+        bucket.acquire(deadline=100.5)
+
+
+def test_open_gemini_client(monkeypatch):
+    monkeypatch.setenv("GEMINI_FAKE_RESPONSE", '{"body": "hi"}')
+    gemini = open_gemini_client(lambda: None, transport="fake")
+    assert isinstance(gemini.transport, FakeTransport)
+    assert gemini.generate("gemini-2.5-flash", "prompt") == '{"body": "hi"}'
+    assert isinstance(open_gemini_client(lambda: None, transport="genai").transport, GenaiTransport)
+    with pytest.raises(ValueError):
+        open_gemini_client(lambda: None, transport="no-such-transport")
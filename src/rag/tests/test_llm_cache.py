@@ -0,0 +1,53 @@
+import time
+
+import pytest
+
+import llm_cache
+from llm_cache import SqliteResponseCache, open_response_cache, response_cache_key
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SqliteResponseCache(str(tmp_path / "cache" / "llm.sqlite3"), ttl_seconds=60, max_entries=3)
+
+
+def test_key_depends_on_model_prompt_and_options():
+    key = response_cache_key("gemini-2.5-flash", "prompt")
+    assert key == response_cache_key("gemini-2.5-flash", "prompt", {})
+    assert key != response_cache_key("gemini-2.5-pro", "prompt")
+    assert key != response_cache_key("gemini-2.5-flash", "prompt", {"response_schema": {"type": "OBJECT"}})
+
+
+def test_round_trip_and_stats(cache):
+    assert cache.get("k") is None
+    cache.set("k", "value")
+    assert cache.get("k") == "value"
+    cache.delete("k")
+    assert cache.get("k") is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "hitRatio": round(1 / 3, 4)}
+
+
+def test_expired_entries_miss(cache, monkeypatch):
+    cache.set("k", "value")
+    now = time.time()
+    monkeypatch.setattr(llm_cache.time, "time", lambda: now + 61)
+    assert cache.get("k") is None
+
+
+def test_evicts_least_recently_used(cache, monkeypatch):
+    clock = iter(range(1_000_000, 1_000_100))
+    monkeypatch.setattr(llm_cache.time, "time", lambda: next(clock))
+    for key in ("a", "b", "c"):
+        cache.set(key, key)
+    cache.get("a")
+    cache.set("d", "d")
+    assert [cache.get(key) for key in ("a", "b", "c", "d")] == ["a", None, "c", "d"]
+
+
+def test_open_response_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("LLM_CACHE_PATH", str(tmp_path / "llm.sqlite3"))
+    monkeypatch.setenv("LLM_CACHE_TTL_SECONDS", "120")
+    cache = open_response_cache("sqlite")
+    assert isinstance(cache, SqliteResponseCache) and cache.ttl_seconds == 120
+    assert open_response_cache("none") is None
+    assert open_response_cache("redis") is None
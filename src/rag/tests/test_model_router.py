@@ -0,0 +1,109 @@
+import json
+
+import pytest
+
+import model_router
+from gemini_client import FakeTransport
+from model_router import MODEL_FAST, MODEL_PRO, route, routing_stats
+
+GOOD_PLAN = {"insuranceCompany": "Aetna", "planName": "Gold PPO", "policyNumber": "COINDEPO052023"}
+
+
+@pytest.fixture(autouse=True)
+def fresh_stats(monkeypatch):
+    monkeypatch.setattr(model_router, "_stats", {})
+    for task in model_router.TASK_POLICIES:
+        monkeypatch.delenv(f"MODEL_TIERS_{task.upper()}", raising=False)
+
+
+def tiers(fast_response, pro_response=json.dumps(GOOD_PLAN)):
+    """generate() backed by one FakeTransport per tier, plus a log of discards."""
+    transports = {MODEL_FAST: FakeTransport(fast_response), MODEL_PRO: FakeTransport(pro_response)}
+    discarded = []
+
+    def generate(model, prompt, on_delta=None, response_schema=None):
+        return transports[model].generate(model, prompt, 1.0, response_schema=response_schema)
+
+    def discard(model, prompt, response_schema=None):
+        discarded.append(model)
+
+    return transports, generate, discard, discarded
+
+
+def test_accepts_fast_tier_output():
+    transports, generate, discard, discarded = tiers(json.dumps(GOOD_PLAN))
+    routed = route("extraction", "prompt", generate, discard)
+    assert routed["model"] == MODEL_FAST and not routed["escalated"] and routed["problem"] is None
+    assert routed["data"] == GOOD_PLAN
+    assert transports[MODEL_PRO].calls == [] and discarded == []
+
+
+@pytest.mark.parametrize(
+    "fast_response",
+    [
+        "not json at all",
+        '{"insuranceCompany": null, "planName": "Gold PPO", "policyNumber": "X"}',
+        json.dumps({"insuranceCompany": "Unknown", "planName": "Unknown", "policyNumber": "X"}),
+    ],
+)
+def test_escalates_rejected_fast_tier_output(fast_response):
+    transports, generate, discard, _ = tiers(fast_response)
+    routed = route("extraction", "prompt", generate, discard)
+    assert routed["model"] == MODEL_PRO and routed["escalated"] and routed["problem"] is None
+    assert routed["data"] == GOOD_PLAN
+    stats = routing_stats()["extraction"]
+    assert stats["requests"] == 1 and stats["escalations"] == 1
+
+
+def test_validator_crash_escalates_and_discards(monkeypatch):
+    def crash(data):
+        raise AttributeError("'int' object has no attribute 'strip'")
+
+    monkeypatch.setitem(model_router.TASK_POLICIES["extraction"], "validate", crash)
+    _, generate, discard, discarded = tiers(json.dumps(GOOD_PLAN))
+    routed = route("extraction", "prompt", generate, discard)
+    assert routed["model"] == MODEL_PRO and routed["data"] is None
+    assert "AttributeError" in routed["problem"]
+    assert discarded == [MODEL_FAST, MODEL_PRO]
+
+
+def test_returns_last_tier_when_every_tier_rejects():
+    _, generate, discard, discarded = tiers("garbage", "still garbage")
+    routed = route("extraction", "prompt", generate, discard)
+    assert routed["model"] == MODEL_PRO and routed["data"] is None
+    assert routed["problem"].startswith("invalid output")
+    assert discarded == [MODEL_FAST, MODEL_PRO]
+    assert routing_stats()["extraction"]["tiers"][MODEL_PRO]["escalated"] == 0
+
+
+def test_only_first_tier_streams():
+    deltas = []
+    _, generate, discard, _ = tiers("garbage")
+    seen = []
+
+    def recording_generate(model, prompt, on_delta=None, response_schema=None):
+        seen.append((model, on_delta))
+        return generate(model, prompt, response_schema=response_schema)
+
+    route("extraction", "prompt", recording_generate, discard, on_delta=deltas.append)
+    assert seen == [(MODEL_FAST, deltas.append), (MODEL_PRO, None)]
+
+
+def test_tier_override(monkeypatch):
+    monkeypatch.setenv("MODEL_TIERS_EXTRACTION", MODEL_PRO)
+    transports, generate, discard, _ = tiers("garbage")
+    routed = route("extraction", "prompt", generate, discard)
+    assert routed["model"] == MODEL_PRO and transports[MODEL_FAST].calls == []
+
+
+@pytest.mark.parametrize(
+    "task, data, problem",
+    [
+        ("denial_extract", {"briefDescription": "  "}, "empty 'briefDescription'"),
+        ("email_draft", {"body": "Dear [Client Name], " + "x" * 300}, "placeholder left in email body"),
+        ("email_analysis", {"summary": "s", "weaknesses": [], "terms": [], "actionItems": []}, "no action items"),
+        ("analysis", {"analysis": "a" * 300, "terms": [{"term": "zz", "definition": "d"}]}, "1/1 terms not found in the text"),
+    ],
+)
+def test_validators(task, data, problem):
+    assert model_router.TASK_POLICIES[task]["validate"](data) == problem
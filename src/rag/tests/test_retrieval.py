@@ -0,0 +1,64 @@
+from types import SimpleNamespace
+
+import pytest
+
+from retrieval import assemble_context, chunk_key, multi_query_retrieve, reciprocal_rank_fusion
+
+
+def doc(text, **metadata):
+    return SimpleNamespace(page_content=text, metadata=metadata)
+
+
+def test_chunk_key_distinguishes_pages_at_same_offset():
+    first = doc("page one text", file_hash="abc", page=0, start_index=0)
+    second = doc("page two text", file_hash="abc", page=1, start_index=0)
+    assert chunk_key(first) != chunk_key(second)
+
+
+def test_chunk_key_falls_back_to_normalized_text():
+    assert chunk_key(doc("some  policy\ntext")) == chunk_key(doc("some policy text"))
+
+
+def test_rrf_keeps_chunks_from_different_pages_with_same_offset():
+    page0 = doc("exclusions apply", file_hash="abc", page=0, start_index=0)
+    page1 = doc("appeal within 180 days", file_hash="abc", page=1, start_index=0)
+    fused = reciprocal_rank_fusion([[page0], [page1, page0]])
+    assert [d.page_content for d, _ in fused] == ["exclusions apply", "appeal within 180 days"]
+
+
+def test_rrf_counts_a_chunk_once_per_ranking():
+    a = doc("a", file_hash="f", page=0, start_index=0)
+    b = doc("b", file_hash="f", page=0, start_index=10)
+    fused = dict((d.page_content, score) for d, score in reciprocal_rank_fusion([[a, a, b]], rrf_k=0))
+    assert fused == {"a": 1.0, "b": pytest.approx(1 / 3)}
+
+
+class FakeStore:
+    def __init__(self, results):
+        self.results = results
+
+    def similarity_search_with_relevance_scores(self, query, k):
+        return self.results[query][:k]
+
+
+def test_multi_query_retrieve_fuses_and_filters():
+    a = doc("a", file_hash="f", page=0, start_index=0)
+    b = doc("b", file_hash="f", page=1, start_index=0)
+    c = doc("c", file_hash="f", page=2, start_index=0)
+    store = FakeStore({"q1": [(a, 0.9), (c, 0.1)], "q2": [(b, 0.8), (a, 0.7)]})
+    fused = multi_query_retrieve(store, queries=["q1", "q2"], k=5, min_score=0.5, concurrency=2)
+    assert [d.page_content for d, _ in fused] == ["a", "b"]
+
+
+def test_assemble_context_merges_overlapping_chunks():
+    first = doc("abcdefgh", source="plan.pdf", page=0, start_index=0)
+    overlap = doc("efghijkl", source="plan.pdf", page=0, start_index=4)
+    other_page = doc("efghijkl", source="plan.pdf", page=1, start_index=4)
+    packed, report = assemble_context([first, overlap, other_page], token_budget=1000)
+    assert packed == ["abcdefghijkl", "efghijkl"]
+    assert report["chunks"] == 3 and report["spans"] == 2
+
+
+def test_assemble_context_truncates_best_span_over_budget():
+    packed, report = assemble_context([doc("x" * 400)], token_budget=10)
+    assert len(packed) == 1 and report["contextTokens"] == 10
@@ -0,0 +1,127 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+DAY = 86400
+
+
+class FakeCases:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, query, projection=None):
+        wanted = set(query["id"]["$in"])
+        return [dict(doc) for doc in self.docs if doc["id"] in wanted]
+
+
+class FakeSnapshots:
+    def __init__(self):
+        self.deleted = []
+
+    def delete(self, key):
+        self.deleted.append(key)
+
+
+@pytest.fixture
+def store(pipeline_store, monkeypatch):
+    pipeline, client = pipeline_store
+    snapshots = FakeSnapshots()
+    cases = FakeCases([])
+    monkeypatch.setattr(pipeline, "get_snapshot_backend", lambda: snapshots)
+    monkeypatch.setattr(pipeline, "get_collection", lambda name: cases)
+    return SimpleNamespace(pipeline=pipeline, client=client, snapshots=snapshots, cases=cases)
+
+
+def add_store(store, kind, ident, size, age_days):
+    name = store.pipeline.store_collection_name(kind, ident)
+    store.client.get_or_create_collection(name).add(ids=[f"{ident}:0", f"{ident}:1"])
+    manifest = {
+        "kind": kind,
+        "caseId" if kind == "case" else "planId": ident,
+        "files": {},
+        "chunks": {ident: [f"{ident}:0", f"{ident}:1"]},
+        "sizes": {ident: size},
+        "lastAccess": time.time() - age_days * DAY,
+    }
+    store.pipeline.write_manifest(name, manifest)
+    return name
+
+
+def evicted(report):
+    return {entry["collection"]: entry["reason"] for entry in report["evicted"]}
+
+
+def test_list_stores(store):
+    add_store(store, "case", "c1", 1000, 1)
+    add_store(store, "plan", "p1", 500, 2)
+    stores = {st["collection"]: st for st in store.pipeline.list_stores()}
+    assert stores["case_c1"]["kind"] == "case" and stores["case_c1"]["id"] == "c1"
+    assert stores["plan_p1"]["sizeBytes"] == 500 and stores["plan_p1"]["chunks"] == 2
+    assert stores["case_c1"]["lastAccess"] > stores["plan_p1"]["lastAccess"]
+
+
+def test_store_size_falls_back_to_chunk_estimate(store):
+    manifest = {"chunks": {"h": ["h:0", "h:1"]}}
+    assert store.pipeline.store_size_bytes(manifest) == 2 * (2000 + store.pipeline._VECTOR_BYTES)
+
+
+def test_closed_case_ids(store):
+    store.cases.docs[:] = [
+        {"id": "open", "status": "active"},
+        {"id": "resolved", "resolved": True},
+        {"id": "closed", "status": "closed"},
+    ]
+    assert store.pipeline._closed_case_ids(["open", "resolved", "closed", "deleted"]) == {"resolved", "closed", "deleted"}
+
+
+def test_closed_case_ids_ignores_a_database_with_none_of_the_cases(store):
+    assert store.pipeline._closed_case_ids(["c1", "c2"]) == set()
+
+
+def test_eviction_order_and_snapshot_drop(store):
+    store.cases.docs[:] = [
+        {"id": "closed", "status": "resolved"},
+        {"id": "stale", "status": "active"},
+        {"id": "old", "status": "active"},
+        {"id": "recent", "status": "active"},
+        {"id": "newest", "status": "active"},
+    ]
+    add_store(store, "case", "closed", 100, 0)
+    add_store(store, "case", "stale", 100, 40)
+    add_store(store, "case", "old", 400, 5)
+    add_store(store, "case", "recent", 400, 2)
+    add_store(store, "case", "newest", 400, 1)
+    add_store(store, "plan", "p1", 300, 3)
+
+    report = store.pipeline.collect_store_garbage(ttl_days=30, max_bytes=1000)
+    # Closed first, then TTL, then least recently used until under 1000 bytes
+    assert evicted(report) == {"case_closed": "case closed", "case_stale": "ttl", "case_old": "size cap", "plan_p1": "size cap"}
+    assert report["reclaimedBytes"] == 900 and report["remainingBytes"] == 800 and report["remainingStores"] == 2
+    assert sorted(store.client.collections) == ["case_newest", "case_recent"]
+    assert sorted(st["collection"] for st in store.pipeline.list_stores()) == ["case_newest", "case_recent"]
+    # Only the closed case's snapshot goes; the others can be restored on next use
+    assert store.snapshots.deleted == ["case_closed"]
+
+
+def test_closed_wins_over_ttl(store):
+    store.cases.docs[:] = [{"id": "c1", "resolved": True}, {"id": "c2"}]
+    add_store(store, "case", "c1", 100, 90)
+    add_store(store, "case", "c2", 100, 1)
+    assert evicted(store.pipeline.collect_store_garbage(ttl_days=30, max_bytes=0)) == {"case_c1": "case closed"}
+
+
+def test_zero_limits_disable_ttl_and_size_eviction(store):
+    store.cases.docs[:] = [{"id": "c1"}]
+    add_store(store, "case", "c1", 10 ** 9, 400)
+    assert store.pipeline.collect_store_garbage(ttl_days=0, max_bytes=0)["evicted"] == []
+
+
+def test_status_lookup_failure_skips_status_eviction(store, monkeypatch):
+    def unavailable(name):
+        raise ConnectionError("mongo down")
+
+    monkeypatch.setattr(store.pipeline, "get_collection", unavailable)
+    add_store(store, "case", "c1", 100, 1)
+    add_store(store, "case", "c2", 100, 60)
+    assert evicted(store.pipeline.collect_store_garbage(ttl_days=30, max_bytes=0)) == {"case_c2": "ttl"}
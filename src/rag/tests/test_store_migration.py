@@ -0,0 +1,101 @@
+import json
+import os
+import sys
+import types
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import FakeChromaClient
+
+
+@pytest.fixture
+def store(pipeline_store, monkeypatch, tmp_path):
+    """pipeline_store plus a fake chromadb whose PersistentClient(path) opens `legacy[path]`."""
+    pipeline, client = pipeline_store
+    legacy = {}
+    chromadb = types.ModuleType("chromadb")
+    chromadb.PersistentClient = lambda path: legacy[path]
+    monkeypatch.setitem(sys.modules, "chromadb", chromadb)
+    os.makedirs(pipeline.LEGACY_VECTOR_STORE_DIR)
+    return SimpleNamespace(pipeline=pipeline, client=client, legacy=legacy, root=pipeline.LEGACY_VECTOR_STORE_DIR)
+
+
+def add_legacy_store(store, dirname, chunks=3, manifest=True):
+    path = os.path.join(store.root, dirname)
+    os.makedirs(path)
+    legacy_client = FakeChromaClient()
+    legacy_client.get_or_create_collection("langchain").add(
+        ids=[f"h:{i}" for i in range(chunks)],
+        embeddings=[[float(i), 0.5] for i in range(chunks)],
+        documents=[f"chunk {i}" for i in range(chunks)],
+        metadatas=[{"file_hash": "h"} for _ in range(chunks)],
+    )
+    store.legacy[path] = legacy_client
+    if manifest:
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump({"files": {"k": "h"}, "chunks": {"h": [f"h:{i}" for i in range(chunks)]}}, f)
+    return path
+
+
+def test_migrates_vectors_and_manifest(store):
+    path = add_legacy_store(store, "chroma_db_c1")
+    assert store.pipeline.migrate_legacy_store(path, "case_c1")
+    records = store.client.get_collection("case_c1").records
+    assert sorted(records) == ["h:0", "h:1", "h:2"]
+    assert records["h:2"] == {"embedding": [2.0, 0.5], "document": "chunk 2", "metadata": {"file_hash": "h"}}
+    assert store.pipeline.read_manifest("case_c1")["chunks"] == {"h": ["h:0", "h:1", "h:2"]}
+    assert not os.path.exists(path)
+
+
+def test_already_migrated_store_keeps_its_collection(store):
+    path = add_legacy_store(store, "chroma_db_c1")
+    store.client.get_or_create_collection("case_c1").add(ids=["current:0"])
+    store.pipeline.write_manifest("case_c1", {"files": {}, "chunks": {"current": ["current:0"]}})
+    assert store.pipeline.migrate_legacy_store(path, "case_c1")
+    assert list(store.client.get_collection("case_c1").records) == ["current:0"]
+    assert store.pipeline.read_manifest("case_c1")["chunks"] == {"current": ["current:0"]}
+    assert not os.path.exists(path)
+
+
+def test_missing_legacy_directory_is_left_alone(store):
+    assert not store.pipeline.migrate_legacy_store(os.path.join(store.root, "chroma_db_gone"), "case_gone")
+    assert store.client.collections == {}
+    assert store.pipeline.migrate_legacy_stores() == {"migrated": 0, "failed": 0}
+
+
+def test_partially_migrated_store_is_copied_again(store):
+    path = add_legacy_store(store, "chroma_db_c1", chunks=4)
+    # An interrupted migration: some chunks copied, no manifest written
+    store.client.get_or_create_collection("case_c1").add(ids=["h:0"], documents=["chunk 0"])
+    assert store.pipeline.migrate_legacy_store(path, "case_c1")
+    assert sorted(store.client.get_collection("case_c1").records) == ["h:0", "h:1", "h:2", "h:3"]
+    assert store.pipeline.read_manifest("case_c1")["chunks"] == {"h": ["h:0", "h:1", "h:2", "h:3"]}
+    assert not os.path.exists(path)
+
+
+def test_legacy_directory_without_manifest_is_dropped(store):
+    path = add_legacy_store(store, "chroma_db_c1", manifest=False)
+    assert store.pipeline.migrate_legacy_store(path, "case_c1")
+    assert store.client.collections == {} and not os.path.exists(path)
+
+
+def test_failed_copy_keeps_the_legacy_directory(store):
+    path = add_legacy_store(store, "chroma_db_c1")
+
+    def broken(include=None):
+        raise IOError("disk error")
+
+    store.legacy[path].get_collection("langchain").get = broken
+    assert store.pipeline.migrate_legacy_stores() == {"migrated": 0, "failed": 1}
+    assert os.path.isdir(path)
+    assert "chunks" not in store.pipeline.read_manifest("case_c1")
+
+
+def test_migrate_legacy_stores_names_case_and_plan_collections(store):
+    add_legacy_store(store, "chroma_db_c1")
+    add_legacy_store(store, "chroma_db_plan_p1")
+    os.makedirs(os.path.join(store.root, "unrelated"))
+    assert store.pipeline.migrate_legacy_stores() == {"migrated": 2, "failed": 0}
+    assert sorted(store.client.collections) == ["case_c1", "plan_p1"]
+    assert sorted(os.listdir(store.root)) == ["unrelated"]
@@ -0,0 +1,102 @@
+import gzip
+import json
+import os
+
+import pytest
+
+from store_snapshot import LocalDirectoryBackend, export_collection, import_collection, open_snapshot_backend
+
+
+class FakeCollection:
+    """The slice of a chromadb collection the snapshot code uses."""
+
+    def __init__(self):
+        self.ids, self.embeddings, self.documents, self.metadatas = [], [], [], []
+        self.add_calls = 0
+
+    def add(self, ids, embeddings, documents, metadatas):
+        self.add_calls += 1
+        self.ids += ids
+        self.embeddings += embeddings
+        self.documents += documents
+        self.metadatas += metadatas
+
+    def get(self, include):
+        return {"ids": self.ids, "embeddings": self.embeddings, "documents": self.documents, "metadatas": self.metadatas}
+
+
+def test_local_backend_round_trip(tmp_path):
+    events = []
+    backend = LocalDirectoryBackend(str(tmp_path / "snapshots"), on_write=lambda: events.append("write"), on_miss=lambda: events.append("miss"))
+    assert backend.get("case-1") is None and not backend.exists("case-1")
+    backend.put("case-1", b"blob")
+    assert backend.exists("case-1") and backend.get("case-1") == b"blob"
+    backend.delete("case-1")
+    backend.delete("case-1")
+    assert not backend.exists("case-1")
+    assert events == ["miss", "write", "write"]
+    assert not list((tmp_path / "snapshots").glob("*.tmp"))
+
+
+def test_export_import_round_trip():
+    source = FakeCollection()
+    source.add(
+        ids=[f"hash:{i}" for i in range(1200)],
+        embeddings=[[i * 0.5, -1.0, 2.25] for i in range(1200)],
+        documents=[f"chunk {i}" for i in range(1200)],
+        metadatas=[{"file_hash": "hash", "page": i // 10} for i in range(1200)],
+    )
+    manifest = {"sources": {"plan.pdf": "hash"}}
+    blob = export_collection(source, manifest)
+
+    target = FakeCollection()
+    assert import_collection(target, blob) == manifest
+    assert target.add_calls == 3
+    assert target.ids == source.ids and target.documents == source.documents and target.metadatas == source.metadatas
+    assert target.embeddings == source.embeddings
+
+
+def test_export_empty_collection():
+    target = FakeCollection()
+    assert import_collection(target, export_collection(FakeCollection(), {})) == {}
+    assert target.ids == []
+
+
+def test_import_rejects_other_versions():
+    blob = gzip.compress(json.dumps({"version": 99}).encode("utf-8"))
+    with pytest.raises(ValueError, match="Unsupported snapshot version"):
+        import_collection(FakeCollection(), blob)
+
+
+def test_open_snapshot_backend(tmp_path, monkeypatch):
+    monkeypatch.delenv("VECTOR_SNAPSHOT_DIR", raising=False)
+    assert open_snapshot_backend() is None
+    monkeypatch.setenv("VECTOR_SNAPSHOT_DIR", str(tmp_path / "snapshots"))
+    backend = open_snapshot_backend()
+    assert isinstance(backend, LocalDirectoryBackend) and backend.root == str(tmp_path / "snapshots")
+    (tmp_path / "file").write_text("not a directory")
+    assert open_snapshot_backend(str(tmp_path / "file")) is None
+
+
+def test_put_uses_a_unique_temp_file(tmp_path, monkeypatch):
+    backend = LocalDirectoryBackend(str(tmp_path))
+    replaced = []
+    real_replace = os.replace
+    monkeypatch.setattr(os, "replace", lambda src, dst: (replaced.append(src), real_replace(src, dst)))
+    backend.put("case-1", b"one")
+    backend.put("case-1", b"two")
+    assert len(set(replaced)) == 2 and all(src.endswith(".tmp") for src in replaced)
+    assert backend.get("case-1") == b"two"
+    assert os.listdir(tmp_path) == ["case-1.json.gz"]
+
+
+def test_failed_put_removes_its_temp_file(tmp_path, monkeypatch):
+    backend = LocalDirectoryBackend(str(tmp_path))
+
+    def fail(src, dst):
+        raise OSError("volume full")
+
+    monkeypatch.setattr(os, "replace", fail)
+    with pytest.raises(OSError):
+        backend.put("case-1", b"blob")
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,61 @@
+import pytest
+
+from structured_output import (
+    ANALYSIS_SCHEMA,
+    EMAIL_ANALYSIS_SCHEMA,
+    PLAN_FIELDS_SCHEMA,
+    parse_structured,
+    schema_errors,
+)
+
+
+def test_parses_bare_json():
+    text = '{"insuranceCompany": "Aetna", "planName": "Gold PPO", "policyNumber": "X1"}'
+    assert parse_structured(text, PLAN_FIELDS_SCHEMA)["planName"] == "Gold PPO"
+
+
+def test_parses_object_wrapped_in_fences_and_prose():
+    text = 'Here you go:\n```json\n{"analysis": "ok", "terms": []}\n```'
+    assert parse_structured(text, ANALYSIS_SCHEMA) == {"analysis": "ok", "terms": []}
+
+
+def test_rejects_text_without_an_object():
+    with pytest.raises(ValueError, match="No JSON object"):
+        parse_structured("no json here", ANALYSIS_SCHEMA)
+
+
+def test_reports_missing_required_key():
+    assert schema_errors({"analysis": "ok"}, ANALYSIS_SCHEMA) == "$.terms is missing"
+
+
+@pytest.mark.parametrize(
+    "value, problem",
+    [
+        ({"insuranceCompany": None, "planName": "p", "policyNumber": "n"}, "$.insuranceCompany is null"),
+        ({"analysis": "ok", "terms": None}, "$.terms is null"),
+        ({"analysis": "ok", "terms": [{"term": None, "definition": "d"}]}, "$.terms[0].term is null"),
+    ],
+)
+def test_rejects_null_required_values(value, problem):
+    schema = PLAN_FIELDS_SCHEMA if "planName" in value else ANALYSIS_SCHEMA
+    assert schema_errors(value, schema) == problem
+
+
+def test_allows_null_optional_values():
+    schema = {"type": "OBJECT", "properties": {"note": {"type": "STRING"}}, "required": []}
+    assert schema_errors({"note": None}, schema) is None
+
+
+def test_reports_nested_type_errors():
+    value = {"summary": "s", "weaknesses": ["w"], "terms": [], "actionItems": ["a", 3]}
+    assert schema_errors(value, EMAIL_ANALYSIS_SCHEMA) == "$.actionItems[1] is not string"
+
+
+def test_booleans_are_not_numbers():
+    assert schema_errors(True, {"type": "INTEGER"}) == "$ is not integer"
+    assert schema_errors(2.5, {"type": "NUMBER"}) is None
+
+
+def test_keeps_extra_keys():
+    data = parse_structured('{"body": "hi", "extra": 1}', {"type": "OBJECT", "properties": {"body": {"type": "STRING"}}, "required": ["body"]})
+    assert data["extra"] == 1
@@ -0,0 +1,101 @@
+import pytest
+
+import thread_context
+from thread_context import build_thread_context, count_tokens, fit_to_budget, format_email
+
+
+def email(i, body="short body"):
+    return {"type": "inbound", "date": f"2026-01-{i + 1:02d}", "from": "insurer@example.com", "subject": f"msg {i}", "body": body}
+
+
+class Summarizer:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, previous, new_messages):
+        self.calls.append((previous, new_messages))
+        return f"summary after {len(self.calls)} call(s)"
+
+
+def test_short_thread_is_verbatim():
+    summarize = Summarizer()
+    context, updated = build_thread_context([email(0), email(1)], None, summarize, recent_messages=3)
+    assert "msg 0" in context and "msg 1" in context
+    assert updated is None and summarize.calls == []
+
+
+def test_older_messages_are_summarized_once():
+    emails = [email(i) for i in range(5)]
+    summarize = Summarizer()
+    context, updated = build_thread_context(emails, None, summarize, recent_messages=2)
+    assert updated == {"summary": "summary after 1 call(s)", "messageCount": 3}
+    assert "Summary of the 3 earlier message(s)" in context
+    assert "msg 3" in context and "msg 4" in context and "Subject: msg 2" not in context
+
+    _, again = build_thread_context(emails, updated, summarize, recent_messages=2)
+    assert again is None and len(summarize.calls) == 1
+
+
+def test_only_newly_older_messages_are_summarized():
+    summarize = Summarizer()
+    stored = {"summary": "old", "messageCount": 3}
+    _, updated = build_thread_context([email(i) for i in range(7)], stored, summarize, recent_messages=2)
+    previous, new_messages = summarize.calls[0]
+    assert previous == "old" and "msg 3" in new_messages and "msg 4" in new_messages and "msg 2" not in new_messages
+    assert updated["messageCount"] == 5
+
+
+def test_first_summary_is_folded_in_batches(monkeypatch):
+    monkeypatch.setattr(thread_context, "THREAD_SUMMARY_BATCH_TOKEN_BUDGET", 400)
+    emails = [email(i, body="word " * 150) for i in range(10)]
+    summarize = Summarizer()
+    _, updated = build_thread_context(emails, None, summarize, recent_messages=1)
+    assert len(summarize.calls) > 1
+    assert all(count_tokens(batch) <= 400 + 10 for _, batch in summarize.calls)
+    # Each batch builds on the previous call's summary and every message is sent exactly once
+    assert [previous for previous, _ in summarize.calls[1:]] == [f"summary after {n} call(s)" for n in range(1, len(summarize.calls))]
+    assert "".join(batch for _, batch in summarize.calls).count("Subject: msg") == 9
+    assert updated["messageCount"] == 9
+
+
+def test_oversized_message_is_capped_in_its_batch(monkeypatch):
+    monkeypatch.setattr(thread_context, "THREAD_SUMMARY_BATCH_TOKEN_BUDGET", 100)
+    summarize = Summarizer()
+    build_thread_context([email(0, body="x" * 5000), email(1)], None, summarize, recent_messages=1)
+    assert len(summarize.calls) == 1 and summarize.calls[0][1].endswith("[...truncated]")
+
+
+def test_summary_and_recent_window_do_not_overlap():
+    emails = [email(i) for i in range(6)]
+    summarize = Summarizer()
+    stored = {"summary": "covers 0-4", "messageCount": 5}
+    context, updated = build_thread_context(emails, stored, summarize, recent_messages=3)
+    assert updated is None and summarize.calls == []
+    assert "Summary of the 5 earlier message(s)" in context
+    assert "Subject: msg 5" in context and "Subject: msg 4" not in context and "Subject: msg 3" not in context
+
+
+def test_summary_is_rebuilt_when_thread_shrinks():
+    summarize = Summarizer()
+    stored = {"summary": "stale", "messageCount": 8}
+    _, updated = build_thread_context([email(i) for i in range(4)], stored, summarize, recent_messages=2)
+    assert summarize.calls[0][0] == ""
+    assert updated["messageCount"] == 2
+
+
+def test_recent_window_respects_token_budget(monkeypatch):
+    monkeypatch.setattr(thread_context, "THREAD_RECENT_TOKEN_BUDGET", 300)
+    emails = [email(0), email(1, body="y" * 800), email(2, body="z" * 800)]
+    context, updated = build_thread_context(emails, None, Summarizer(), recent_messages=3)
+    assert "Subject: msg 2" in context and "Subject: msg 1" not in context
+    assert updated["messageCount"] == 2
+
+
+def test_format_email_includes_stored_analysis():
+    entry = format_email(dict(email(0), analysis={"summary": "denied", "weaknesses": ["no code"], "actionItems": ["appeal"]}))
+    assert "[INBOUND]" in entry and "Summary: denied" in entry and "- no code" in entry and "- appeal" in entry
+
+
+@pytest.mark.parametrize("text, capped", [("short", False), ("long " * 500, True)])
+def test_fit_to_budget(text, capped):
+    assert fit_to_budget(text, 50).endswith("[...truncated]") is capped
@@ -0,0 +1,129 @@
+import hashlib
+import os
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture
+def store(pipeline_store, monkeypatch):
+    """
+    pipeline_store plus fake fetchers: file bytes come from `contents` by file
+    name, each "|"-separated part of the bytes is a page and each page one chunk.
+    """
+    pipeline, client = pipeline_store
+    contents = {}
+    downloads = []
+
+    def download_file_bytes(file_data, bucket_name, sb=None):
+        downloads.append(file_data["name"])
+        return contents.get(file_data["name"])
+
+    def load_pdf_bytes(data, source="memory.pdf"):
+        pages = data.decode("utf-8").split("|")
+        return [SimpleNamespace(page_content=text, metadata={"source": source, "page": i, "start_index": 0}) for i, text in enumerate(pages)]
+
+    monkeypatch.setattr(pipeline, "download_file_bytes", download_file_bytes)
+    monkeypatch.setattr(pipeline, "load_pdf_bytes", load_pdf_bytes)
+    monkeypatch.setattr(pipeline, "split_documents", lambda docs: docs)
+    return SimpleNamespace(pipeline=pipeline, client=client, contents=contents, downloads=downloads)
+
+
+def files(*names, size=10):
+    return [{"name": name, "path": f"case/{name}", "size": size} for name in names]
+
+
+def sync(store, names, size=10, **kwargs):
+    return store.pipeline.sync_vector_store("case_c1", files(*names, size=size), "denials", **kwargs)
+
+
+def hash_of(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def test_first_sync_embeds_every_file(store):
+    store.contents.update({"a.pdf": b"a1|a2", "b.pdf": b"b1"})
+    db, chunk_count = sync(store, ["a.pdf", "b.pdf"], chunk_metadata={"case_id": "c1"}, manifest_extra={"kind": "case", "caseId": "c1"})
+    assert chunk_count == 3
+    records = store.client.get_collection("case_c1").records
+    assert sorted(records) == sorted([f"{hash_of('a1|a2')}:0", f"{hash_of('a1|a2')}:1", f"{hash_of('b1')}:0"])
+    assert records[f"{hash_of('b1')}:0"]["metadata"] == {"source": "b.pdf", "page": 0, "start_index": 0, "case_id": "c1", "file_hash": hash_of("b1")}
+
+    manifest = store.pipeline.read_manifest("case_c1")
+    assert manifest["kind"] == "case" and manifest["caseId"] == "c1"
+    assert manifest["files"] == {"denials/case/a.pdf:10": hash_of("a1|a2"), "denials/case/b.pdf:10": hash_of("b1")}
+    assert manifest["chunks"][hash_of("a1|a2")] == [f"{hash_of('a1|a2')}:0", f"{hash_of('a1|a2')}:1"]
+    assert set(manifest["sizes"]) == {hash_of("a1|a2"), hash_of("b1")}
+    assert manifest["lastAccess"] > 0
+
+
+def test_unchanged_files_are_not_downloaded_again(store):
+    store.contents.update({"a.pdf": b"a1"})
+    sync(store, ["a.pdf"])
+    before = store.pipeline.read_manifest("case_c1")
+    _, chunk_count = sync(store, ["a.pdf"])
+    assert store.downloads == ["a.pdf"] and chunk_count == 1
+    after = store.pipeline.read_manifest("case_c1")
+    assert after["files"] == before["files"] and after["chunks"] == before["chunks"]
+
+
+def test_removed_files_lose_their_chunks(store):
+    store.contents.update({"a.pdf": b"a1", "b.pdf": b"b1|b2"})
+    sync(store, ["a.pdf", "b.pdf"])
+    _, chunk_count = sync(store, ["a.pdf"])
+    assert chunk_count == 1
+    assert list(store.client.get_collection("case_c1").records) == [f"{hash_of('a1')}:0"]
+    manifest = store.pipeline.read_manifest("case_c1")
+    assert list(manifest["files"]) == ["denials/case/a.pdf:10"]
+    assert list(manifest["chunks"]) == list(manifest["sizes"]) == [hash_of("a1")]
+
+
+def test_identical_reupload_is_recognised_by_hash(store):
+    store.contents.update({"a.pdf": b"same", "copy.pdf": b"same"})
+    sync(store, ["a.pdf"])
+    _, chunk_count = sync(store, ["copy.pdf"])
+    assert store.downloads == ["a.pdf", "copy.pdf"] and chunk_count == 1
+    assert list(store.client.get_collection("case_c1").records) == [f"{hash_of('same')}:0"]
+    assert store.pipeline.read_manifest("case_c1")["files"] == {"denials/case/copy.pdf:10": hash_of("same")}
+
+
+def test_changed_content_replaces_old_chunks(store):
+    store.contents.update({"a.pdf": b"v1"})
+    sync(store, ["a.pdf"])
+    # Re-uploaded under the same path with new content (and so a new size)
+    store.contents.update({"a.pdf": b"v2|v2b"})
+    _, chunk_count = sync(store, ["a.pdf"], size=12)
+    assert chunk_count == 2
+    assert sorted(store.client.get_collection("case_c1").records) == [f"{hash_of('v2|v2b')}:0", f"{hash_of('v2|v2b')}:1"]
+    manifest = store.pipeline.read_manifest("case_c1")
+    assert manifest["files"] == {"denials/case/a.pdf:12": hash_of("v2|v2b")}
+    assert list(manifest["chunks"]) == list(manifest["sizes"]) == [hash_of("v2|v2b")]
+
+
+def test_undownloadable_files_are_dropped(store):
+    store.contents.update({"a.pdf": b"a1"})
+    sync(store, ["a.pdf"])
+    store.contents.clear()
+    _, chunk_count = sync(store, ["gone.pdf"])
+    assert chunk_count == 0 and store.client.get_collection("case_c1").records == {}
+    assert store.pipeline.read_manifest("case_c1")["files"] == {}
+
+
+def test_collection_without_manifest_is_rebuilt(store):
+    stale = store.client.get_or_create_collection("case_c1")
+    stale.add(ids=["orphan"], documents=["old"])
+    store.contents.update({"a.pdf": b"a1"})
+    _, chunk_count = sync(store, ["a.pdf"])
+    assert chunk_count == 1
+    assert list(store.client.get_collection("case_c1").records) == [f"{hash_of('a1')}:0"]
+
+
+def test_manifest_writes_use_unique_temp_files(store, monkeypatch):
+    replaced = []
+    real_replace = os.replace
+    monkeypatch.setattr(os, "replace", lambda src, dst: (replaced.append(src), real_replace(src, dst)))
+    store.pipeline.write_manifest("case_c1", {"files": {}})
+    store.pipeline.write_manifest("case_c1", {"files": {"k": "h"}})
+    assert len(set(replaced)) == 2
+    assert store.pipeline.read_manifest("case_c1") == {"files": {"k": "h"}}
+    assert os.listdir(os.path.dirname(replaced[0])) == ["case_c1.json"]
@@ -0,0 +1,140 @@
+"""
+Token-budgeted email thread context for the PolicyPilot prompts.
+
+Appeal threads only grow, so putting every message into the prompt makes
+latency and cost grow with the thread. Instead the latest THREAD_RECENT_MESSAGES
+messages go in verbatim and everything older is folded into a rolling
+summary. The summary is stored on the case as
+
+    emailThreadSummary: { "summary": str, "messageCount": int }
+
+where messageCount is how many leading messages it covers, so each message is
+summarised once: later requests only summarise messages that have since
+dropped out of the verbatim window, on top of the stored summary. Messages
+are folded in batches of at most THREAD_SUMMARY_BATCH_TOKEN_BUDGET tokens,
+so summarising a long thread for the first time never sends it in one
+prompt. Messages the summary already covers are left out of the verbatim
+window, so the two never overlap.
+
+Every section is held to a hard token budget (counted with retrieval.count_tokens).
+
+Configuration (environment):
+    THREAD_RECENT_MESSAGES          messages included verbatim (default 3)
+    THREAD_RECENT_TOKEN_BUDGET      tokens for the verbatim messages (default 2500)
+    THREAD_SUMMARY_TOKEN_BUDGET     tokens for the summary of older messages (default 800)
+    THREAD_SUMMARY_BATCH_TOKEN_BUDGET  tokens of messages per summarisation call (default 6000)
+    ANALYSIS_CONTEXT_TOKEN_BUDGET   tokens for the stored denial analysis (default 1500)
+"""
+
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from retrieval import count_tokens, truncate_to_tokens
+
+THREAD_RECENT_MESSAGES = int(os.getenv("THREAD_RECENT_MESSAGES", "3"))
+THREAD_RECENT_TOKEN_BUDGET = int(os.getenv("THREAD_RECENT_TOKEN_BUDGET", "2500"))
+THREAD_SUMMARY_TOKEN_BUDGET = int(os.getenv("THREAD_SUMMARY_TOKEN_BUDGET", "800"))
+THREAD_SUMMARY_BATCH_TOKEN_BUDGET = int(os.getenv("THREAD_SUMMARY_BATCH_TOKEN_BUDGET", "6000"))
+ANALYSIS_CONTEXT_TOKEN_BUDGET = int(os.getenv("ANALYSIS_CONTEXT_TOKEN_BUDGET", "1500"))
+
+SEPARATOR = "--------------------------------------------------"
+
+
+def format_email(email: Dict[str, Any]) -> str:
+    """One thread message, including the stored per-email analysis if any."""
+    entry = (
+        f"{SEPARATOR}\n"
+        f"[{(email.get('type') or 'unknown').upper()}] {email.get('date', '')}\n"
+        f"From: {email.get('from', 'Unknown')}\n"
+        f"Subject: {email.get('subject', 'No Subject')}\n"
+        f"Body:\n{email.get('body', '')}\n"
+    )
+    analysis = email.get("analysis")
+    if analysis:
+        entry += "\n[INTERNAL ANALYSIS]\n"
+        entry += f"Summary: {analysis.get('summary') or 'N/A'}\n"
+        entry += "Weaknesses Identified:\n" + "".join(f"- {w}\n" for w in analysis.get("weaknesses") or [])
+        entry += "Recommended Actions:\n" + "".join(f"- {a}\n" for a in analysis.get("actionItems") or [])
+    return entry + SEPARATOR
+
+
+def fit_to_budget(text: str, max_tokens: int) -> str:
+    """Hard-cap a prompt section at `max_tokens`."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    return truncate_to_tokens(text, max_tokens) + "\n[...truncated]"
+
+
+def _batches(emails: List[Dict[str, Any]], max_tokens: int) -> List[str]:
+    """Formatted messages joined into chunks of at most `max_tokens`; oversized messages are capped."""
+    batches: List[str] = []
+    batch: List[str] = []
+    used = 0
+    for email in emails:
+        formatted = fit_to_budget(format_email(email), max_tokens)
+        cost = count_tokens(formatted)
+        if batch and used + cost > max_tokens:
+            batches.append("\n".join(batch))
+            batch, used = [], 0
+        batch.append(formatted)
+        used += cost
+    if batch:
+        batches.append("\n".join(batch))
+    return batches
+
+
+def build_thread_context(
+    emails: List[Dict[str, Any]],
+    stored_summary: Optional[Dict[str, Any]],
+    summarize: Callable[[str, str], str],
+    recent_messages: int = None,
+) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Build the email-thread section of a prompt.
+
+    `summarize(previous_summary, new_messages_text)` is only called when
+    messages have left the verbatim window since `stored_summary` was made,
+    once per batch of them.
+    Returns (context_text, updated_summary); updated_summary is None when the
+    stored summary is still current and doesn't need to be written back.
+    """
+    if not emails:
+        return "", None
+    recent_messages = THREAD_RECENT_MESSAGES if recent_messages is None else recent_messages
+
+    # Walk back from the newest message, keeping whole messages while they fit
+    recent: List[str] = []
+    used = 0
+    split = len(emails)
+    while split > 0 and len(recent) < recent_messages:
+        formatted = format_email(emails[split - 1])
+        cost = count_tokens(formatted)
+        if recent and used + cost > THREAD_RECENT_TOKEN_BUDGET:
+            break
+        recent.insert(0, fit_to_budget(formatted, THREAD_RECENT_TOKEN_BUDGET))
+        used += cost
+        split -= 1
+
+    summary = (stored_summary or {}).get("summary", "")
+    covered = (stored_summary or {}).get("messageCount", 0)
+    updated = None
+    if covered > split:
+        if covered >= len(emails):
+            # Thread was rewritten underneath the summary; start over
+            summary, covered = "", 0
+        else:
+            # The window reaches back past the summary (shorter recent messages
+            # than last time); drop the messages it already covers
+            recent = recent[covered - split:]
+            split = covered
+    if split > covered:
+        for batch in _batches(emails[covered:split], THREAD_SUMMARY_BATCH_TOKEN_BUDGET):
+            summary = fit_to_budget(summarize(summary, batch).strip(), THREAD_SUMMARY_TOKEN_BUDGET)
+        covered = split
+        updated = {"summary": summary, "messageCount": covered}
+
+    sections = []
+    if summary and covered:
+        sections.append(f"Summary of the {covered} earlier message(s):\n{summary}")
+    sections.append("Most recent message(s), oldest first:\n" + "\n".join(recent))
+    return "\n\n".join(sections), updated
@@ -69,6 +69,11 @@ const caseSchema = new mongoose.Schema({
     body: String,
   },
   emailThread: [emailMessageSchema],
+  // Rolling summary of the oldest `messageCount` thread messages, maintained by the RAG pipeline
+  emailThreadSummary: {
+    summary: String,
+    messageCount: Number,
+  },
   resolved: Boolean,
   resolvedDate: String,
   feedback: String,